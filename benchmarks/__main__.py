@@ -0,0 +1,405 @@
+'''
+Run the benchmarks: python -m benchmarks [-o results.json] [--compare old.json]
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+from dmarc_policy_parser import dmarc, dns, dnswire, public_suffix
+from dmarc_policy_parser.bulk import get_dmarc_policies
+from dmarc_policy_parser.bulk import BulkResult
+from dmarc_policy_parser.cache import MemoryCache, SqliteCache
+from dmarc_policy_parser.columnar import ResultTable
+from dmarc_policy_parser.disposition import (
+    evaluate_message, evaluate_messages,
+)
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.files import set_cache_home
+from dmarc_policy_parser.resolver import (
+    ResolverPool, set_nameservers, set_resolver_pool,
+)
+
+from benchmarks import corpus
+from benchmarks.harness import Runner, environment, compare
+from tests.stubdns import StubServer, Zone
+
+
+GROUPS = ('parse', 'psl', 'cache', 'lookup', 'disposition', 'results',
+          'startup')
+
+SIZES = {
+    # parse records, PSL domains, cache sizes, cache samples, lookups,
+    # messages, result rows, new processes
+    'full': (20000, 50000, (1000, 10000, 100000), 5000, 5000, 20000,
+             200000, 20),
+    'quick': (2000, 5000, (1000, 10000), 500, 500, 2000, 20000, 5),
+}
+
+
+parser = argparse.ArgumentParser(prog='python -m benchmarks')
+parser.add_argument('-o', '--output', help='write the results as JSON')
+parser.add_argument('--compare', metavar='JSON',
+                    help='compare with the results of a previous run')
+parser.add_argument('--only', action='append', choices=GROUPS,
+                    help='only run this group of benchmarks; may be repeated')
+parser.add_argument('--quick', action='store_true',
+                    help='use smaller inputs')
+parser.add_argument('--seed', type=int, default=1,
+                    help='seed for generating the inputs (default: 1)')
+parser.add_argument('--repeat', type=int, default=3,
+                    help='time each benchmark this many times and report '
+                    'the fastest (default: 3)')
+parser.add_argument('--no-memory', dest='memory', action='store_false',
+                    help='skip the tracemalloc pass of each benchmark')
+parser.add_argument('--public-suffix-file',
+                    help='public suffix list to use (default: a system copy '
+                    'if there is one)')
+
+
+def _ignore_errors(fn, *exceptions):
+    def wrapper(x):
+        try:
+            fn(x)
+        except exceptions:
+            pass
+
+    return wrapper
+
+
+def bench_parse(runner, rng, n):
+    records = corpus.make_records(rng, n)
+    runner.run('parse.parse_dmarc_policy',
+               _ignore_errors(dmarc.parse_dmarc_policy, ValueError), records)
+    runner.run('parse.parse_dmarc_record',
+               _ignore_errors(dmarc.parse_dmarc_record, ValueError), records)
+    runner.run('parse.select_memoized',
+               _ignore_errors(
+                   lambda r: dmarc._select_dmarc_record('example.com', [r]),
+                   DmarcException),
+               records, setup=dmarc._parse_cached.cache_clear)
+
+
+def bench_psl(runner, rng, n):
+    domains = corpus.make_domains(rng, n)
+    clear = public_suffix._get_public_suffix.cache_clear
+    public_suffix.get_public_suffix_trie()
+
+    def prime():
+        clear()
+        for d in domains:
+            public_suffix.get_public_suffix(d)
+
+    runner.run('psl.get_public_suffix.cold', public_suffix.get_public_suffix,
+               domains, setup=clear)
+    runner.run('psl.get_public_suffix.warm', public_suffix.get_public_suffix,
+               domains, setup=prime)
+
+
+def bench_cache(runner, rng, sizes, samples, tmpdir):
+    now = time.time()
+    for size in sizes:
+        filename = os.path.join(tmpdir, 'cache-%d.sqlite3' % (size,))
+        cache = SqliteCache(filename)
+        names = ['_dmarc.' + d for d in corpus.make_domains(rng, size)]
+        cache.update((name, [corpus.make_record(rng, name[7:])], now, 3600)
+                     for name in names)
+        dns.set_dns_cache(cache)
+        sample = rng.sample(names, min(samples, size))
+        value = [corpus.make_record(rng, 'example.com')]
+
+        def reset():
+            dns.set_memory_cache(MemoryCache())
+
+        def prime():
+            reset()
+            for name in sample:
+                dns.get_dns_txt_record(name)
+
+        runner.run('cache.write n=%d' % (size,),
+                   lambda name: dns._store(name, value, 3600, 24*3600, now),
+                   ['new.%d.example' % i for i in range(len(sample))],
+                   setup=reset)
+        runner.run('cache.read.cold n=%d' % (size,), dns.get_dns_txt_record,
+                   sample, setup=reset)
+        runner.run('cache.read.warm n=%d' % (size,), dns.get_dns_txt_record,
+                   sample, setup=prime)
+        dns.set_dns_cache(None)
+        cache.close()
+
+
+def _stub_server(records, loss=0):
+    # A nameserver for records in a child process, answering UDP queries
+    # up to the EDNS payload size that the resolver advertises.
+    zone = Zone(records, loss=loss)
+    zone.udp_payload_size = dnswire.EDNS_PAYLOAD_SIZE
+    return StubServer(zone, process=True)
+
+
+def bench_lookup(runner, rng, n, tmpdir):
+    zone, domains = corpus.make_zone(rng, n)
+    counter = [0]
+
+    def reset():
+        counter[0] += 1
+        dns.set_dns_cache(SqliteCache(
+            os.path.join(tmpdir, 'lookup-%d.sqlite3' % counter[0])))
+        dns.set_memory_cache(MemoryCache())
+        dmarc._parse_cached.cache_clear()
+
+    def prime():
+        reset()
+        for d in domains:
+            get_dmarc_policy(d)
+
+    get_dmarc_policy = _ignore_errors(dmarc.get_dmarc_policy, DmarcException)
+    with _stub_server(zone) as server:
+        set_nameservers([server.address])
+        runner.run('lookup.get_dmarc_policy.cold', get_dmarc_policy,
+                   domains, setup=reset)
+        runner.run('lookup.get_dmarc_policy.warm', get_dmarc_policy,
+                   domains, setup=prime)
+        for concurrency in (8, 32):
+            runner.run_batch(
+                'lookup.get_dmarc_policies.cold c=%d' % (concurrency,),
+                lambda: get_dmarc_policies(domains, concurrency),
+                len(set(domains)), setup=reset)
+    # A small fraction of lost packets dominates the tail latency.
+    with _stub_server(zone, loss=0.02) as server:
+        set_nameservers([server.address])
+        for hedge in (False, True):
+            set_resolver_pool(ResolverPool(hedge=hedge))
+            runner.run('lookup.get_dmarc_policy.lossy%s' % (
+                ' hedge' if hedge else '',), get_dmarc_policy, domains,
+                setup=reset)
+    set_resolver_pool(ResolverPool())
+    dns.set_dns_cache(None)
+
+
+def _compose_disposition(message):
+    # What callers did before disposition: look up the policy and the
+    # record, and compare organizational domains for every identifier.
+    from_domain, spf_domain, dkim_domains = message
+    try:
+        policy = dmarc.get_dmarc_policy(from_domain)
+        record = dmarc.get_dmarc_record(from_domain)
+    except DmarcException:
+        return None
+    if record is None:
+        return 'none'
+    from_org = public_suffix.get_public_suffix(from_domain)
+
+    def aligned(domain, mode):
+        if mode == 's':
+            return domain == from_domain
+        return public_suffix.get_public_suffix(domain) == from_org
+
+    if (spf_domain and aligned(spf_domain, record.aspf) or
+            any(aligned(d, record.adkim) for d in dkim_domains)):
+        return 'none'
+    if record.percent is not None and random.random() * 100 >= record.percent:
+        return {'reject': 'quarantine'}.get(policy, 'none')
+    return policy
+
+
+def bench_disposition(runner, rng, n_domains, n_messages, tmpdir):
+    zone, domains = corpus.make_zone(rng, n_domains)
+    messages = corpus.make_messages(rng, domains, n_messages)
+    with _stub_server(zone) as server:
+        set_nameservers([server.address])
+        dns.set_dns_cache(SqliteCache(
+            os.path.join(tmpdir, 'disposition.sqlite3')))
+        dns.set_memory_cache(MemoryCache())
+        get_dmarc_policies(domains)
+        runner.run('disposition.compose.warm', _compose_disposition, messages)
+        runner.run('disposition.evaluate_message.warm',
+                   lambda m: evaluate_message(*m), messages)
+        runner.run_batch('disposition.evaluate_messages.warm',
+                         lambda: evaluate_messages(messages), len(messages))
+    dns.set_dns_cache(None)
+
+
+def bench_results(runner, rng, n, tmpdir):
+    records = []
+    for record in corpus.make_records(rng, max(n // 20, 1)):
+        try:
+            records.append(dmarc.parse_dmarc_record(record))
+        except ValueError:
+            pass
+    results = []
+    for domain in corpus.make_domains(rng, n):
+        x = rng.random()
+        if x < 0.4:
+            results.append(BulkResult(domain, None, None, None))
+        else:
+            record = rng.choice(records).with_domain(domain)
+            results.append(BulkResult(
+                domain, record, dmarc._effective_policy(domain, record), None))
+    filename = os.path.join(tmpdir, 'results.table')
+    table = ResultTable.from_results(results)
+    table.save(filename)
+
+    def as_dicts():
+        return [{'domain': r.domain, 'policy': r.policy,
+                 'record': None if r.record is None else
+                 json.loads(json.dumps(r.record.as_dict()))}
+                for r in results]
+
+    # Compare the peak memory of keeping a scan as dicts and as a table.
+    runner.run_batch('results.dicts.build', as_dicts, n)
+    runner.run_batch('results.table.build',
+                     lambda: ResultTable.from_results(results), n)
+    runner.run_batch('results.table.where',
+                     lambda: table.where(p='none', rua=None), n)
+    runner.run_batch('results.table.count_by',
+                     lambda: table.count_by('p', 'pct'), n)
+    runner.run_batch('results.table.load',
+                     lambda: ResultTable.load(filename).close(), n)
+
+
+# Run in a new interpreter by bench_startup with the arguments mode, cache
+# home, public suffix list and number of workers. Prints the latencies in
+# seconds measured from before the import of dmarc_policy_parser (import,
+# first_call) or from the fork of each worker (fork, fork_preload) to its
+# first lookup.
+_STARTUP_SCRIPT = '''
+import os, sys, json, time
+start = time.perf_counter()
+import dmarc_policy_parser
+mode, cache_home, psl_file, workers = sys.argv[1:]
+if mode == 'import':
+    print(json.dumps([time.perf_counter() - start]))
+    sys.exit()
+dmarc_policy_parser.set_cache_home(cache_home)
+dmarc_policy_parser.set_public_suffix_file(psl_file)
+# Nothing listens here: every answer must come from the cache.
+dmarc_policy_parser.set_nameservers([('127.0.0.1', 9)])
+if mode == 'first_call':
+    dmarc_policy_parser.get_dmarc_policy('mail.example.com')
+    print(json.dumps([time.perf_counter() - start]))
+    sys.exit()
+if mode == 'fork_preload':
+    dmarc_policy_parser.preload()
+latencies = []
+for _ in range(int(workers)):
+    r, w = os.pipe()
+    t = time.perf_counter()
+    pid = os.fork()
+    if pid == 0:
+        dmarc_policy_parser.get_dmarc_policy('mail.example.com')
+        os.write(w, repr(time.perf_counter() - t).encode())
+        os._exit(0)
+    os.close(w)
+    with os.fdopen(r) as fp:
+        latencies.append(float(fp.read()))
+    os.waitpid(pid, 0)
+print(json.dumps(latencies))
+'''
+
+
+def bench_startup(runner, n, tmpdir, psl_file):
+    # Import time and the latency of the first lookup of a new process or
+    # of a worker forked with and without preload, answered from the
+    # persistent cache: a missing record at the domain, and the record of
+    # its organizational domain.
+    if psl_file is None:
+        return
+    cache_home = os.path.join(tmpdir, 'startup')
+    os.mkdir(cache_home)
+    now = time.time()
+    cache = SqliteCache(os.path.join(cache_home, 'dns_txt_cache.sqlite3'))
+    cache.update([
+        ('_dmarc.mail.example.com', [], now, 3600),
+        ('_dmarc.example.com', ['v=DMARC1; p=reject'], now, 3600),
+    ])
+    cache.close()
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(dmarc.__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(
+        [root] + [p for p in [env.get('PYTHONPATH')] if p])
+
+    def start(mode, workers=1):
+        output = subprocess.check_output(
+            [sys.executable, '-c', _STARTUP_SCRIPT, mode, cache_home,
+             psl_file, str(workers)], env=env, cwd=tmpdir)
+        return json.loads(output.decode())
+
+    # Compile the public suffix list snapshot outside the timings.
+    start('first_call')
+    runner.run_measured('startup.import', start, ['import'] * n)
+    runner.run_measured('startup.first_call', start, ['first_call'] * n)
+    if hasattr(os, 'fork'):
+        runner.run_measured('startup.fork.first_call',
+                            lambda mode: start(mode, n), ['fork'])
+        runner.run_measured('startup.fork.first_call preload',
+                            lambda mode: start(mode, n), ['fork_preload'])
+
+
+def _public_suffix_file(filename):
+    if filename:
+        return filename
+    for filename in public_suffix.SYSTEM_PUBLIC_SUFFIX_FILES:
+        if os.path.exists(filename):
+            return filename
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    (n_parse, n_psl, cache_sizes, cache_samples, n_lookup, n_messages,
+     n_results, n_processes) = SIZES['quick' if args.quick else 'full']
+    runner = Runner(args.only, args.memory, args.repeat)
+    tmpdir = tempfile.mkdtemp(prefix='dmarc-benchmarks-')
+    try:
+        # Keep the benchmarks away from the user's cache.
+        set_cache_home(tmpdir)
+        filename = _public_suffix_file(args.public_suffix_file)
+        if filename:
+            public_suffix.set_public_suffix_file(filename)
+        if runner.selected('parse'):
+            bench_parse(runner, random.Random(args.seed), n_parse)
+        if runner.selected('psl'):
+            bench_psl(runner, random.Random(args.seed), n_psl)
+        if runner.selected('cache'):
+            bench_cache(runner, random.Random(args.seed), cache_sizes,
+                        cache_samples, tmpdir)
+        if runner.selected('lookup'):
+            bench_lookup(runner, random.Random(args.seed), n_lookup, tmpdir)
+        if runner.selected('disposition'):
+            bench_disposition(runner, random.Random(args.seed), n_lookup,
+                              n_messages, tmpdir)
+        if runner.selected('results'):
+            bench_results(runner, random.Random(args.seed), n_results, tmpdir)
+        if runner.selected('startup'):
+            bench_startup(runner, n_processes, tmpdir, filename)
+    finally:
+        shutil.rmtree(tmpdir)
+
+    env = environment()
+    try:
+        import resource
+    except ImportError:
+        pass
+    else:
+        # Kilobytes on Linux, bytes on macOS.
+        env['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    output = {
+        'environment': env,
+        'arguments': vars(args),
+        'results': runner.results,
+    }
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(output, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(runner.results, json.load(fp))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
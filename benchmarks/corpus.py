@@ -0,0 +1,180 @@
+'''
+Deterministic synthetic inputs shaped like what the library sees in
+practice: the tag mix and formatting of published DMARC records, and a
+domain mix dominated by .com with a long tail of ccTLDs, multi-label
+public suffixes, private suffixes and internationalized names.
+'''
+
+# (weight, suffix)
+SUFFIXES = (
+    (45, 'com'), (8, 'net'), (7, 'org'), (5, 'de'), (4, 'co.uk'),
+    (3, 'dk'), (3, 'nl'), (3, 'io'), (2, 'com.au'), (2, 'co.jp'),
+    (2, 'com.br'), (2, 'fr'), (2, 'ru'), (1, 'github.io'),
+    (1, 'blogspot.com'), (1, 'herokuapp.com'), (1, 'k12.ca.us'),
+    (1, 'xn--p1ai'), (1, 'рф'), (1, 'gov.uk'), (1, 'edu'),
+    (1, 'appspot.com'), (1, 'nom.br'), (1, 'kawasaki.jp'),
+)
+
+SUBDOMAIN_LABELS = (
+    'www', 'mail', 'smtp', 'mx', 'news', 'eu', 'us', 'shop', 'login',
+    'mailer', 'em', 'bounce', 'marketing', 'support',
+)
+
+_SYLLABLES = (
+    'ka', 'lo', 'mi', 'net', 'ra', 'tek', 'so', 'via', 'dan', 'ske',
+    'ban', 'ko', 'mail', 'data', 'bit', 'ly', 'on', 'go', 'pro', 'fi',
+)
+
+REPORTERS = (
+    'rua.agari.com', 'dmarc.postmarkapp.com', 'ag.dmarcian.com',
+    'rep.dmarcanalyzer.com', 'dmarc-reports.cloudflare.net',
+)
+
+
+def _weighted(rng, choices):
+    total = sum(w for w, _ in choices)
+    x = rng.uniform(0, total)
+    for w, v in choices:
+        x -= w
+        if x <= 0:
+            return v
+    return choices[-1][1]
+
+
+def make_label(rng):
+    return ''.join(rng.choice(_SYLLABLES)
+                   for _ in range(rng.randint(1, 4)))
+
+
+def make_org_domain(rng):
+    return '%s.%s' % (make_label(rng), _weighted(rng, SUFFIXES))
+
+
+def make_domains(rng, n):
+    '''
+    Returns n domain names: mostly organizational domains, some with one
+    to three subdomain labels, a few in upper case and a few invalid.
+    '''
+    result = []
+    for _ in range(n):
+        domain = make_org_domain(rng)
+        depth = _weighted(rng, ((60, 0), (25, 1), (10, 2), (5, 3)))
+        for _ in range(depth):
+            domain = '%s.%s' % (rng.choice(SUBDOMAIN_LABELS), domain)
+        x = rng.random()
+        if x < 0.02:
+            domain = domain.upper()
+        elif x < 0.03:
+            domain = domain.replace('.', '..', 1)
+        result.append(domain)
+    return result
+
+
+def _mailto(rng, domain):
+    if rng.random() < 0.5:
+        uri = 'mailto:dmarc@%s' % (domain,)
+    else:
+        uri = 'mailto:%s@%s' % (make_label(rng), rng.choice(REPORTERS))
+    if rng.random() < 0.05:
+        uri += '!%d%s' % (rng.randint(1, 50), rng.choice('km'))
+    return uri
+
+
+def make_record(rng, domain, invalid=0.02):
+    '''
+    Returns a DMARC record for domain. Most records only set p and rua;
+    a fraction given by invalid have a duplicate tag.
+    '''
+    tags = [('v', 'DMARC1'),
+            ('p', _weighted(rng, ((60, 'none'), (20, 'quarantine'),
+                                  (20, 'reject'))))]
+    if rng.random() < 0.85:
+        tags.append(('rua', ','.join(
+            _mailto(rng, domain) for _ in range(rng.randint(1, 3)))))
+    if rng.random() < 0.3:
+        tags.append(('ruf', _mailto(rng, domain)))
+        tags.append(('fo', rng.choice(('1', '0:1:d:s', 'd:s'))))
+    if rng.random() < 0.25:
+        tags.append(('sp', rng.choice(('none', 'quarantine', 'reject'))))
+    if rng.random() < 0.2:
+        tags.append(('pct', str(rng.choice((10, 25, 50, 100)))))
+    if rng.random() < 0.15:
+        tags.append(('adkim', rng.choice('rs')))
+        tags.append(('aspf', rng.choice('rs')))
+    if rng.random() < 0.1:
+        tags.append(('ri', '86400'))
+        tags.append(('rf', 'afrf'))
+    if rng.random() < invalid:
+        tags.append(('p', 'monitor'))
+    sep = rng.choice(('; ', ';', ' ; '))
+    record = sep.join('%s=%s' % kv for kv in tags)
+    if rng.random() < 0.5:
+        record += ';'
+    return record
+
+
+def make_records(rng, n):
+    '''
+    Returns n DMARC records. Like in real DNS data, many domains publish
+    the exact same record, so only about a third of them are distinct.
+    '''
+    distinct = [make_record(rng, make_org_domain(rng))
+                for _ in range(max(n // 3, 1))]
+    return [rng.choice(distinct) if rng.random() < 0.7 else
+            make_record(rng, make_org_domain(rng)) for _ in range(n)]
+
+
+def make_zone(rng, n):
+    '''
+    Returns (zone, domains) for an end-to-end lookup benchmark: zone maps
+    "_dmarc." names to TXT records and domains are n names to look up.
+    About 60% of the domains have a record of their own, 25% are
+    subdomains that fall back to their organizational domain and 15% have
+    no record at all. Some record sets also contain SPF records.
+    '''
+    zone = {}
+    domains = []
+    for _ in range(n):
+        domain = '%s.%s' % (make_label(rng), rng.choice(
+            ('com', 'net', 'org', 'co.uk', 'de', 'dk')))
+        x = rng.random()
+        if x < 0.85:
+            txt = [make_record(rng, domain, invalid=0)]
+            if rng.random() < 0.2:
+                txt.append('v=spf1 include:_spf.%s ~all' % (domain,))
+            zone['_dmarc.' + domain] = txt
+        if 0.6 <= x < 0.85:
+            domain = '%s.%s' % (rng.choice(SUBDOMAIN_LABELS), domain)
+        domains.append(domain)
+    return zone, domains
+
+
+ESP_DOMAINS = (
+    'sendgrid.net', 'amazonses.com', 'mailchimpapp.net', 'mcsv.net',
+    'bounces.google.com', 'mailgun.org',
+)
+
+
+def make_messages(rng, domains, n):
+    '''
+    Returns n (from_domain, spf_domain, dkim_domains) messages as seen by a
+    receiver, with From domains taken from domains, so the same senders
+    recur as in a mail queue. Most messages are signed by their own domain
+    or a subdomain of it, many are also signed or sent by an email service
+    provider, and some are spoofed.
+    '''
+    messages = []
+    for _ in range(n):
+        domain = rng.choice(domains)
+        esp = rng.choice(ESP_DOMAINS)
+        x = rng.random()
+        if x < 0.5:
+            message = (domain, 'bounce.' + domain, (domain, esp))
+        elif x < 0.75:
+            message = (domain, esp, ('em.' + domain,))
+        elif x < 0.9:
+            message = (domain, esp, (esp,))
+        else:
+            message = (domain, None, ())
+        messages.append(message)
+    return messages
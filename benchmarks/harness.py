@@ -0,0 +1,172 @@
+'''
+Timing and memory measurement for the benchmarks.
+'''
+
+import gc
+import sys
+import time
+import platform
+import tracemalloc
+
+
+PERCENTILES = (50, 90, 99, 99.9)
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    i = min(int(len(sorted_values) * p / 100), len(sorted_values) - 1)
+    return sorted_values[i]
+
+
+def summarize(name, latencies, total_time, peak_memory):
+    '''
+    Returns the result dict of a benchmark: ops/s, latency percentiles
+    and maximum in microseconds, and peak traced memory in bytes.
+    '''
+    latencies = sorted(latencies)
+    result = {
+        'name': name,
+        'ops': len(latencies),
+        'seconds': total_time,
+        'ops_per_sec': len(latencies) / total_time if total_time else None,
+        'peak_memory': peak_memory,
+    }
+    for p in PERCENTILES:
+        result['p%s_us' % (p,)] = percentile(latencies, p) * 1e6
+    result['max_us'] = latencies[-1] * 1e6
+    return result
+
+
+class Runner:
+    '''
+    Runs benchmarks and collects their results.
+
+    Every benchmark is timed repeat times, keeping the fastest run as
+    timeit does, and then run once more under tracemalloc to find the peak
+    memory allocated while running it, since tracing slows down allocation
+    considerably.
+    '''
+
+    def __init__(self, only=None, memory=True, repeat=3, out=sys.stdout):
+        self.only = only
+        self.memory = memory
+        self.repeat = repeat
+        self.out = out
+        self.results = []
+
+    def selected(self, group):
+        return not self.only or group in self.only
+
+    def run(self, name, fn, inputs, setup=None):
+        '''
+        Time fn(x) for each x in inputs. setup is called before each pass
+        and may be used to reset caches.
+        '''
+        inputs = list(inputs)
+        timer = time.perf_counter
+
+        def timed_pass():
+            latencies = []
+            append = latencies.append
+            start = timer()
+            for x in inputs:
+                t = timer()
+                fn(x)
+                append(timer() - t)
+            return latencies, timer() - start
+
+        def untimed_pass():
+            for x in inputs:
+                fn(x)
+
+        self._run(name, timed_pass, untimed_pass, setup)
+
+    def run_batch(self, name, fn, n, setup=None):
+        '''
+        Time a single call fn() that performs n operations. Only the mean
+        latency is known, so all percentiles are reported as the mean.
+        '''
+        timer = time.perf_counter
+
+        def timed_pass():
+            start = timer()
+            fn()
+            total = timer() - start
+            return [total / n] * n, total
+
+        self._run(name, timed_pass, fn, setup)
+
+    def run_measured(self, name, fn, inputs, setup=None):
+        '''
+        Record the latencies in seconds that fn(x) returns as a list for
+        each x in inputs, for operations that must be timed elsewhere, e.g.
+        in a new process. Peak memory is not measured.
+        '''
+        inputs = list(inputs)
+
+        def timed_pass():
+            latencies = []
+            for x in inputs:
+                latencies.extend(fn(x))
+            return latencies, sum(latencies)
+
+        self._run(name, timed_pass, None, setup)
+
+    def _run(self, name, timed_pass, untimed_pass, setup):
+        best = None
+        for _ in range(self.repeat):
+            if setup is not None:
+                setup()
+            gc.collect()
+            latencies, total = timed_pass()
+            if best is None or total < best[1]:
+                best = latencies, total
+        latencies, total = best
+        peak = None
+        if self.memory and untimed_pass is not None:
+            if setup is not None:
+                setup()
+            gc.collect()
+            tracemalloc.start()
+            try:
+                untimed_pass()
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+        result = summarize(name, latencies, total, peak)
+        self.results.append(result)
+        self.report(result)
+
+    def report(self, result):
+        peak = result['peak_memory']
+        print('%-36s %10.0f ops/s  p50 %8.2f us  p99 %8.2f us  %s' % (
+            result['name'], result['ops_per_sec'] or 0, result['p50_us'],
+            result['p99_us'],
+            '' if peak is None else '%8.1f KiB' % (peak / 1024,)),
+            file=self.out, flush=True)
+
+
+def environment():
+    return {
+        'python': sys.version,
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+    }
+
+
+def compare(results, baseline, out=sys.stdout):
+    '''
+    Print the change in ops/s and p99 latency relative to a previous run.
+    '''
+    old = {r['name']: r for r in baseline['results']}
+    for r in results:
+        o = old.get(r['name'])
+        if o is None or not o['ops_per_sec'] or not r['ops_per_sec']:
+            continue
+        print('%-36s ops/s %+7.1f%%  p99 %+7.1f%%' % (
+            r['name'], 100 * (r['ops_per_sec'] / o['ops_per_sec'] - 1),
+            100 * (r['p99_us'] / o['p99_us'] - 1) if o['p99_us'] else 0),
+            file=out)
@@ -1,12 +1,93 @@
-from dmarc_policy_parser.dmarc import (
-    get_dmarc_policy,
-)
-from dmarc_policy_parser.exceptions import (
-    DmarcException,
-)
-from dmarc_policy_parser.files import (
-    set_cache_home,
-)
-
-
-__all__ = ['get_dmarc_policy', 'DmarcException', 'set_cache_home']
+'''
+The public API of dmarc_policy_parser.
+
+The names below are imported from their submodules when they are first
+used, so that importing the package is cheap and a process only loads the
+subsystems it needs. See preload to load them up front instead.
+'''
+
+import sys
+import types
+import importlib
+
+
+# Public name -> submodule that defines it. No name may be that of a
+# submodule, since importing the submodule binds it in the package.
+_EXPORTS = {
+    'get_dmarc_policies': 'bulk',
+    'prewarm_cache': 'bulk',
+    'PolicyClient': 'client',
+    'ResultTable': 'columnar',
+    'get_dmarc_policy': 'dmarc',
+    'async_get_dmarc_policy': 'dmarc',
+    'get_parsed_record_cache_stats': 'dmarc',
+    'set_policy_discovery': 'dmarc',
+    'evaluate_message': 'disposition',
+    'async_evaluate_message': 'disposition',
+    'evaluate_messages': 'disposition',
+    'TxtDataset': 'dataset',
+    'TxtIndex': 'dataset',
+    'build_txt_index': 'dataset',
+    'open_txt_dataset': 'dataset',
+    'get_dns_cache_stats': 'dns',
+    'set_dns_backend': 'dns',
+    'set_dns_cache': 'dns',
+    'set_memory_cache': 'dns',
+    'set_txt_source': 'dns',
+    'DmarcException': 'exceptions',
+    'set_cache_home': 'files',
+    'Metrics': 'metrics',
+    'get_metrics': 'metrics',
+    'set_metrics': 'metrics',
+    'get_public_suffix_age': 'public_suffix',
+    'set_public_suffix_background_refresh': 'public_suffix',
+    'set_public_suffix_file': 'public_suffix',
+    'ingest_reports': 'reports',
+    'parse_report': 'reports',
+    'StateStore': 'incremental',
+    'rescan': 'incremental',
+    'ResolverPool': 'resolver',
+    'set_nameservers': 'resolver',
+    'set_resolver_pool': 'resolver',
+    'PolicyServer': 'server',
+    'export_cache_snapshot': 'snapshot',
+    'import_cache_snapshot': 'snapshot',
+    'preload': 'warmup',
+}
+
+__all__ = [
+    'get_dmarc_policy', 'async_get_dmarc_policy', 'get_dmarc_policies',
+    'DmarcException',
+    'set_cache_home', 'set_dns_backend', 'set_dns_cache', 'set_memory_cache',
+    'set_nameservers', 'set_public_suffix_background_refresh',
+    'set_public_suffix_file', 'get_public_suffix_age', 'get_dns_cache_stats',
+    'get_parsed_record_cache_stats', 'Metrics', 'get_metrics', 'set_metrics',
+    'set_txt_source', 'TxtDataset', 'TxtIndex', 'build_txt_index',
+    'open_txt_dataset', 'prewarm_cache', 'export_cache_snapshot',
+    'import_cache_snapshot', 'PolicyServer', 'PolicyClient', 'ResolverPool',
+    'set_resolver_pool', 'set_policy_discovery', 'evaluate_message',
+    'async_evaluate_message', 'evaluate_messages', 'ingest_reports',
+    'parse_report', 'StateStore', 'rescan', 'ResultTable', 'preload',
+]
+
+
+class _Package(types.ModuleType):
+    # The class of this module: looks up the names of _EXPORTS in their
+    # submodules on first use. (Module __getattr__ needs Python 3.7.)
+
+    def __getattr__(self, name):
+        try:
+            module = _EXPORTS[name]
+        except KeyError:
+            raise AttributeError('module %r has no attribute %r' %
+                                 (self.__name__, name)) from None
+        module = importlib.import_module('%s.%s' % (self.__name__, module))
+        value = getattr(module, name)
+        super().__setattr__(name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_EXPORTS))
+
+
+sys.modules[__name__].__class__ = _Package
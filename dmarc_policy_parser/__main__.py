@@ -1,16 +1,352 @@
+import os
+import sys
+import csv
+import json
+import time
 import logging
-from dmarc_policy_parser import get_dmarc_policy
-from dmarc_policy_parser.public_suffix import test as test_public_suffix
+import argparse
+import collections
 
+from dmarc_policy_parser.bulk import iter_dmarc_records, prewarm_cache
+from dmarc_policy_parser.columnar import ResultTable
+from dmarc_policy_parser.dataset import build_txt_index, open_txt_dataset
+from dmarc_policy_parser.dmarc import (
+    POLICY_DISCOVERY_METHODS, set_policy_discovery,
+)
+from dmarc_policy_parser.dns import set_txt_source
+from dmarc_policy_parser.files import open_text, set_cache_home
+from dmarc_policy_parser.resolver import (
+    DNS_PORT, ResolverPool, set_nameservers, set_resolver_pool,
+)
+from dmarc_policy_parser.reports import ingest_reports
+from dmarc_policy_parser.incremental import rescan
+from dmarc_policy_parser.public_suffix import (
+    set_public_suffix_background_refresh, test as test_public_suffix,
+)
+from dmarc_policy_parser.server import parse_address, serve
+from dmarc_policy_parser.snapshot import (
+    export_cache_snapshot, import_cache_snapshot,
+)
 
-logging.basicConfig(level=logging.DEBUG)
 
+parser = argparse.ArgumentParser(
+    prog='python -m dmarc_policy_parser',
+    description='Look up the DMARC policies of a list of domains. '
+    'Results are written as they complete, one line per input domain.')
+parser.add_argument(
+    'input', nargs='?',
+    help='file with one domain per line, optionally gzip-compressed '
+    '(default: standard input, unless only importing or exporting a '
+    'snapshot)')
+parser.add_argument('-o', '--output', default='-',
+                    help='output file (default: standard output)')
+parser.add_argument('-f', '--format', choices=('jsonl', 'csv', 'table'),
+                    default='jsonl',
+                    help='output format; table writes a ResultTable file '
+                    'once all lookups are done and needs -o (default: jsonl)')
+parser.add_argument('-j', '--concurrency', type=int, default=32,
+                    help='number of concurrent lookups (default: 32)')
+parser.add_argument('-t', '--timeout', type=float, default=3,
+                    help='timeout in seconds of each DNS lookup, including '
+                    'its retries; finding the record of a domain may take '
+                    'several lookups (default: 3)')
+parser.add_argument('-d', '--deadline', type=float,
+                    help='give up on all remaining domains after this many '
+                    'seconds')
+parser.add_argument('-p', '--progress', type=float, default=10,
+                    metavar='SECONDS',
+                    help='print progress to stderr this often; '
+                    '0 to only print a summary at the end (default: 10)')
+parser.add_argument('-n', '--nameserver', action='append',
+                    metavar='ADDRESS[:PORT]',
+                    help='DNS server to use instead of the ones in '
+                    '/etc/resolv.conf; may be repeated')
+parser.add_argument('--discovery', choices=POLICY_DISCOVERY_METHODS,
+                    default='rfc7489',
+                    help='how to find the record of a domain without one of '
+                    'its own: the organizational domain (RFC 7489) or the '
+                    'DMARCbis tree walk (default: rfc7489)')
+parser.add_argument('--parallel-discovery', action='store_true',
+                    help='query all names that discovery may need at once')
+parser.add_argument('--hedge', action='store_true',
+                    help='also send a query to the next nameserver when the '
+                    'first is slower than usual to answer')
+parser.add_argument('--cache-home',
+                    help='directory for the DNS cache and the public suffix '
+                    'list')
+parser.add_argument('--dataset', metavar='FILE',
+                    help='look up records in a zone file, JSON Lines file or '
+                    'index of TXT records instead of DNS')
+parser.add_argument('--build-index', nargs=2, metavar=('DATASET', 'INDEX'),
+                    help='index a zone file or JSON Lines file of TXT '
+                    'records for --dataset and exit')
+parser.add_argument('--prewarm', action='store_true',
+                    help='only fill the DNS cache with the records of the '
+                    'domains; print a summary instead of the results')
+parser.add_argument('--import-snapshot', metavar='FILE',
+                    help='merge a cache snapshot into the DNS cache and '
+                    'install its public suffix list if it is newer, before '
+                    'any lookups')
+parser.add_argument('--export-snapshot', metavar='FILE',
+                    help='write the DNS cache and the public suffix list to '
+                    'a snapshot after any lookups')
+parser.add_argument('--serve', action='append', metavar='ADDRESS',
+                    help='instead of looking up a list of domains, serve '
+                    'lookups on a Unix socket (a path) or TCP (host:port) '
+                    'until interrupted; may be repeated')
+parser.add_argument('--reports', action='store_true',
+                    help='the input lists DMARC aggregate report files '
+                    '(XML, gzip or zip) instead of domains; write the '
+                    'updated totals of the domain of each report as it is '
+                    'read')
+parser.add_argument('--report-workers', type=int, metavar='N',
+                    help='number of processes reading reports '
+                    '(default: one per CPU)')
+parser.add_argument('--rescan', metavar='STATE',
+                    help='only write the domains whose policy or record '
+                    'changed since the last rescan with this state file, '
+                    'skipping domains whose DNS answers have not expired')
+parser.add_argument('--force-rescan', action='store_true',
+                    help='with --rescan, revalidate all domains')
+parser.add_argument('-v', '--verbose', action='count', default=0,
+                    help='log lookups (-vv for debug output)')
+parser.add_argument('--test-public-suffix', action='store_true',
+                    help='run the public suffix list self-test and exit')
 
-for d in 'gmail.com hotmail.com google.com yahoo.com tdc.dk danskebank.dk'.split():
-    print(d)
+
+CSV_FIELDS = ('domain', 'policy', 'record_domain', 'p', 'sp', 'pct', 'error')
+
+
+def parse_nameserver(s):
+    if s.startswith('['):
+        # [IPv6 address]:port
+        host, _, port = s[1:].partition(']')
+        return host, int(port.lstrip(':') or DNS_PORT)
+    if s.count(':') == 1:
+        host, port = s.split(':')
+        return host, int(port)
+    return s, DNS_PORT
+
+
+def read_domains(fp):
+    for line in fp:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+def _json_writer(fp):
+    def write(r):
+        fp.write(json.dumps({
+            'domain': r.domain,
+            'policy': r.policy,
+            'record': None if r.record is None else r.record.as_dict(),
+            'error': None if r.error is None else str(r.error),
+        }) + '\n')
+
+    return write
+
+
+def _csv_writer(fp):
+    writer = csv.writer(fp)
+    writer.writerow(CSV_FIELDS)
+
+    def write(r):
+        record = r.record or {}
+        writer.writerow((
+            r.domain, r.policy or '', record.get('domain', ''),
+            record.get('request', ''), record.get('srequest', ''),
+            record.get('percent', ''),
+            '' if r.error is None else str(r.error)))
+
+    return write
+
+
+class Progress:
+    def __init__(self, interval, fp=sys.stderr):
+        self.interval = interval
+        self.fp = fp
+        self.start = self.last = time.monotonic()
+        self.count = 0
+        self.counts = collections.Counter()
+
+    def add(self, result):
+        self.count += 1
+        if result.error is not None:
+            self.counts['error'] += 1
+        else:
+            self.counts[result.policy or 'no record'] += 1
+        if self.interval:
+            now = time.monotonic()
+            if now - self.last >= self.interval:
+                self.last = now
+                self.report(now)
+
+    def report(self, now=None):
+        elapsed = (now or time.monotonic()) - self.start
+        print('%d domains in %.1f s (%.1f/s): %s' % (
+            self.count, elapsed, self.count / max(elapsed, 1e-9),
+            ', '.join('%s %d' % kv for kv in sorted(self.counts.items()))),
+            file=self.fp, flush=True)
+
+
+def lookup(args):
+    table = None
+    if args.format == 'table':
+        if args.output == '-':
+            parser.error('-f table needs an output file')
+        output = sys.stdout
+        table = ResultTable()
+        write = table.append
+    else:
+        output = (sys.stdout if args.output == '-' else
+                  open(args.output, 'w', newline='' if args.format == 'csv'
+                       else None))
+        write = (_csv_writer if args.format == 'csv' else _json_writer)(
+            output)
+    progress = Progress(args.progress)
+    try:
+        with open_text(args.input or '-') as fp:
+            results = iter_dmarc_records(
+                read_domains(fp), args.concurrency, args.deadline,
+                unique=False, timeout=args.timeout)
+            for r in results:
+                write(r)
+                progress.add(r)
+        if table is not None:
+            table.save(args.output)
+        output.flush()
+    except BrokenPipeError:
+        # The reader went away, e.g. "| head". Point stdout at /dev/null so
+        # that Python does not complain again when flushing it at exit.
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    progress.report()
+
+
+def ingest(args):
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    reports = errors = mismatched = 0
     try:
-        print(get_dmarc_policy(d))
-    except Exception as exn:
-        print(repr(exn))
+        with open_text(args.input or '-') as fp:
+            results = ingest_reports(read_domains(fp), args.report_workers,
+                                     timeout=args.timeout)
+            for report, aggregate, differences in results:
+                reports += 1
+                if aggregate is None:
+                    errors += 1
+                    print('Could not read %s: %s' % (
+                        report.filename, report.error), file=sys.stderr)
+                    continue
+                mismatched += bool(differences)
+                line = aggregate.as_dict()
+                line['report'] = {
+                    'filename': report.filename,
+                    'org_name': report.org_name,
+                    'report_id': report.report_id,
+                    'messages': report.messages,
+                    'mismatches': differences,
+                }
+                output.write(json.dumps(line) + '\n')
+        output.flush()
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print('Read %d reports: %d errors, %d differing from the published '
+          'policy' % (reports, errors, mismatched), file=sys.stderr)
+
+
+def write_changes(args):
+    output = sys.stdout if args.output == '-' else open(args.output, 'w')
+    counts = {}
+    try:
+        with open_text(args.input or '-') as fp:
+            changes = rescan(read_domains(fp), args.rescan, args.concurrency,
+                             args.force_rescan, counts=counts,
+                             timeout=args.timeout)
+            for c in changes:
+                output.write(json.dumps({
+                    'domain': c.domain,
+                    'change': c.change,
+                    'old_policy': c.old_policy,
+                    'policy': c.policy,
+                    'record': None if c.record is None else c.record.as_dict(),
+                    'error': None if c.error is None else str(c.error),
+                }) + '\n')
+        output.flush()
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    print('Skipped %(skipped)d domains, revalidated %(revalidated)d '
+          '(%(parsed)d parsed): %(changed)d changed, %(errors)d errors'
+          % counts, file=sys.stderr)
+
+
+def main(args=None):
+    args = parser.parse_args(args)
+    logging.basicConfig(
+        level=(logging.WARNING, logging.INFO, logging.DEBUG)[
+            min(args.verbose, 2)])
+    if args.cache_home:
+        set_cache_home(args.cache_home)
+    if args.nameserver:
+        set_nameservers([parse_nameserver(s) for s in args.nameserver])
+    if args.hedge:
+        set_resolver_pool(ResolverPool(hedge=True))
+    set_policy_discovery(args.discovery, args.parallel_discovery)
+    if args.test_public_suffix:
+        test_public_suffix()
+        return
+    if args.build_index:
+        count = build_txt_index(*args.build_index)
+        print('Indexed %d records' % count, file=sys.stderr)
+        return
+    if args.dataset:
+        set_txt_source(open_txt_dataset(args.dataset))
+    if args.serve:
+        set_public_suffix_background_refresh(True)
+        serve([parse_address(a) for a in args.serve],
+              concurrency=args.concurrency, timeout=args.timeout)
+        return
+    if args.import_snapshot:
+        result = import_cache_snapshot(args.import_snapshot)
+        print('Imported %d DNS cache entries%s' % (
+            result['imported'], ' and the public suffix list'
+            if result['public_suffix_list'] else ''), file=sys.stderr)
+    if args.input is not None or not (args.import_snapshot or
+                                      args.export_snapshot):
+        if args.rescan:
+            returncode = write_changes(args)
+            if returncode:
+                return returncode
+        elif args.reports:
+            returncode = ingest(args)
+            if returncode:
+                return returncode
+        elif args.prewarm:
+            with open_text(args.input or '-') as fp:
+                counts = prewarm_cache(
+                    read_domains(fp), args.concurrency, args.deadline,
+                    timeout=args.timeout)
+            print('Looked up %(domains)d domains: %(records)d records, '
+                  '%(errors)d errors' % counts, file=sys.stderr)
+        else:
+            returncode = lookup(args)
+            if returncode:
+                return returncode
+    if args.export_snapshot:
+        count = export_cache_snapshot(args.export_snapshot)
+        print('Exported %d DNS cache entries' % count, file=sys.stderr)
+
 
-test_public_suffix()
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+import time
+import sqlite3
+import collections
+import concurrent.futures
+
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.metrics import increment
+from dmarc_policy_parser.public_suffix import (
+    get_public_suffix, get_public_suffix_trie,
+)
+from dmarc_policy_parser.dns import get_txt_source
+from dmarc_policy_parser.dmarc import (
+    get_dmarc_record, get_policy_discovery, _get_dmarc_record,
+    _discover_dmarc_record, _effective_policy,
+)
+
+
+_DONE = object()
+
+# What a lookup can raise besides its DmarcException: ValueError from
+# parsing, OSError from the resolver (including timeouts) and the errors
+# of an sqlite3 DNS cache. They are reported for the domain rather than
+# ending the batch.
+_LOOKUP_ERRORS = (DmarcException, ValueError, OSError, sqlite3.Error)
+
+BulkResult = collections.namedtuple('BulkResult', 'domain record policy error')
+
+
+def _result(domain, record=None, error=None):
+    if error is not None:
+        return BulkResult(domain, None, None, error)
+    return BulkResult(domain, record, _effective_policy(domain, record), None)
+
+
+def iter_dmarc_records(domains, concurrency=32, deadline=None, unique=True,
+                       **kwargs):
+    '''
+    Look up the DMARC records of many domains concurrently.
+
+    Yields a BulkResult for each distinct domain in the order the lookups
+    complete. Errors are reported in the error field instead of being raised.
+
+    At most concurrency DNS lookups are in flight at any time. The
+    organizational domain is only looked up for domains that have no record
+    of their own, and domains sharing an organizational domain wait on the
+    same lookup. With another method of set_policy_discovery, each of the
+    concurrency lookups is a complete discovery, which may query several
+    names at once. If deadline (in seconds) passes, the remaining domains are
+    reported with a DmarcException.
+
+    domains may be any iterable and is consumed lazily. If unique is false,
+    duplicate domains are not filtered out and each occurrence is reported,
+    so that memory use does not grow with the number of domains.
+
+    Any other keyword arguments are passed on to get_dns_txt_record.
+
+    If an offline TXT source is set with set_txt_source, there is no I/O to
+    overlap, so the domains are evaluated one by one in the calling thread.
+    '''
+    end_time = None if deadline is None else time.monotonic() + deadline
+    if get_txt_source() is not None:
+        yield from _iter_offline(domains, end_time, unique, **kwargs)
+        return
+    seen = set()
+    domain_iter = iter(domains)
+    pending = {}
+    org_waiters = {}
+    default_discovery = get_policy_discovery() == ('rfc7489', False)
+    lookup = _get_dmarc_record if default_discovery else _discover_dmarc_record
+
+    executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+    try:
+        while True:
+            while len(pending) < concurrency:
+                domain = next(domain_iter, _DONE)
+                if domain is _DONE:
+                    break
+                if unique:
+                    if domain in seen:
+                        continue
+                    seen.add(domain)
+                f = executor.submit(lookup, domain, **kwargs)
+                pending[f] = (domain, False)
+            if not pending:
+                break
+            if end_time is None:
+                timeout = None
+            else:
+                timeout = max(end_time - time.monotonic(), 0)
+            done, _ = concurrent.futures.wait(
+                pending, timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            if not done:
+                break
+            for f in done:
+                name, is_org = pending.pop(f)
+                try:
+                    record = f.result()
+                except _LOOKUP_ERRORS as exn:
+                    record, error = None, exn
+                else:
+                    error = None
+                if is_org:
+                    for domain in org_waiters.pop(name):
+                        yield _result(domain, record, error)
+                    continue
+                if record or error or not default_discovery:
+                    yield _result(name, record, error)
+                    continue
+                try:
+                    org_domain = get_public_suffix(name)
+                except _LOOKUP_ERRORS as exn:
+                    yield _result(name, error=exn)
+                    continue
+                if org_domain is None or org_domain == name:
+                    yield _result(name)
+                    continue
+                increment('org_domain_fallbacks')
+                if org_domain in org_waiters:
+                    org_waiters[org_domain].append(name)
+                else:
+                    org_waiters[org_domain] = [name]
+                    f = executor.submit(_get_dmarc_record, org_domain,
+                                        **kwargs)
+                    pending[f] = (org_domain, True)
+
+        # Deadline exceeded: report everything that did not finish.
+        for f, (name, is_org) in pending.items():
+            f.cancel()
+            for domain in org_waiters.pop(name) if is_org else (name,):
+                yield _result(domain, error=DmarcException(
+                    'Deadline exceeded while looking up %r' % (domain,)))
+        for domain in domain_iter:
+            if unique:
+                if domain in seen:
+                    continue
+                seen.add(domain)
+            yield _result(domain, error=DmarcException(
+                'Deadline exceeded before looking up %r' % (domain,)))
+    finally:
+        executor.shutdown(wait=False)
+
+
+def _iter_offline(domains, end_time, unique, **kwargs):
+    seen = set()
+    for domain in domains:
+        if unique:
+            if domain in seen:
+                continue
+            seen.add(domain)
+        if end_time is not None and time.monotonic() > end_time:
+            yield _result(domain, error=DmarcException(
+                'Deadline exceeded before looking up %r' % (domain,)))
+            continue
+        try:
+            record = get_dmarc_record(domain, **kwargs)
+        except _LOOKUP_ERRORS as exn:
+            yield _result(domain, error=exn)
+        else:
+            yield _result(domain, record)
+
+
+def get_dmarc_policies(domains, concurrency=32, deadline=None, **kwargs):
+    '''
+    Returns a dict mapping each distinct domain to a BulkResult.
+
+    See iter_dmarc_records for the meaning of the arguments.
+    '''
+    return {
+        r.domain: r
+        for r in iter_dmarc_records(domains, concurrency, deadline, **kwargs)
+    }
+
+
+def prewarm_cache(domains, concurrency=32, deadline=None, **kwargs):
+    '''
+    Look up the DMARC records of domains concurrently to fill the DNS cache
+    and the public suffix list, e.g. before export_cache_snapshot or before
+    a host starts serving. Returns a dict counting the domains looked up,
+    the "records" found and the "errors".
+
+    See iter_dmarc_records for the meaning of the arguments.
+    '''
+    get_public_suffix_trie()
+    counts = {'domains': 0, 'records': 0, 'errors': 0}
+    for r in iter_dmarc_records(domains, concurrency, deadline, **kwargs):
+        counts['domains'] += 1
+        if r.error is not None:
+            counts['errors'] += 1
+        elif r.record is not None:
+            counts['records'] += 1
+    return counts
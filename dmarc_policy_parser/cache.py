@@ -0,0 +1,326 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+import collections
+
+from dmarc_policy_parser.files import file_lock, open_temporary
+
+
+logger = logging.getLogger('dmarc_policy_parser')
+
+
+class JsonFileCache:
+    '''
+    The original DNS cache format: a JSON object mapping each domain to
+    [result, time, ttl], rewritten in its entirety on every update.
+    Entries written by older versions lack the ttl.
+
+    Writers lock the file and merge in entries written by other processes
+    since it was last read, keeping the newest entry for each domain.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._data = self._read()
+
+    def _read(self):
+        try:
+            with open(self.filename) as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return {}
+
+    def get(self, domain):
+        return self._data.get(domain)
+
+    def set(self, domain, result, cached_time, ttl=None):
+        with self._lock, file_lock(self.filename):
+            data = self._read()
+            for d, entry in self._data.items():
+                if d not in data or data[d][1] < entry[1]:
+                    data[d] = entry
+            data[domain] = [result, cached_time, ttl]
+            fp, tmp_filename = open_temporary(self.filename)
+            try:
+                with fp:
+                    json.dump(data, fp, indent=0)
+                os.replace(tmp_filename, self.filename)
+            except BaseException:
+                os.unlink(tmp_filename)
+                raise
+            self._data = data
+
+    def items(self):
+        '''
+        Yields (domain, result, time, ttl) for each entry.
+        '''
+        for domain, entry in self._read().items():
+            yield (domain, entry[0], entry[1],
+                   entry[2] if len(entry) > 2 else None)
+
+    def merge(self, entries):
+        '''
+        Store (domain, result, time, ttl) entries, except where the cache
+        already has a newer entry for the domain. Returns the number of
+        entries stored.
+        '''
+        stored = 0
+        with self._lock, file_lock(self.filename):
+            data = self._read()
+            for domain, result, cached_time, ttl in entries:
+                if domain not in data or data[domain][1] < cached_time:
+                    data[domain] = [result, cached_time, ttl]
+                    stored += 1
+            fp, tmp_filename = open_temporary(self.filename)
+            try:
+                with fp:
+                    json.dump(data, fp, indent=0)
+                os.replace(tmp_filename, self.filename)
+            except BaseException:
+                os.unlink(tmp_filename)
+                raise
+            self._data = data
+        return stored
+
+    def close(self):
+        pass
+
+
+class SqliteCache:
+    '''
+    DNS cache stored in an indexed sqlite3 table.
+
+    Lookups only read the requested row and each update is a single
+    transaction, so neither depends on the size of the cache. The database
+    is opened in WAL mode so an interrupted process cannot corrupt it, and
+    readers do not block the writer. Each thread and each forked process
+    uses its own connection.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = threading.local()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS txt_records ('
+                'domain TEXT PRIMARY KEY, result TEXT, time REAL, ttl REAL)')
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(txt_records)')]
+            if 'ttl' not in columns:
+                conn.execute('ALTER TABLE txt_records ADD COLUMN ttl REAL')
+
+    def _connection(self):
+        try:
+            pid, conn = self._local.conn
+        except AttributeError:
+            pass
+        else:
+            if pid == os.getpid():
+                return conn
+            # Inherited from the parent process: sqlite3 connections must
+            # not be used across fork, so leave it alone and reconnect.
+        conn = sqlite3.connect(self.filename, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._local.conn = os.getpid(), conn
+        return conn
+
+    def get(self, domain):
+        row = self._connection().execute(
+            'SELECT result, time, ttl FROM txt_records WHERE domain = ?',
+            (domain,)).fetchone()
+        if row is None:
+            return None
+        return [json.loads(row[0]), row[1], row[2]]
+
+    def set(self, domain, result, cached_time, ttl=None):
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO txt_records VALUES (?, ?, ?, ?)',
+                (domain, json.dumps(result), cached_time, ttl))
+
+    def update(self, entries):
+        '''
+        Store many (domain, result, time, ttl) entries in one transaction.
+        '''
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO txt_records VALUES (?, ?, ?, ?)',
+                ((d, json.dumps(r), t, ttl) for d, r, t, ttl in entries))
+
+    def items(self):
+        '''
+        Yields (domain, result, time, ttl) for each entry.
+        '''
+        rows = self._connection().execute(
+            'SELECT domain, result, time, ttl FROM txt_records')
+        for domain, result, cached_time, ttl in rows:
+            yield domain, json.loads(result), cached_time, ttl
+
+    def merge(self, entries):
+        '''
+        Store (domain, result, time, ttl) entries in one transaction, except
+        where the cache already has a newer entry for the domain. Returns
+        the number of entries stored.
+        '''
+        conn = self._connection()
+        with conn:
+            before = conn.total_changes
+            conn.executemany(
+                'INSERT OR REPLACE INTO txt_records '
+                'SELECT ?1, ?2, ?3, ?4 WHERE NOT EXISTS ('
+                'SELECT 1 FROM txt_records WHERE domain = ?1 AND time >= ?3)',
+                ((d, json.dumps(r), t, ttl) for d, r, t, ttl in entries))
+            return conn.total_changes - before
+
+    def close(self):
+        try:
+            pid, conn = self._local.conn
+        except AttributeError:
+            return
+        del self._local.conn
+        if pid == os.getpid():
+            conn.close()
+
+
+def open_default_cache(cache_dir):
+    '''
+    Open the sqlite3 cache in cache_dir, importing the entries of an old
+    dns_txt_cache.json the first time the database is created.
+    '''
+    filename = os.path.join(cache_dir, 'dns_txt_cache.sqlite3')
+    json_filename = os.path.join(cache_dir, 'dns_txt_cache.json')
+    is_new = not os.path.exists(filename)
+    cache = SqliteCache(filename)
+    if is_new and os.path.exists(json_filename):
+        logger.info('Importing %s', json_filename)
+        try:
+            with open(json_filename) as fp:
+                data = json.load(fp)
+        except ValueError:
+            logger.warning('Could not import %s', json_filename)
+        else:
+            cache.update((d, e[0], e[1], None) for d, e in data.items())
+    return cache
+
+
+class MemoryCache:
+    '''
+    Bounded in-memory LRU cache in front of the persistent DNS cache.
+
+    At most max_entries domains are kept. Positive answers expire after the
+    TTL of the DNS records, while "no such domain" and "no TXT records"
+    answers use the SOA-derived TTL capped at negative_ttl. Failed lookups
+    are remembered for error_ttl seconds so that a broken domain is not
+    retried on every call. TTLs below min_ttl are raised to min_ttl.
+
+    If stale_ttl is set, answers remain usable for that many seconds after
+    they expire, while get_dns_txt_record refreshes them in the background.
+    '''
+
+    def __init__(self, max_entries=100000, negative_ttl=3600, error_ttl=30,
+                 min_ttl=0, stale_ttl=0):
+        self.max_entries = max_entries
+        self.negative_ttl = negative_ttl
+        self.error_ttl = error_ttl
+        self.min_ttl = min_ttl
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._counters = collections.Counter()
+
+    def get_ttl(self, result, ttl, max_age):
+        '''
+        Returns how long an answer with the given DNS TTL may be cached.
+        '''
+        if not result:
+            ttl = self.negative_ttl if ttl is None else min(
+                ttl, self.negative_ttl)
+        elif ttl is None:
+            ttl = max_age
+        return min(max(ttl, self.min_ttl), max_age)
+
+    def is_usable(self, cached_time, ttl, now, max_age):
+        '''
+        Returns (usable, stale) for an answer cached at cached_time.
+        '''
+        expires = min(cached_time + ttl, cached_time + max_age)
+        if now < expires:
+            return True, False
+        return now < expires + self.stale_ttl, True
+
+    def get(self, domain, now, max_age):
+        '''
+        Returns (result, error, stale) or None if domain is not cached or the
+        entry is older than max_age or its TTL (plus stale_ttl).
+        '''
+        with self._lock:
+            try:
+                cached_time, ttl, result, error = self._entries[domain]
+            except KeyError:
+                self._counters['misses'] += 1
+                return None
+            usable, stale = self.is_usable(cached_time, ttl, now, max_age)
+            if not usable or (stale and error is not None):
+                del self._entries[domain]
+                self._counters['expirations'] += 1
+                self._counters['misses'] += 1
+                return None
+            self._entries.move_to_end(domain)
+            if stale:
+                self._counters['stale_hits'] += 1
+            elif error is not None:
+                self._counters['error_hits'] += 1
+            elif not result:
+                self._counters['negative_hits'] += 1
+            else:
+                self._counters['hits'] += 1
+            return result, error, stale
+
+    def _set(self, domain, entry):
+        with self._lock:
+            self._entries[domain] = entry
+            self._entries.move_to_end(domain)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self._counters['evictions'] += 1
+
+    def set(self, domain, result, cached_time, ttl):
+        self._set(domain, (cached_time, ttl, result, None))
+
+    def set_error(self, domain, error, now):
+        self._set(domain, (now, self.error_ttl, None, error))
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def discard(self, domain):
+        with self._lock:
+            self._entries.pop(domain, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        '''
+        Returns a dict of counters: hits, negative_hits, error_hits,
+        stale_hits, misses, expirations, evictions and the current number of
+        entries.
+        '''
+        with self._lock:
+            result = dict.fromkeys(
+                ('hits', 'negative_hits', 'error_hits', 'stale_hits',
+                 'misses', 'expirations', 'evictions'), 0)
+            result.update(self._counters)
+            result['entries'] = len(self._entries)
+        return result
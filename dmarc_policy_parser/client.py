@@ -0,0 +1,115 @@
+'''
+Client for the JSON protocol of server.PolicyServer.
+'''
+
+import json
+import socket
+import threading
+
+from dmarc_policy_parser.dmarc import DmarcRecord
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.server import parse_address
+
+
+class PolicyClient:
+    '''
+    Looks up DMARC policies through a PolicyServer listening on address,
+    which is a string as accepted by server.parse_address or the value it
+    returns.
+
+    The connection is opened on first use and reopened if the server has
+    closed it, e.g. after a restart. A client may be shared between
+    threads, but requests are then sent one at a time.
+    '''
+
+    def __init__(self, address, timeout=10):
+        if isinstance(address, str):
+            address = parse_address(address)
+        self.address = address
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._file = None
+
+    def _connect(self):
+        if isinstance(self.address, str):
+            sock = socket.socket(socket.AF_UNIX)
+            sock.settimeout(self.timeout)
+            try:
+                sock.connect(self.address)
+            except BaseException:
+                sock.close()
+                raise
+        else:
+            sock = socket.create_connection(self.address, self.timeout)
+        self._sock = sock
+        self._file = sock.makefile('rwb')
+
+    def _request(self, request):
+        data = (json.dumps(request) + '\n').encode('utf8')
+        with self._lock:
+            for retry in (True, False):
+                reused = self._sock is not None
+                try:
+                    if not reused:
+                        self._connect()
+                    self._file.write(data)
+                    self._file.flush()
+                    line = self._file.readline()
+                except socket.timeout:
+                    self.close()
+                    raise DmarcException(
+                        'Timed out waiting for %s' % (self.address,))
+                except OSError as exn:
+                    self.close()
+                    if retry and reused:
+                        continue
+                    raise DmarcException(
+                        'Connection to %s failed: %s' % (self.address, exn))
+                if line:
+                    break
+                self.close()
+                if not (retry and reused):
+                    raise DmarcException(
+                        '%s closed the connection' % (self.address,))
+        response = json.loads(line.decode('utf8'))
+        if 'error' in response:
+            raise DmarcException(response['error'])
+        return response['result']
+
+    def get_dmarc_policy(self, domain):
+        '''
+        Like dmarc.get_dmarc_policy.
+        '''
+        return self._request({'method': 'get_dmarc_policy',
+                              'domain': domain})
+
+    def get_dmarc_record(self, domain):
+        '''
+        Like dmarc.get_dmarc_record.
+        '''
+        result = self._request({'method': 'get_dmarc_record',
+                                'domain': domain})
+        return None if result is None else DmarcRecord.from_dict(result)
+
+    def stats(self):
+        '''
+        Returns the DNS and parsed record cache statistics of the server.
+        '''
+        return self._request({'method': 'stats'})
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._file.close()
+            except OSError:
+                # Could not flush a request to a lost connection.
+                pass
+            self._sock.close()
+            self._sock = self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
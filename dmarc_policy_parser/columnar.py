@@ -0,0 +1,474 @@
+'''
+A compact, column-oriented container for the results of large scans.
+
+Keeping a dict or DmarcRecord for each of millions of domains costs
+hundreds of bytes per domain. ResultTable instead stores each tag in its
+own array: the enumerated tags as one byte per domain, and the other
+values as indexes into a pool of distinct strings, which is small since
+most domains share the same few pct, ri, fo and rf values. The rua and
+ruf lists are pooled whole rather than by URI: domains that report to the
+same address almost always publish the same list, and one index per
+domain keeps the columns fixed-width. Domain names are stored back to
+back in a single buffer.
+
+A table can be saved to a file and loaded again with memory mapping, so
+that opening a scan is instant and its pages are shared between the
+processes that read it.
+'''
+
+import os
+import sys
+import json
+import mmap
+import array
+import bisect
+import itertools
+import collections
+
+from dmarc_policy_parser.bulk import BulkResult
+from dmarc_policy_parser.dmarc import DmarcRecord
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.files import open_temporary
+
+
+FILE_MAGIC = b'DMARCTAB'
+# Bump when the file format changes incompatibly.
+FILE_VERSION = 1
+
+STATUSES = ('no_record', 'record', 'error')
+POLICIES = (None, 'none', 'quarantine', 'reject')
+ALIGNMENTS = (None, 'r', 's')
+VERSIONS = (None, 'DMARC1')
+
+# Column name -> (array typecode, values of an enumerated column, or None
+# for a column of string pool indexes where -1 means None).
+COLUMNS = collections.OrderedDict((
+    ('status', ('B', STATUSES)),
+    ('policy', ('B', POLICIES)),
+    ('version', ('B', VERSIONS)),
+    ('p', ('B', POLICIES)),
+    ('sp', ('B', POLICIES)),
+    ('adkim', ('B', ALIGNMENTS)),
+    ('aspf', ('B', ALIGNMENTS)),
+    ('pct', ('i', None)),
+    ('ri', ('i', None)),
+    ('fo', ('i', None)),
+    ('rf', ('i', None)),
+    ('rua', ('i', None)),
+    ('ruf', ('i', None)),
+    ('record_domain', ('i', None)),
+    ('error', ('i', None)),
+))
+
+# Index of the record_domain column for records found at the domain itself,
+# which where and count_by represent as '.'.
+_SAME_DOMAIN = -2
+
+
+def _encode_uris(uris):
+    return json.dumps(uris)
+
+
+def _decode_uris(s):
+    return tuple(tuple(uri) for uri in json.loads(s))
+
+
+# How the values of the pool columns are stored as strings.
+_POOL_CODECS = {
+    'pct': (str, int),
+    'ri': (str, int),
+    'fo': (':'.join, lambda s: tuple(s.split(':'))),
+    'rf': (':'.join, lambda s: tuple(s.split(':'))),
+    'rua': (_encode_uris, _decode_uris),
+    'ruf': (_encode_uris, _decode_uris),
+    'record_domain': (str, str),
+    'error': (str, str),
+}
+
+# DmarcRecord attribute of each column.
+_ATTRIBUTES = {
+    'p': 'request', 'sp': 'srequest', 'adkim': 'adkim', 'aspf': 'aspf',
+    'pct': 'percent', 'ri': 'ainterval', 'version': 'version', 'fo': 'fo',
+    'rf': 'rfmt', 'rua': 'auri', 'ruf': 'furi',
+}
+
+
+class ResultTable:
+    '''
+    Results of a scan, as yielded by bulk.iter_dmarc_records, stored by
+    column. Rows are numbered in the order they were appended, and
+    table[i] returns row i as a BulkResult. Errors are kept as their
+    message and returned as DmarcException.
+
+    The columns are named after the tags (p, sp, rua, ...) plus status
+    ('no_record', 'record' or 'error'), policy (the effective policy of the
+    domain), record_domain and error. where and count_by select rows by
+    column values without creating a BulkResult for each row; there,
+    record_domain is '.' for records found at the domain itself.
+    '''
+
+    def __init__(self):
+        self._columns = {name: array.array(typecode)
+                         for name, (typecode, _) in COLUMNS.items()}
+        self._domain_data = bytearray()
+        self._domain_offsets = array.array('q', [0])
+        self._order = None
+        self._pool = []
+        self._pool_ids = {}
+        self._mmap = None
+        self._views = []
+
+    def __len__(self):
+        return len(self._domain_offsets) - 1
+
+    def _intern(self, s):
+        try:
+            return self._pool_ids[s]
+        except KeyError:
+            i = self._pool_ids[s] = len(self._pool)
+            self._pool.append(s)
+            return i
+
+    def append(self, result):
+        '''
+        Add a BulkResult, or any (domain, record, policy, error) tuple.
+        '''
+        if self._mmap is not None:
+            raise DmarcException('A loaded ResultTable is read-only')
+        domain, record, policy, error = result
+        columns = self._columns
+        if error is not None:
+            status = 2
+        elif record is None:
+            status = 0
+        else:
+            status = 1
+        columns['status'].append(status)
+        columns['policy'].append(POLICIES.index(policy))
+        for name, (typecode, values) in COLUMNS.items():
+            if name in ('status', 'policy', 'record_domain', 'error'):
+                continue
+            value = None if record is None else getattr(
+                record, _ATTRIBUTES[name])
+            if values is None:
+                columns[name].append(-1 if value is None else self._intern(
+                    _POOL_CODECS[name][0](value)))
+            else:
+                columns[name].append(values.index(value))
+        record_domain = None if record is None else record.domain
+        if record_domain is None:
+            columns['record_domain'].append(-1)
+        elif record_domain == domain:
+            columns['record_domain'].append(_SAME_DOMAIN)
+        else:
+            columns['record_domain'].append(self._intern(record_domain))
+        columns['error'].append(
+            -1 if error is None else self._intern(str(error)))
+        self._domain_data += domain.encode('utf8')
+        self._domain_offsets.append(len(self._domain_data))
+        self._order = None
+
+    def extend(self, results):
+        for result in results:
+            self.append(result)
+
+    @classmethod
+    def from_results(cls, results):
+        '''
+        Returns a new table of results, e.g. from iter_dmarc_records.
+        '''
+        table = cls()
+        table.extend(results)
+        return table
+
+    def domain(self, i):
+        offsets = self._domain_offsets
+        return bytes(self._domain_data[offsets[i]:offsets[i + 1]]).decode(
+            'utf8')
+
+    def value(self, column, i):
+        '''
+        Returns the value of column in row i, e.g. value('p', 0).
+        '''
+        code = self._columns[column][i]
+        if code == _SAME_DOMAIN and column == 'record_domain':
+            return self.domain(i)
+        return self._decode(column, code)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('row index out of range')
+        domain = self.domain(i)
+        status = STATUSES[self._columns['status'][i]]
+        if status == 'error':
+            return BulkResult(domain, None, None,
+                              DmarcException(self.value('error', i)))
+        if status == 'no_record':
+            return BulkResult(domain, None, None, None)
+        kwargs = {attribute: self.value(name, i)
+                  for name, attribute in _ATTRIBUTES.items()}
+        record = DmarcRecord(domain=self.value('record_domain', i), **kwargs)
+        return BulkResult(domain, record, self.value('policy', i), None)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def _get_order(self):
+        # Row numbers sorted by domain.
+        if self._order is None:
+            self._order = array.array(
+                'i', sorted(range(len(self)), key=self.domain))
+        return self._order
+
+    def find(self, domain):
+        '''
+        Returns the first row of domain, or None.
+        '''
+        order = self._get_order()
+        keys = _SortedDomains(self, order)
+        k = bisect.bisect_left(keys, domain)
+        if k < len(order) and keys[k] == domain:
+            return order[k]
+        return None
+
+    def get(self, domain):
+        '''
+        Returns the BulkResult of domain, or None.
+        '''
+        i = self.find(domain)
+        return None if i is None else self[i]
+
+    def _codes(self, column, value):
+        # The codes in column that match value, which may be a set of
+        # alternatives.
+        if isinstance(value, (set, frozenset)):
+            alternatives = value
+        else:
+            alternatives = (value,)
+        typecode, values = COLUMNS[column]
+        codes = set()
+        for v in alternatives:
+            if v is None:
+                codes.add(-1 if values is None else values.index(None))
+            elif column == 'record_domain' and v == '.':
+                codes.add(_SAME_DOMAIN)
+            elif values is None:
+                s = _POOL_CODECS[column][0](v)
+                if self._pool_ids is None:
+                    self._pool_ids = {s: i for i, s in enumerate(self._pool)}
+                if s in self._pool_ids:
+                    codes.add(self._pool_ids[s])
+            elif v in values:
+                codes.add(values.index(v))
+            else:
+                raise ValueError('invalid %s %r' % (column, v))
+        return codes
+
+    def _mask(self, criteria):
+        # Returns bytes with a 1 for each row that matches all criteria.
+        n = len(self)
+        mask = None
+        for column, value in criteria.items():
+            if column not in COLUMNS:
+                raise ValueError('unknown column %r' % (column,))
+            codes = self._codes(column, value)
+            data = self._columns[column]
+            if COLUMNS[column][0] == 'B':
+                table = bytearray(256)
+                for code in codes:
+                    table[code] = 1
+                m = bytes(data).translate(table)
+            else:
+                m = bytes(map(codes.__contains__, data))
+            if mask is None:
+                mask = m
+            else:
+                mask = (int.from_bytes(mask, 'little') &
+                        int.from_bytes(m, 'little')).to_bytes(n, 'little')
+        if mask is None:
+            mask = b'\x01' * n
+        return mask
+
+    def where(self, **criteria):
+        '''
+        Returns an array of the rows where each column given as a keyword
+        has the given value, or one of a set of values. For example,
+        where(p='none', rua=None) selects the domains with p=none and no
+        rua, and where(status='error') the failed lookups.
+        '''
+        mask = self._mask(criteria)
+        return array.array('i', itertools.compress(range(len(self)), mask))
+
+    def count(self, **criteria):
+        '''
+        Returns the number of rows matching criteria as in where.
+        '''
+        return self._mask(criteria).count(1)
+
+    def count_by(self, *columns, **criteria):
+        '''
+        Returns a Counter mapping each combination of values of columns to
+        its number of rows, counting only the rows matching criteria as in
+        where. For example, count_by('p', 'pct') or count_by('rua', p='none').
+        A single column is counted by its values rather than 1-tuples.
+        '''
+        if not columns:
+            raise ValueError('count_by needs at least one column; use count '
+                             'for the number of rows')
+        for column in columns:
+            if column not in COLUMNS:
+                raise ValueError('unknown column %r' % (column,))
+        data = [self._columns[c] for c in columns]
+        rows = zip(*data) if len(data) > 1 else data[0]
+        if criteria:
+            rows = itertools.compress(rows, self._mask(criteria))
+        counts = collections.Counter(rows)
+        result = collections.Counter()
+        for key, n in counts.items():
+            codes = key if len(data) > 1 else (key,)
+            values = tuple(self._decode(c, code)
+                           for c, code in zip(columns, codes))
+            result[values if len(data) > 1 else values[0]] += n
+        return result
+
+    def _decode(self, column, code):
+        typecode, values = COLUMNS[column]
+        if values is None:
+            if code == -1:
+                return None
+            if code == _SAME_DOMAIN:
+                return '.'
+            return _POOL_CODECS[column][1](self._pool[code])
+        return values[code]
+
+    def save(self, filename):
+        '''
+        Write the table to filename in a format that load maps into memory.
+        '''
+        order = self._get_order()
+        pool_data = bytearray()
+        pool_offsets = array.array('q', [0])
+        for s in self._pool:
+            pool_data += s.encode('utf8')
+            pool_offsets.append(len(pool_data))
+        sections = [(name, self._columns[name]) for name in COLUMNS]
+        sections += [
+            ('domain_offsets', self._domain_offsets),
+            ('domain_data', self._domain_data),
+            ('domain_order', order),
+            ('pool_offsets', pool_offsets),
+            ('pool_data', pool_data),
+        ]
+        header = {
+            'version': FILE_VERSION,
+            'byteorder': sys.byteorder,
+            'rows': len(self),
+            'sections': {},
+        }
+        offset = 0
+        for name, data in sections:
+            size = len(memoryview(data).cast('B'))
+            header['sections'][name] = [
+                getattr(data, 'typecode', 'B'), offset, size]
+            offset += _padded(size)
+        header_data = json.dumps(header).encode('utf8')
+        start = _padded(len(FILE_MAGIC) + 8 + len(header_data))
+        fp, tmp_filename = open_temporary(filename, 'wb')
+        try:
+            with fp:
+                fp.write(FILE_MAGIC)
+                fp.write(len(header_data).to_bytes(8, 'little'))
+                fp.write(header_data)
+                fp.write(bytes(start - fp.tell()))
+                for name, data in sections:
+                    data = memoryview(data).cast('B')
+                    fp.write(data)
+                    fp.write(bytes(_padded(len(data)) - len(data)))
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+
+    @classmethod
+    def load(cls, filename):
+        '''
+        Returns the table saved in filename, mapped into memory. The table
+        is read-only; close it to unmap the file.
+        '''
+        with open(filename, 'rb') as fp:
+            magic = fp.read(len(FILE_MAGIC))
+            if magic != FILE_MAGIC:
+                raise DmarcException('%s is not a result table' % (filename,))
+            header_size = int.from_bytes(fp.read(8), 'little')
+            header = json.loads(fp.read(header_size).decode('utf8'))
+            if header.get('version') != FILE_VERSION:
+                raise DmarcException(
+                    'Unsupported result table version %r in %s' %
+                    (header.get('version'), filename))
+            if header['byteorder'] != sys.byteorder:
+                raise DmarcException('%s was written on a %s-endian machine'
+                                     % (filename, header['byteorder']))
+            start = _padded(len(FILE_MAGIC) + 8 + header_size)
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        table = cls.__new__(cls)
+        table._mmap = mm
+        table._views = []
+        view = memoryview(mm)
+        table._views.append(view)
+        sections = {}
+        for name, (typecode, offset, size) in header['sections'].items():
+            section = view[start + offset:start + offset + size]
+            table._views.append(section)
+            if typecode != 'B':
+                section = section.cast(typecode)
+                table._views.append(section)
+            sections[name] = section
+        table._columns = {name: sections[name] for name in COLUMNS}
+        table._domain_offsets = sections['domain_offsets']
+        table._domain_data = sections['domain_data']
+        table._order = sections['domain_order']
+        pool_offsets = sections['pool_offsets']
+        pool_data = sections['pool_data']
+        table._pool = [
+            bytes(pool_data[pool_offsets[i]:pool_offsets[i + 1]]).decode(
+                'utf8') for i in range(len(pool_offsets) - 1)]
+        table._pool_ids = None
+        return table
+
+    def close(self):
+        '''
+        Unmap the file of a loaded table.
+        '''
+        if self._mmap is None:
+            return
+        for view in reversed(self._views):
+            view.release()
+        self._views = []
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class _SortedDomains:
+    # The domains of a table in sorted order, for bisect.
+
+    def __init__(self, table, order):
+        self.table = table
+        self.order = order
+
+    def __len__(self):
+        return len(self.order)
+
+    def __getitem__(self, k):
+        return self.table.domain(self.order[k])
+
+
+def _padded(size):
+    return (size + 7) & ~7
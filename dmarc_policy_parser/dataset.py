@@ -0,0 +1,395 @@
+'''
+Offline sources of TXT records, for evaluating DMARC policies against a
+pre-fetched dataset instead of DNS. See dns.set_txt_source.
+
+Datasets are read from zone files (as produced by a zone walk or AXFR) or
+from JSON Lines exports with one record per line, such as
+{"name": "_dmarc.example.com", "type": "TXT", "value": "v=DMARC1; p=none"}.
+Either can be loaded into memory with open_txt_dataset, or compiled once
+with build_txt_index into an index file that TxtIndex memory-maps,
+so that datasets larger than memory can be used and opening them is
+instant.
+'''
+
+import re
+import os
+import sys
+import json
+import mmap
+import array
+import struct
+import zlib
+import logging
+import contextlib
+
+from dmarc_policy_parser import dnswire
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.files import open_temporary, open_text
+
+
+logger = logging.getLogger('dmarc_policy_parser')
+
+DATASET_FORMATS = ('zone', 'jsonl')
+
+_JSON_EXTENSIONS = ('.jsonl', '.json', '.ndjson')
+_JSON_NAME_KEYS = ('name', 'domain')
+_JSON_VALUE_KEYS = ('records', 'value', 'data', 'txt', 'record')
+_ZONE_CLASSES = ('IN', 'CH', 'HS', 'CS')
+
+_INDEX_MAGIC = b'DMARCTXT'
+_INDEX_VERSION = 1
+_INDEX_HEADER = struct.Struct('<8sIQQ')
+_INDEX_SLOT = struct.Struct('<QQ')
+
+
+def normalize_name(name):
+    '''
+    Returns name in lowercase without the trailing dot, with non-ASCII
+    labels converted with IDNA.
+    '''
+    name = name.lower().rstrip('.')
+    try:
+        name.encode('ascii')
+    except UnicodeEncodeError:
+        name = dnswire.normalize_name(name)
+    return name
+
+
+def _guess_format(filename):
+    base = filename[:-3] if filename.endswith('.gz') else filename
+    if base.endswith(_JSON_EXTENSIONS):
+        return 'jsonl'
+    return 'zone'
+
+
+_ZONE_TOKEN = re.compile(r'''
+    "(?P<quoted>(?:[^"\\]|\\.)*)"
+    | (?P<paren>[()])
+    | (?P<comment>;.*)
+    | (?P<word>(?:[^\s"();\\]|\\.)+)
+''', re.VERBOSE)
+
+_ESCAPE = re.compile(rb'\\(\d{3}|.)', re.DOTALL)
+
+
+def _unescape(s):
+    # Character-strings may contain \X and \DDD escapes (RFC 1035 5.1).
+    def repl(mo):
+        g = mo.group(1)
+        return bytes((int(g),)) if g.isdigit() else g
+
+    return _ESCAPE.sub(repl, s.encode('utf8', 'surrogateescape'))
+
+
+def _join_strings(strings):
+    return b''.join(strings).decode('utf8', 'replace')
+
+
+def _tokenize(line):
+    tokens = []
+    for mo in _ZONE_TOKEN.finditer(line):
+        kind = mo.lastgroup
+        if kind == 'comment':
+            break
+        if kind == 'quoted':
+            tokens.append((True, mo.group('quoted')))
+        else:
+            tokens.append((False, mo.group(kind)))
+    return tokens
+
+
+def _absolute_name(name, origin):
+    if name == '@':
+        return origin
+    if name.endswith('.'):
+        return name
+    return '%s.%s' % (name, origin) if origin else name
+
+
+def read_zone_file(fp, origin=''):
+    '''
+    Yields (name, record) for each TXT record in a zone file, joining
+    records split into several character-strings. Records of other types
+    are skipped. Handles $ORIGIN, relative and omitted owner names and
+    records spanning several lines in parentheses.
+    '''
+    owner = None
+    pending = None
+    for line in fp:
+        tokens = _tokenize(line)
+        if pending is not None:
+            # Continuation of a record in parentheses.
+            pending_tokens, starts_with_space = pending
+            tokens = pending_tokens + tokens
+        else:
+            starts_with_space = line[:1].isspace()
+        depth = 0
+        for quoted, t in tokens:
+            if not quoted and t in '()':
+                depth += 1 if t == '(' else -1
+        if depth > 0:
+            pending = tokens, starts_with_space
+            continue
+        pending = None
+        tokens = [(q, t) for q, t in tokens if q or t not in '()']
+        if not tokens:
+            continue
+        quoted, first = tokens[0]
+        if not quoted and first.upper() == '$ORIGIN':
+            if len(tokens) > 1:
+                origin = _absolute_name(tokens[1][1], origin)
+            continue
+        if not quoted and first.startswith('$'):
+            # $TTL; $INCLUDE and $GENERATE are not supported.
+            continue
+        if not starts_with_space:
+            owner = _absolute_name(first, origin)
+            tokens = tokens[1:]
+        i = 0
+        while i < len(tokens) and i < 2 and not tokens[i][0] and (
+                tokens[i][1][:1].isdigit() or
+                tokens[i][1].upper() in _ZONE_CLASSES):
+            i += 1
+        if i >= len(tokens) or tokens[i][1].upper() != 'TXT':
+            continue
+        if owner is None:
+            raise DmarcException('Record without owner name: %r' % (line,))
+        yield owner, _join_strings(_unescape(t) for q, t in tokens[i + 1:])
+
+
+def _parse_character_strings(value):
+    tokens = _tokenize(value)
+    if tokens and all(quoted for quoted, t in tokens):
+        return _join_strings(_unescape(t) for quoted, t in tokens)
+    return value
+
+
+def read_jsonl(fp):
+    '''
+    Yields (name, record) for each TXT record in a JSON Lines file.
+
+    Each line is an object with the owner name in "name" or "domain" and
+    the record in "records", "value", "data", "txt" or "record", either as
+    a string or a list of strings. Lines with a "type" other than TXT are
+    skipped. Values in zone file presentation format, with each
+    character-string in double quotes, are unquoted.
+    '''
+    for lineno, line in enumerate(fp, 1):
+        if not line.strip():
+            continue
+        try:
+            obj = json.loads(line)
+        except ValueError as exn:
+            raise DmarcException('Line %d: %s' % (lineno, exn))
+        rtype = obj.get('type')
+        if rtype is not None and str(rtype).upper() not in ('TXT', '16'):
+            continue
+        name = next((obj[k] for k in _JSON_NAME_KEYS if k in obj), None)
+        value = next((obj[k] for k in _JSON_VALUE_KEYS if k in obj), None)
+        if name is None or value is None:
+            raise DmarcException('Line %d: missing name or value' % lineno)
+        for v in value if isinstance(value, list) else (value,):
+            yield name, _parse_character_strings(v)
+
+
+def read_txt_dataset(filename, format=None):
+    '''
+    Yields (name, record) for each TXT record in filename, which is
+    in the given format (one of DATASET_FORMATS) or else guessed from the
+    file extension. The file may be gzip-compressed.
+    '''
+    if format is None:
+        format = _guess_format(filename)
+    if format not in DATASET_FORMATS:
+        raise ValueError('unknown dataset format %r' % (format,))
+    with open_text(filename) as fp:
+        if format == 'jsonl':
+            yield from read_jsonl(fp)
+        else:
+            yield from read_zone_file(fp)
+
+
+class TxtDataset:
+    '''
+    TXT records held in memory, keyed by normalized name.
+    '''
+
+    def __init__(self, records=()):
+        self._records = {}
+        self._count = 0
+        for name, record in records:
+            self.add(name, record)
+
+    def add(self, name, record):
+        self._records.setdefault(normalize_name(name), []).append(record)
+        self._count += 1
+
+    def get_txt_records(self, name):
+        '''
+        Returns the TXT records of name, or None if there are none.
+        '''
+        return self._records.get(normalize_name(name))
+
+    def __len__(self):
+        # The number of records, like TxtIndex.
+        return self._count
+
+    def close(self):
+        pass
+
+
+def _hash_key(key):
+    # Stable across processes, unlike hash(). Collisions only cost a
+    # comparison of the names.
+    return zlib.crc32(key)
+
+
+def _escape_record(record):
+    return (record.replace('\\', '\\\\').replace('\t', '\\t')
+            .replace('\n', '\\n').encode('utf8', 'replace'))
+
+
+_RECORD_ESCAPE = re.compile(r'\\(.)')
+_RECORD_ESCAPES = {'\\': '\\', 't': '\t', 'n': '\n'}
+
+
+def _unescape_record(data):
+    record = data.decode('utf8')
+    if '\\' in record:
+        record = _RECORD_ESCAPE.sub(
+            lambda mo: _RECORD_ESCAPES[mo.group(1)], record)
+    return record
+
+
+def build_txt_index(filename, index_filename, format=None):
+    '''
+    Compile the dataset in filename into an index file for TxtIndex.
+    Returns the number of records.
+
+    The index consists of a header, an open-addressing hash table with a
+    (hash, offset) slot per name, and one "name<TAB>record<LF>" entry per
+    record, with backslash, tab and newline escaped in the record. The
+    entries are sorted by name so that the records of a name are adjacent.
+    Only the names and offsets are kept in memory while building.
+    '''
+    keys = []
+    data_fp, data_filename = open_temporary(index_filename, 'wb')
+    try:
+        with data_fp:
+            offset = 0
+            for name, record in read_txt_dataset(filename, format):
+                key = normalize_name(name).encode('ascii', 'replace')
+                entry = b'%s\t%s\n' % (key, _escape_record(record))
+                keys.append((key, offset, len(entry)))
+                data_fp.write(entry)
+                offset += len(entry)
+        keys.sort()
+        count = len(keys)
+        names = sum(1 for i in range(count)
+                    if i == 0 or keys[i][0] != keys[i - 1][0])
+        slots = names * 2 + 1
+        table = array.array('Q', bytes(_INDEX_SLOT.size * slots))
+        offset = _INDEX_HEADER.size + _INDEX_SLOT.size * slots
+        previous = None
+        for key, _, length in keys:
+            if key != previous:
+                h = _hash_key(key)
+                i = h % slots
+                while table[2 * i + 1]:
+                    i = (i + 1) % slots
+                table[2 * i] = h
+                table[2 * i + 1] = offset
+                previous = key
+            offset += length
+        if sys.byteorder != 'little':
+            table.byteswap()
+        fp, tmp_filename = open_temporary(index_filename, 'wb')
+        try:
+            with fp, open(data_filename, 'rb') as data_fp:
+                fp.write(_INDEX_HEADER.pack(
+                    _INDEX_MAGIC, _INDEX_VERSION, count, slots))
+                table.tofile(fp)
+                del table
+                data = mmap.mmap(data_fp.fileno(), 0, access=mmap.ACCESS_READ)
+                with contextlib.closing(data):
+                    for key, offset, length in keys:
+                        fp.write(data[offset:offset + length])
+            os.replace(tmp_filename, index_filename)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+    finally:
+        os.unlink(data_filename)
+    logger.info('Indexed %d records from %s', count, filename)
+    return count
+
+
+def is_txt_index(filename):
+    with open(filename, 'rb') as fp:
+        return fp.read(len(_INDEX_MAGIC)) == _INDEX_MAGIC
+
+
+class TxtIndex:
+    '''
+    TXT records in a memory-mapped index file written by build_txt_index.
+    A lookup hashes the name and reads one or a few slots of the hash
+    table, so only the pages that are touched are read from disk.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as fp:
+            self._mmap = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, count, slots = _INDEX_HEADER.unpack_from(
+                self._mmap)
+        except struct.error:
+            magic = version = None
+        if magic != _INDEX_MAGIC or version != _INDEX_VERSION:
+            self._mmap.close()
+            raise DmarcException('%s is not a TXT index' % (filename,))
+        self._count = count
+        self._slots = slots
+
+    def get_txt_records(self, name):
+        '''
+        Returns the TXT records of name, or None if there are none.
+        '''
+        key = normalize_name(name).encode('ascii', 'replace')
+        mm = self._mmap
+        h = _hash_key(key)
+        i = h % self._slots
+        while True:
+            slot_hash, offset = _INDEX_SLOT.unpack_from(
+                mm, _INDEX_HEADER.size + _INDEX_SLOT.size * i)
+            if not offset:
+                return None
+            if slot_hash == h:
+                tab = mm.find(b'\t', offset)
+                if mm[offset:tab] == key:
+                    break
+            i = (i + 1) % self._slots
+        records = []
+        prefix = key + b'\t'
+        end = len(mm)
+        while offset < end and mm[offset:offset + len(prefix)] == prefix:
+            start = offset + len(prefix)
+            offset = mm.find(b'\n', start) + 1
+            records.append(_unescape_record(mm[start:offset - 1]))
+        return records
+
+    def __len__(self):
+        return self._count
+
+    def close(self):
+        self._mmap.close()
+
+
+def open_txt_dataset(filename, format=None):
+    '''
+    Returns a TxtIndex if filename is an index file, and otherwise loads
+    the dataset into a TxtDataset.
+    '''
+    if format is None and filename != '-' and is_txt_index(filename):
+        return TxtIndex(filename)
+    return TxtDataset(read_txt_dataset(filename, format))
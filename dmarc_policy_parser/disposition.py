@@ -0,0 +1,162 @@
+'''
+Evaluate DMARC for a message: identifier alignment, the policy that
+applies to its From domain and pct sampling [DMARC, Sec. 6.6].
+'''
+
+import random
+import collections
+
+from dmarc_policy_parser.bulk import iter_dmarc_records
+from dmarc_policy_parser.dmarc import (
+    get_dmarc_record, async_get_dmarc_record, _effective_policy,
+)
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.public_suffix import get_public_suffix
+
+
+# disposition is what to do with the message: 'none', 'quarantine' or
+# 'reject'. reason is one of:
+# - pass: an aligned SPF or DKIM identifier passed.
+# - fail: no aligned identifier passed, so policy is applied.
+# - sampled_out: like fail, but the message was not selected by pct, so
+#   the next weaker policy is applied [DMARC, Sec. 6.6.4].
+# - no_policy: the From domain has no DMARC record.
+# - no_from_domain: the message has no From domain, so there is no policy
+#   to look up.
+# - error: the record could not be looked up or parsed; see error.
+# spf_aligned and dkim_aligned are None unless there is a record.
+Evaluation = collections.namedtuple(
+    'Evaluation',
+    'domain disposition policy reason spf_aligned dkim_aligned record error')
+
+_WEAKER_POLICY = {'reject': 'quarantine', 'quarantine': 'none',
+                  'none': 'none'}
+
+
+def _normalize(domain):
+    if domain:
+        return domain.rstrip('.').lower()
+
+
+def _normalize_all(domains):
+    return tuple(_normalize(d) for d in domains or () if d)
+
+
+def _is_aligned(domain, from_domain, from_org, mode, org_domain):
+    if domain is None:
+        return False
+    if domain == from_domain:
+        return True
+    if mode == 's' or from_org is None:
+        return False
+    # Domains that share an organizational domain are subdomains of it, so
+    # most unaligned domains are ruled out without looking at the PSL.
+    if domain != from_org and not domain.endswith('.' + from_org):
+        return False
+    return org_domain(domain) == from_org
+
+
+def _evaluate(from_domain, spf_domain, dkim_domains, record, error,
+              org_domain, rng):
+    if not from_domain:
+        return Evaluation(None, 'none', None, 'no_from_domain', None, None,
+                          None, None)
+    if error is not None:
+        return Evaluation(from_domain, 'none', None, 'error', None, None,
+                          None, error)
+    if record is None:
+        return Evaluation(from_domain, 'none', None, 'no_policy', None, None,
+                          None, None)
+    from_org = org_domain(from_domain)
+    spf_aligned = _is_aligned(spf_domain, from_domain, from_org,
+                              record.aspf, org_domain)
+    dkim_aligned = any(_is_aligned(d, from_domain, from_org, record.adkim,
+                                   org_domain) for d in dkim_domains)
+    policy = _effective_policy(from_domain, record)
+    if spf_aligned or dkim_aligned:
+        disposition, reason = 'none', 'pass'
+    elif (policy != 'none' and record.percent is not None and
+            record.percent < 100 and rng.random() * 100 >= record.percent):
+        disposition, reason = _WEAKER_POLICY[policy], 'sampled_out'
+    else:
+        disposition, reason = policy, 'fail'
+    return Evaluation(from_domain, disposition, policy, reason, spf_aligned,
+                      dkim_aligned, record, None)
+
+
+def evaluate_message(from_domain, spf_domain=None, dkim_domains=(),
+                     rng=None, **kwargs):
+    '''
+    Returns the Evaluation of a message whose RFC5322.From domain is
+    from_domain, where spf_domain is the domain that SPF authenticated (or
+    None) and dkim_domains are the d= domains of its valid DKIM
+    signatures. A message without a From domain is evaluated as
+    no_from_domain, without any lookup.
+
+    rng is used for pct sampling and defaults to the random module. Any
+    other keyword arguments are passed on to get_dns_txt_record.
+    '''
+    from_domain = _normalize(from_domain)
+    record = error = None
+    if from_domain:
+        try:
+            record = get_dmarc_record(from_domain, **kwargs)
+        except (DmarcException, ValueError) as exn:
+            error = exn
+    return _evaluate(from_domain, _normalize(spf_domain),
+                     _normalize_all(dkim_domains), record, error,
+                     get_public_suffix, rng or random)
+
+
+async def async_evaluate_message(from_domain, spf_domain=None,
+                                 dkim_domains=(), rng=None, **kwargs):
+    '''
+    Coroutine version of evaluate_message.
+    '''
+    from_domain = _normalize(from_domain)
+    record = error = None
+    if from_domain:
+        try:
+            record = await async_get_dmarc_record(from_domain, **kwargs)
+        except (DmarcException, ValueError) as exn:
+            error = exn
+    return _evaluate(from_domain, _normalize(spf_domain),
+                     _normalize_all(dkim_domains), record, error,
+                     get_public_suffix, rng or random)
+
+
+def evaluate_messages(messages, concurrency=32, deadline=None, rng=None,
+                      **kwargs):
+    '''
+    Evaluate a batch of messages, given as (from_domain, spf_domain,
+    dkim_domains) tuples as in evaluate_message. Returns a list of
+    Evaluations in the same order.
+
+    The distinct From domains are looked up concurrently by
+    iter_dmarc_records, and the organizational domain of each distinct
+    domain is only computed once per batch.
+    '''
+    messages = [(_normalize(f), _normalize(s), _normalize_all(d))
+                for f, s, d in messages]
+    results = {
+        r.domain: r for r in iter_dmarc_records(
+            {m[0] for m in messages if m[0]}, concurrency, deadline,
+            **kwargs)
+    }
+    org_domains = {}
+
+    def org_domain(domain):
+        try:
+            return org_domains[domain]
+        except KeyError:
+            result = org_domains[domain] = get_public_suffix(domain)
+            return result
+
+    rng = rng or random
+    evaluations = []
+    for f, s, d in messages:
+        result = results.get(f)
+        evaluations.append(_evaluate(
+            f, s, d, result and result.record, result and result.error,
+            org_domain, rng))
+    return evaluations
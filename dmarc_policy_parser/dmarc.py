@@ -1,172 +1,490 @@
-import re
+import os
+import sys
+import operator
+import functools
+import threading
+import collections.abc
 
 from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.metrics import get_metrics, increment, timer
 from dmarc_policy_parser.public_suffix import get_public_suffix
-from dmarc_policy_parser.dns import get_dns_txt_record
+from dmarc_policy_parser.dns import (
+    get_dns_txt_record, async_get_dns_txt_record, get_txt_source,
+    _retrieve_exception,
+)
 
 
-DMARC_RECORD_PATTERN = '^\s*v\s*=\s*DMARC1\s*;.*$'
+DMARC_RECORD_PATTERN = r'^\s*v\s*=\s*DMARC1\s*;.*$'
 
 
-class _Parser:
-    def __init__(self, record):
-        self.is_dmarc_record = bool(re.match(DMARC_RECORD_PATTERN, record))
-        # See https://tools.ietf.org/html/rfc7489#section-6.4
-        component_strings = record.strip().split(';')
-        if len(component_strings) == 0:
-            raise ValueError('empty input')
-        if component_strings[-1] == '':
-            # Trailing separator allowed
-            component_strings.pop()
-        seen_idx = {}
-        self.values = {}
-        for i, s in enumerate(component_strings):
-            try:
-                k, v = s.split('=', 1)
-            except ValueError:
-                raise ValueError('missing "=" in component: %r' % (s,))
-            k, v = k.strip(), v.strip()
-            if seen_idx.setdefault(k, i) != i:
-                raise ValueError('duplicate key %r' % (k,))
-            if (i == 0) != (k == 'v'):
-                assert not self.is_dmarc_record
-                raise ValueError('version must be first')
-            if k == 'r' and i != 1:
-                raise ValueError('request must be second')
-            try:
-                method = getattr(self, 'parse_' + k)
-            except AttributeError:
-                raise ValueError('unrecognized component %r' % (k,))
-            method(v)
-
-    def set_value(self, k, v):
-        self.values[k] = v
-
-    # dmarc-version   = "v" *WSP "=" *WSP %x44 %x4d %x41 %x52 %x43 %x31
-    def parse_v(self, value):
-        if value != 'DMARC1':
-            assert not self.is_dmarc_record
-            raise ValueError('invalid version %r' % (value,))
-        self.set_value('version', value)
-
-    def _parse_request(self, value):
-        if value not in ('none', 'quarantine', 'reject'):
-            raise ValueError('invalid request %r' % (value,))
-        return value
-
-    # dmarc-request   = "p" *WSP "=" *WSP
-    #                   ( "none" / "quarantine" / "reject" )
-    def parse_p(self, value):
-        self.set_value('request', self._parse_request(value))
-
-    # dmarc-srequest  = "sp" *WSP "=" *WSP
-    #                   ( "none" / "quarantine" / "reject" )
-    def parse_sp(self, value):
-        self.set_value('srequest', self._parse_request(value))
-
-    def _parse_uri(self, value):
-        r = []
-        for v in value.split(':'):
-            try:
-                uri, limit_str = v.split('!', 1)
-            except ValueError:
-                uri, limit = v, None
+def is_dmarc_record(txt):
+    '''
+    Equivalent to re.match(DMARC_RECORD_PATTERN, txt), without the regex.
+    '''
+    s = txt.lstrip()
+    if s[:1] != 'v':
+        return False
+    s = s[1:].lstrip()
+    if s[:1] != '=':
+        return False
+    s = s[1:].lstrip()
+    if s[:6] != 'DMARC1':
+        return False
+    s = s[6:].lstrip()
+    if s[:1] != ';':
+        return False
+    # '.*$' does not match newlines, except for one at the very end.
+    newline = s.find('\n')
+    return newline == -1 or newline == len(s) - 1
+
+
+_RECORD_FIELDS = (
+    'version', 'request', 'srequest', 'auri', 'furi', 'adkim', 'aspf',
+    'ainterval', 'fo', 'rfmt', 'percent', 'domain',
+)
+
+
+class DmarcRecord(collections.abc.Mapping):
+    '''
+    An immutable parsed DMARC record.
+
+    The tags are available as read-only attributes, named as in RFC 7489
+    (request for "p", auri for "rua" and so on), with None for tags that
+    are not present. The record is also a read-only mapping of the present
+    tags, like the dict returned by parse_dmarc_policy. auri and furi are
+    tuples of (uri, size limit) pairs; fo and rfmt are tuples of strings.
+    '''
+
+    __slots__ = tuple('_' + k for k in _RECORD_FIELDS)
+
+    def __init__(self, version=None, request=None, srequest=None, auri=None,
+                 furi=None, adkim=None, aspf=None, ainterval=None, fo=None,
+                 rfmt=None, percent=None, domain=None):
+        self._version = version
+        self._request = request
+        self._srequest = srequest
+        self._auri = auri
+        self._furi = furi
+        self._adkim = adkim
+        self._aspf = aspf
+        self._ainterval = ainterval
+        self._fo = fo
+        self._rfmt = rfmt
+        self._percent = percent
+        self._domain = domain
+
+    def __reduce__(self):
+        return (DmarcRecord, tuple(getattr(self, k) for k in _RECORD_FIELDS))
+
+    def __getitem__(self, key):
+        if key in _RECORD_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        if key in _RECORD_FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        return default
+
+    def __iter__(self):
+        for k in _RECORD_FIELDS:
+            if getattr(self, k) is not None:
+                yield k
+
+    def __len__(self):
+        return sum(getattr(self, k) is not None for k in _RECORD_FIELDS)
+
+    def __repr__(self):
+        return 'DmarcRecord(%s)' % ', '.join(
+            '%s=%r' % (k, v) for k, v in self.items())
+
+    def with_domain(self, domain):
+        '''
+        Returns a copy of the record with the domain field set.
+        '''
+        return DmarcRecord(
+            self._version, self._request, self._srequest, self._auri,
+            self._furi, self._adkim, self._aspf, self._ainterval, self._fo,
+            self._rfmt, self._percent, domain)
+
+    def as_dict(self):
+        '''
+        Returns the record as a dict in the format of parse_dmarc_policy.
+        '''
+        result = {}
+        for k, v in self.items():
+            if isinstance(v, tuple):
+                v = list(v)
+            result[k] = v
+        return result
+
+    @classmethod
+    def from_dict(cls, d):
+        '''
+        Returns the record for a dict returned by as_dict, e.g. after a
+        round trip through JSON.
+        '''
+        kwargs = dict(d)
+        for k in ('auri', 'furi'):
+            if k in kwargs:
+                kwargs[k] = tuple(tuple(uri) for uri in kwargs[k])
+        for k in ('fo', 'rfmt'):
+            if k in kwargs:
+                kwargs[k] = tuple(kwargs[k])
+        return cls(**kwargs)
+
+
+for _k in _RECORD_FIELDS:
+    setattr(DmarcRecord, _k, property(operator.attrgetter('_' + _k)))
+del _k
+
+
+# Interned values of the enumerated tags. Looking a value up here both
+# validates it and lets all records share the same string objects.
+_REQUESTS = {v: v for v in ('none', 'quarantine', 'reject')}
+_ALIGNMENTS = {v: v for v in ('r', 's')}
+_FAILURE_OPTIONS = {v: v for v in ('0', '1', 'd', 's')}
+_SIZE_UNITS = dict(k=10, m=20, g=30, t=40)
+
+
+def _parse_uri(value):
+    r = []
+    for v in value.split(','):
+        v = v.strip()
+        uri, sep, limit_str = v.partition('!')
+        if not sep:
+            limit = None
+        else:
+            if not limit_str:
+                raise ValueError('empty size in %r' % (value,))
+            unit = _SIZE_UNITS.get(limit_str[-1])
+            if unit is not None:
+                limit = int(limit_str[:-1]) * 2 ** unit
             else:
-                if not limit_str:
-                    raise ValueError('empty size in %r' % (value,))
-                sizes = dict(k=10, m=20, g=30, t=40)
-                if limit_str[-1] in sizes:
-                    limit = int(limit_str[:-1]) * 2 ** sizes[limit_str[-1]]
-                else:
-                    limit = int(limit_str)
-            r.append((uri, limit))
-        return r
-
-    # dmarc-auri      = "rua" *WSP "=" *WSP
-    #                   dmarc-uri *(*WSP "," *WSP dmarc-uri)
-    def parse_rua(self, value):
-        self.set_value('auri', self._parse_uri(value))
-
-    # dmarc-furi      = "ruf" *WSP "=" *WSP
-    #                   dmarc-uri *(*WSP "," *WSP dmarc-uri)
-    def parse_ruf(self, value):
-        self.set_value('furi', self._parse_uri(value))
-
-    def _parse_alignment(self, value):
-        if value not in ('r', 's'):
-            raise ValueError('invalid alignment %r' % (value,))
-        return value
-
-    # dmarc-adkim     = "adkim" *WSP "=" *WSP
-    #                   ( "r" / "s" )
-    def parse_adkim(self, value):
-        self.set_value('adkim', self._parse_alignment(value))
-
-    # dmarc-aspf      = "aspf" *WSP "=" *WSP
-    #                   ( "r" / "s" )
-    def parse_aspf(self, value):
-        self.set_value('aspf', self._parse_alignment(value))
-
-    # dmarc-ainterval = "ri" *WSP "=" *WSP 1*DIGIT
-    def parse_ri(self, value):
-        self.set_value('ainterval', int(value))
-
-    # dmarc-fo        = "fo" *WSP "=" *WSP
-    #                   ( "0" / "1" / "d" / "s" )
-    #                   *(*WSP ":" *WSP ( "0" / "1" / "d" / "s" ))
-    def parse_fo(self, value):
-        v_strip = re.sub(r'\s+', '', value)
-        values = v_strip.split(':')
-        if any(v not in ('0', '1', 'd', 's') for v in values):
-            raise ValueError('invalid failure reporting options %r' % value)
-        self.set_value('fo', values)
-
-    # dmarc-rfmt      = "rf"  *WSP "=" *WSP Keyword *(*WSP ":" Keyword)
-    #                   ; registered reporting formats only
-    def parse_rf(self, value):
-        self.set_value('rfmt', [c.strip() for c in value.split(':')])
-
-    # dmarc-percent   = "pct" *WSP "=" *WSP
-    #                   1*3DIGIT
-    def parse_pct(self, value):
-        self.set_value('percent', int(value))
+                limit = int(limit_str)
+        r.append((sys.intern(uri), limit))
+    return tuple(r)
+
+
+def parse_dmarc_record(record):
+    '''
+    Parse a DMARC record into a DmarcRecord.
+
+    Raises ValueError if the record is not a valid DMARC record.
+    See https://tools.ietf.org/html/rfc7489#section-6.4
+    '''
+    component_strings = record.strip().split(';')
+    if component_strings[-1] == '':
+        # Trailing separator allowed
+        component_strings.pop()
+    version = request = srequest = auri = furi = adkim = aspf = None
+    ainterval = fo = rfmt = percent = None
+    seen = set()
+    for i, s in enumerate(component_strings):
+        k, sep, v = s.partition('=')
+        if not sep:
+            raise ValueError('missing "=" in component: %r' % (s,))
+        k, v = k.strip(), v.strip()
+        if k in seen:
+            raise ValueError('duplicate key %r' % (k,))
+        seen.add(k)
+        if (i == 0) != (k == 'v'):
+            raise ValueError('version must be first')
+        if k == 'p':
+            # dmarc-request   = "p" *WSP "=" *WSP
+            #                   ( "none" / "quarantine" / "reject" )
+            request = _REQUESTS.get(v)
+            if request is None:
+                raise ValueError('invalid request %r' % (v,))
+        elif k == 'v':
+            # dmarc-version   = "v" *WSP "=" *WSP %x44 %x4d %x41 %x52 %x43 %x31
+            if v != 'DMARC1':
+                raise ValueError('invalid version %r' % (v,))
+            version = 'DMARC1'
+        elif k == 'rua':
+            # dmarc-auri      = "rua" *WSP "=" *WSP
+            #                   dmarc-uri *(*WSP "," *WSP dmarc-uri)
+            auri = _parse_uri(v)
+        elif k == 'ruf':
+            # dmarc-furi      = "ruf" *WSP "=" *WSP
+            #                   dmarc-uri *(*WSP "," *WSP dmarc-uri)
+            furi = _parse_uri(v)
+        elif k == 'sp':
+            # dmarc-srequest  = "sp" *WSP "=" *WSP
+            #                   ( "none" / "quarantine" / "reject" )
+            srequest = _REQUESTS.get(v)
+            if srequest is None:
+                raise ValueError('invalid request %r' % (v,))
+        elif k == 'adkim':
+            # dmarc-adkim     = "adkim" *WSP "=" *WSP
+            #                   ( "r" / "s" )
+            adkim = _ALIGNMENTS.get(v)
+            if adkim is None:
+                raise ValueError('invalid alignment %r' % (v,))
+        elif k == 'aspf':
+            # dmarc-aspf      = "aspf" *WSP "=" *WSP
+            #                   ( "r" / "s" )
+            aspf = _ALIGNMENTS.get(v)
+            if aspf is None:
+                raise ValueError('invalid alignment %r' % (v,))
+        elif k == 'pct':
+            # dmarc-percent   = "pct" *WSP "=" *WSP
+            #                   1*3DIGIT
+            percent = int(v)
+        elif k == 'fo':
+            # dmarc-fo        = "fo" *WSP "=" *WSP
+            #                   ( "0" / "1" / "d" / "s" )
+            #                   *(*WSP ":" *WSP ( "0" / "1" / "d" / "s" ))
+            try:
+                fo = tuple(_FAILURE_OPTIONS[o]
+                           for o in ''.join(v.split()).split(':'))
+            except KeyError:
+                raise ValueError(
+                    'invalid failure reporting options %r' % v)
+        elif k == 'rf':
+            # dmarc-rfmt      = "rf"  *WSP "=" *WSP Keyword *(*WSP ":" Keyword)
+            #                   ; registered reporting formats only
+            rfmt = tuple(sys.intern(c.strip()) for c in v.split(':'))
+        elif k == 'ri':
+            # dmarc-ainterval = "ri" *WSP "=" *WSP 1*DIGIT
+            ainterval = int(v)
+        elif k == 'r' and i != 1:
+            raise ValueError('request must be second')
+        else:
+            raise ValueError('unrecognized component %r' % (k,))
+    return DmarcRecord(version, request, srequest, auri, furi, adkim, aspf,
+                       ainterval, fo, rfmt, percent)
 
 
 def parse_dmarc_policy(record):
-    return _Parser(record).values
+    '''
+    Parse a DMARC record into a dict. See also parse_dmarc_record.
+    '''
+    return parse_dmarc_record(record).as_dict()
 
 
 def _get_dmarc_record(domain, *args, **kwargs):
     subdomain = '_dmarc.%s' % domain
     # The following call might raise DmarcException
     # in case of a runtime error in the DNS lookup
-    records = get_dns_txt_record(subdomain, *args, **kwargs) or ()
-    records = [r for r in records if re.match(DMARC_RECORD_PATTERN, r)]
+    records = get_dns_txt_record(subdomain, *args, **kwargs)
+    return _select_dmarc_record(domain, records)
+
+
+async def _async_get_dmarc_record(domain, *args, **kwargs):
+    subdomain = '_dmarc.%s' % domain
+    records = await async_get_dns_txt_record(subdomain, *args, **kwargs)
+    return _select_dmarc_record(domain, records)
+
+
+# Many domains publish the same record, e.g. parked domains and domains
+# hosted by the same mail provider, so parsed records are shared.
+PARSED_RECORD_CACHE_SIZE = 16384
+
+
+@functools.lru_cache(maxsize=PARSED_RECORD_CACHE_SIZE)
+def _parse_cached(record):
+    # Returns (parsed record, None) or (None, (error class name, message)).
+    with timer('parse'):
+        try:
+            return parse_dmarc_record(record), None
+        except ValueError as exn:
+            return None, (type(exn).__name__, str(exn))
+
+
+def get_parsed_record_cache_stats():
+    '''
+    Returns a dict of counters for the cache of parsed records:
+    hits, misses and the current number of entries.
+    '''
+    info = _parse_cached.cache_info()
+    return dict(hits=info.hits, misses=info.misses, entries=info.currsize)
+
+
+def _select_dmarc_record(domain, records):
+    records = [r for r in records or () if is_dmarc_record(r)]
     if records:
         if len(records) > 1:
             raise DmarcException(
                 'more than one DMARC policy published for %r' % (domain,))
-        try:
-            result = parse_dmarc_policy(records[0])
-        except ValueError as exn:
+        result, error = _parse_cached(records[0])
+        if error is not None:
+            # Counted here rather than in _parse_cached, so that every
+            # lookup of an invalid record counts, not only the first.
+            increment('errors', stage='parse', error=error[0])
             raise DmarcException(
                 'Could not parse record %r: %s' %
-                (records[0], exn))
-        result['domain'] = domain
-        return result
+                (records[0], error[1]))
+        return result.with_domain(domain)
+
+
+POLICY_DISCOVERY_METHODS = ('rfc7489', 'tree-walk')
+
+# The tree walk jumps to this many labels after querying a longer domain.
+TREE_WALK_MAX_LABELS = 7
+
+# Threads running the queries of parallel discovery besides the first.
+DISCOVERY_THREADS = 32
+
+_discovery_lock = threading.Lock()
+
+
+def get_policy_discovery():
+    '''
+    Returns (method, parallel) as given to set_policy_discovery.
+    '''
+    try:
+        return get_policy_discovery._value
+    except AttributeError:
+        return 'rfc7489', False
+
+
+def set_policy_discovery(method='rfc7489', parallel=False):
+    '''
+    Choose how get_dmarc_record finds the record that applies to a domain
+    without a record of its own:
+
+    - rfc7489: query the organizational domain [DMARC, Sec. 6.6.3].
+    - tree-walk: query each parent domain, closest first, jumping to
+      TREE_WALK_MAX_LABELS labels from longer domains [DMARCbis, Sec. 4.10].
+
+    If parallel is true, all of the names are queried at once instead of
+    one after the other, so a lookup takes one round trip instead of up to
+    eight, at the cost of queries whose answers turn out not to be needed.
+    Those answers are cached, and subdomains of one organization share
+    them. The closest record still takes precedence, and an error looking
+    up a closer name is raised even if a more distant name has a record.
+    '''
+    if method not in POLICY_DISCOVERY_METHODS:
+        raise ValueError('unknown policy discovery method %r' % (method,))
+    get_policy_discovery._value = method, bool(parallel)
+
+
+def _get_discovery_executor():
+    try:
+        return _get_discovery_executor._value
+    except AttributeError:
+        pass
+    with _discovery_lock:
+        try:
+            return _get_discovery_executor._value
+        except AttributeError:
+            import concurrent.futures
+            executor = _get_discovery_executor._value = \
+                concurrent.futures.ThreadPoolExecutor(DISCOVERY_THREADS)
+            return executor
+
+
+def _after_fork_in_child():
+    global _discovery_lock
+    _discovery_lock = threading.Lock()
+    # The threads of the executor only exist in the parent.
+    try:
+        del _get_discovery_executor._value
+    except AttributeError:
+        pass
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _tree_walk_names(domain):
+    labels = domain.split('.')
+    if not all(labels):
+        return [domain]
+    names = [domain]
+    for k in range(min(len(labels) - 1, TREE_WALK_MAX_LABELS), 0, -1):
+        names.append('.'.join(labels[-k:]))
+    return names
+
+
+def _discovery_names(domain, method):
+    # The names to query for domain, in order of precedence.
+    if method == 'tree-walk':
+        return _tree_walk_names(domain)
+    org_domain = get_public_suffix(domain)
+    if org_domain is None or org_domain == domain:
+        return [domain]
+    return [domain, org_domain]
 
 
 def get_dmarc_record(domain, *args, **kwargs):
     '''
     Implements DMARC Policy Discovery [DMARC, Sec. 6.6.3].
     https://tools.ietf.org/html/rfc7489#section-6.6.3
+
+    See set_policy_discovery for the alternatives.
+    '''
+    metrics = get_metrics()
+    if metrics is None:
+        return _discover_dmarc_record(domain, *args, **kwargs)
+    with metrics.timer('get_dmarc_record'):
+        return _discover_dmarc_record(domain, *args, **kwargs)
+
+
+def _discover_dmarc_record(domain, *args, **kwargs):
+    method, parallel = get_policy_discovery()
+    names = _discovery_names(domain, method)
+    futures = []
+    if parallel and len(names) > 1 and get_txt_source() is None:
+        # Query the first name in this thread and the others in the pool.
+        executor = _get_discovery_executor()
+        futures = [executor.submit(_get_dmarc_record, name, *args, **kwargs)
+                   for name in names[1:]]
+    try:
+        record = _get_dmarc_record(names[0], *args, **kwargs)
+        if record or len(names) == 1:
+            return record
+        increment('org_domain_fallbacks')
+        for i, name in enumerate(names[1:]):
+            if futures:
+                record = futures[i].result()
+            else:
+                record = _get_dmarc_record(name, *args, **kwargs)
+            if record:
+                return record
+    finally:
+        for f in futures:
+            f.cancel()
+
+
+async def async_get_dmarc_record(domain, *args, **kwargs):
     '''
-    record = _get_dmarc_record(domain, *args, **kwargs)
-    if not record:
-        org_domain = get_public_suffix(domain)
-        if org_domain != domain:
-            record = _get_dmarc_record(org_domain, *args, **kwargs)
-    return record
+    Coroutine version of get_dmarc_record.
+    '''
+    metrics = get_metrics()
+    if metrics is None:
+        return await _async_discover_dmarc_record(domain, *args, **kwargs)
+    with metrics.timer('get_dmarc_record'):
+        return await _async_discover_dmarc_record(domain, *args, **kwargs)
+
+
+async def _async_discover_dmarc_record(domain, *args, **kwargs):
+    # asyncio is slow to import, and only the coroutine versions need it.
+    import asyncio
+    method, parallel = get_policy_discovery()
+    names = _discovery_names(domain, method)
+    if not parallel or get_txt_source() is not None:
+        lookups = (_async_get_dmarc_record(name, *args, **kwargs)
+                   for name in names)
+    else:
+        lookups = [asyncio.ensure_future(
+            _async_get_dmarc_record(name, *args, **kwargs))
+            for name in names]
+        for task in lookups:
+            # The answers for names after the closest record are not used.
+            task.add_done_callback(_retrieve_exception)
+    for i, lookup in enumerate(lookups):
+        if i == 1:
+            increment('org_domain_fallbacks')
+        record = await lookup
+        if record:
+            return record
 
 
 def get_dmarc_policy(domain, *args, **kwargs):
@@ -179,14 +497,33 @@ def get_dmarc_policy(domain, *args, **kwargs):
     Previously 'none' would be returned, making it impossible to
     distinguish "no DMARC record" from "no action required".
     '''
-    POLICY = ['none', 'quarantine', 'reject']
-    record = get_dmarc_record(domain, *args, **kwargs)
-    if not record:
+    metrics = get_metrics()
+    if metrics is None:
+        return _effective_policy(
+            domain, get_dmarc_record(domain, *args, **kwargs))
+    with metrics.timer('get_dmarc_policy'):
+        return _effective_policy(
+            domain, get_dmarc_record(domain, *args, **kwargs))
+
+
+async def async_get_dmarc_policy(domain, *args, **kwargs):
+    '''
+    Coroutine version of get_dmarc_policy.
+    '''
+    metrics = get_metrics()
+    if metrics is None:
+        return _effective_policy(
+            domain, await async_get_dmarc_record(domain, *args, **kwargs))
+    with metrics.timer('get_dmarc_policy'):
+        return _effective_policy(
+            domain, await async_get_dmarc_record(domain, *args, **kwargs))
+
+
+def _effective_policy(domain, record):
+    if record is None:
         return None
-    request = record.get('request')
-    srequest = record.get('srequest')
-    if record['domain'] != domain and srequest in POLICY:
-        return srequest
-    if request in POLICY:
-        return request
+    if record.domain != domain and record.srequest is not None:
+        return record.srequest
+    if record.request is not None:
+        return record.request
     return 'none'
@@ -1,20 +1,75 @@
 import os
 import re
-import json
 import time
 import logging
-import subprocess
+import threading
 from dmarc_policy_parser.exceptions import DmarcException
-from dmarc_policy_parser.files import get_path
+from dmarc_policy_parser.cache import MemoryCache, open_default_cache
+from dmarc_policy_parser.files import get_cache_home
+from dmarc_policy_parser.metrics import get_metrics, timer
+from dmarc_policy_parser.resolver import query_txt, async_query_txt
 
 
 logger = logging.getLogger('dmarc_policy_parser')
 
+DNS_BACKENDS = ('native', 'host')
+
+_cache_lock = threading.Lock()
+
+
+def get_dns_backend():
+    try:
+        return get_dns_backend._value
+    except AttributeError:
+        return 'native'
+
+
+def set_dns_backend(backend):
+    '''
+    Select how fetch_dns_txt_record looks up records: 'native' queries the
+    nameservers directly over UDP/TCP, 'host' runs the host(1) program.
+    '''
+    if backend not in DNS_BACKENDS:
+        raise ValueError('unknown DNS backend %r' % (backend,))
+    get_dns_backend._value = backend
+
 
 def fetch_dns_txt_record(domain, timeout=3):
+    records, ttl = _fetch_dns_txt_record(domain, timeout)
+    return records
+
+
+async def async_fetch_dns_txt_record(domain, timeout=3):
+    '''
+    Coroutine version of fetch_dns_txt_record.
+    '''
+    records, ttl = await _async_fetch_dns_txt_record(domain, timeout)
+    return records
+
+
+def _fetch_dns_txt_record(domain, timeout):
+    # Returns (records, ttl). The host backend does not report TTLs.
     if domain.startswith('-'):
         raise ValueError('invalid domain %r' % (domain,))
     logger.info("Looking up %r", domain)
+    if get_dns_backend() == 'host':
+        return _fetch_dns_txt_record_host(domain, timeout), None
+    return query_txt(domain, timeout)
+
+
+async def _async_fetch_dns_txt_record(domain, timeout):
+    if domain.startswith('-'):
+        raise ValueError('invalid domain %r' % (domain,))
+    logger.info("Looking up %r", domain)
+    if get_dns_backend() == 'host':
+        records = await _async_fetch_dns_txt_record_host(domain, timeout)
+        return records, None
+    return await async_query_txt(domain, timeout)
+
+
+def _fetch_dns_txt_record_host(domain, timeout):
+    # Only the host backend needs subprocess; import it when it is used.
+    import subprocess
     proc = subprocess.Popen(
         ('host', '-t', 'TXT', domain),
         stdin=subprocess.DEVNULL,
@@ -25,19 +80,43 @@ def fetch_dns_txt_record(domain, timeout=3):
     except subprocess.TimeoutExpired:
         proc.kill()
         raise DmarcException('Timed out while looking up %r' % (domain,))
+    return _parse_host_output(domain, proc.returncode,
+                              stdout_data, stderr_data)
+
+
+async def _async_fetch_dns_txt_record_host(domain, timeout):
+    import asyncio
+    import subprocess
+    proc = await asyncio.create_subprocess_exec(
+        'host', '-t', 'TXT', domain,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE)
+    try:
+        stdout_data, stderr_data = await asyncio.wait_for(
+            proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise DmarcException('Timed out while looking up %r' % (domain,))
+    return _parse_host_output(domain, proc.returncode,
+                              stdout_data, stderr_data)
+
+
+def _parse_host_output(domain, returncode, stdout_data, stderr_data):
     if stderr_data:
         raise DmarcException('Error from host program: %r' %
                              (stderr_data[:500],))
     if b'not found' in stdout_data:
-        if proc.returncode != 1:
+        if returncode != 1:
             raise DmarcException(
                 '"not found" in response, but host returned %s instead of 1' %
-                proc.returncode)
+                returncode)
         return None  # No such domain
-    if proc.returncode != 0:
+    if returncode != 0:
         raise DmarcException(
             '"not found" not in response, but host returned %s' %
-            proc.returncode)
+            returncode)
     try:
         stdout = stdout_data.decode('utf8')
     except UnicodeDecodeError:
@@ -89,33 +168,351 @@ def fetch_dns_txt_record(domain, timeout=3):
     return records
 
 
-def get_dns_txt_record(domain, timeout=3, max_age=24*3600):
-    filename = get_path('dns_txt_cache.json')
+def get_txt_source():
+    return get_txt_source._value
+
+
+get_txt_source._value = None
+
+
+def set_txt_source(source):
+    '''
+    Answer get_dns_txt_record from source instead of DNS, for example a
+    dataset.TxtIndex of pre-fetched records. The caches are bypassed.
+    The source must provide get_txt_records(domain), returning a list of
+    strings or None. Pass None to go back to DNS.
+    '''
+    get_txt_source._value = source
+
+
+def get_dns_cache():
+    '''
+    Returns the persistent DNS cache, by default an sqlite3 database in the
+    cache home directory.
+    '''
+    try:
+        return get_dns_cache._value
+    except AttributeError:
+        pass
+    cache_home = get_cache_home()
+    with _cache_lock:
+        try:
+            cache, cache_dir = get_dns_cache._default
+        except AttributeError:
+            cache_dir = None
+        if cache_dir != cache_home:
+            cache = open_default_cache(cache_home)
+            get_dns_cache._default = cache, cache_home
+        return cache
+
+
+def set_dns_cache(cache):
+    '''
+    Replace the persistent DNS cache, e.g. with cache.JsonFileCache.
+    Pass None to go back to the default.
+
+    The cache must provide get(domain) returning [result, time, ttl] or None
+    and set(domain, result, time, ttl).
+    '''
+    if cache is None:
+        try:
+            del get_dns_cache._value
+        except AttributeError:
+            pass
+    else:
+        get_dns_cache._value = cache
+
+
+def get_memory_cache():
     try:
-        cache = get_dns_txt_record.cache
+        return get_memory_cache._value
     except AttributeError:
+        pass
+    with _cache_lock:
         try:
-            with open(filename) as fp:
-                cache = get_dns_txt_record.cache = json.load(fp)
-        except FileNotFoundError:
-            cache = get_dns_txt_record.cache = {}
+            return get_memory_cache._value
+        except AttributeError:
+            cache = get_memory_cache._value = MemoryCache()
+            return cache
+
+
+def set_memory_cache(cache):
+    '''
+    Replace the in-memory DNS cache, e.g. to change the bound on its size
+    or the TTLs used for negative answers and failed lookups.
+    '''
+    get_memory_cache._value = cache
+
+
+def get_dns_cache_stats():
+    return get_memory_cache().stats()
+
+
+def _get_cached(domain, max_age, now):
+    # Returns (found, result, stale); raises the error of a recently failed
+    # lookup.
+    found, result, stale = _get_memory_cached(domain, max_age, now)
+    if found:
+        return found, result, stale
+    return _get_persistent_cached(domain, max_age, now)
 
+
+def _get_memory_cached(domain, max_age, now):
+    metrics = get_metrics()
+    entry = get_memory_cache().get(domain, now, max_age)
+    if entry is None:
+        return False, None, False
+    result, error, stale = entry
+    if error is not None:
+        if metrics is not None:
+            metrics.increment('cache', result='cached_error')
+        raise error
+    if metrics is not None:
+        metrics.increment('cache', result='stale' if stale else 'memory_hit')
+    return True, result, stale
+
+
+def _get_persistent_cached(domain, max_age, now):
+    metrics = get_metrics()
+    memory_cache = get_memory_cache()
+    with timer('cache_read'):
+        entry = get_dns_cache().get(domain)
+    if entry is not None:
+        cached_result, cached_time = entry[:2]
+        ttl = entry[2] if len(entry) > 2 else None
+        ttl = memory_cache.get_ttl(cached_result, ttl, max_age)
+        usable, stale = memory_cache.is_usable(cached_time, ttl, now, max_age)
+        if usable:
+            memory_cache.set(domain, cached_result, cached_time, ttl)
+            if metrics is not None:
+                metrics.increment(
+                    'cache', result='stale' if stale else 'persistent_hit')
+            return True, cached_result, stale
+    if metrics is not None:
+        metrics.increment('cache', result='miss')
+    return False, None, False
+
+
+def _store(domain, result, ttl, max_age, now):
+    ttl = get_memory_cache().get_ttl(result, ttl, max_age)
+    _store_persistent(domain, result, now, ttl)
+    get_memory_cache().set(domain, result, now, ttl)
+
+
+def _store_persistent(domain, result, now, ttl):
+    with timer('cache_write'):
+        get_dns_cache().set(domain, result, now, ttl)
+
+
+def _store_error(domain, error, now):
+    get_memory_cache().set_error(domain, error, now)
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _lookup(domain, timeout, max_age):
+    # Concurrent lookups of the same domain share a single DNS query.
+    with _inflight_lock:
+        flight = _inflight.get(domain)
+        is_leader = flight is None
+        if is_leader:
+            flight = _inflight[domain] = _Flight()
+    if not is_leader:
+        flight.event.wait()
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
     now = time.time()
-    if domain in cache:
-        cached_result, cached_time = cache[domain]
-        if cached_time >= now - max_age:
-            return cached_result
-    reraise_exn = None
     try:
-        result = fetch_dns_txt_record(domain, timeout)
-    except DmarcException as exn:
-        reraise_exn = exn
-        result = None
-    cache[domain] = [result, now]
-    tmp_filename = filename + '.tmp'
-    with open(tmp_filename, 'w') as fp:
-        json.dump(cache, fp, indent=0)
-    os.rename(tmp_filename, filename)
-    if reraise_exn:
-        raise reraise_exn
+        with timer('dns_query'):
+            result, ttl = _fetch_dns_txt_record(domain, timeout)
+        _store(domain, result, ttl, max_age, now)
+    except BaseException as exn:
+        if isinstance(exn, DmarcException):
+            _store_error(domain, exn, now)
+        flight.error = exn
+        raise
+    else:
+        flight.result = result
+    finally:
+        with _inflight_lock:
+            del _inflight[domain]
+        flight.event.set()
     return result
+
+
+def _refresh(domain, timeout, max_age):
+    try:
+        _lookup(domain, timeout, max_age)
+    except Exception:
+        logger.debug('Background refresh of %r failed', domain,
+                     exc_info=True)
+
+
+def _refresh_in_background(domain, timeout, max_age):
+    with _inflight_lock:
+        if domain in _inflight:
+            return
+    t = threading.Thread(target=_refresh, args=(domain, timeout, max_age),
+                         daemon=True)
+    t.start()
+
+
+def get_dns_txt_record(domain, timeout=3, max_age=24*3600):
+    '''
+    Returns the TXT records of domain, or None if the domain does not exist.
+
+    Answers are cached for their DNS TTL, but at most max_age seconds.
+    If several threads ask for the same domain at once, only one of them
+    queries DNS and the others wait for its answer.
+    '''
+    metrics = get_metrics()
+    if metrics is None:
+        return _get_dns_txt_record(domain, timeout, max_age)
+    with metrics.timer('get_dns_txt_record'):
+        return _get_dns_txt_record(domain, timeout, max_age)
+
+
+def _get_dns_txt_record(domain, timeout, max_age):
+    source = get_txt_source._value
+    if source is not None:
+        return source.get_txt_records(domain)
+    now = time.time()
+    found, cached_result, stale = _get_cached(domain, max_age, now)
+    if found:
+        if stale:
+            _refresh_in_background(domain, timeout, max_age)
+        return cached_result
+    return _lookup(domain, timeout, max_age)
+
+
+_async_inflight = {}
+_async_refresh_tasks = set()
+
+
+def _retrieve_exception(future):
+    # Don't warn about errors that no other coroutine was waiting for.
+    if not future.cancelled():
+        future.exception()
+
+
+async def _async_lookup(domain, timeout, max_age, semaphore):
+    # asyncio is slow to import, and only the coroutine versions need it.
+    import asyncio
+    loop = asyncio.get_event_loop()
+    key = (loop, domain)
+    try:
+        future = _async_inflight[key]
+    except KeyError:
+        pass
+    else:
+        return await asyncio.shield(future)
+    future = _async_inflight[key] = loop.create_future()
+    future.add_done_callback(_retrieve_exception)
+    now = time.time()
+    try:
+        with timer('dns_query'):
+            if semaphore is None:
+                result, ttl = await _async_fetch_dns_txt_record(
+                    domain, timeout)
+            else:
+                async with semaphore:
+                    result, ttl = await _async_fetch_dns_txt_record(
+                        domain, timeout)
+        # Answer from the memory cache right away, and write the
+        # persistent cache without blocking the event loop.
+        memory_cache = get_memory_cache()
+        ttl = memory_cache.get_ttl(result, ttl, max_age)
+        memory_cache.set(domain, result, now, ttl)
+        await loop.run_in_executor(None, _store_persistent, domain, result,
+                                   now, ttl)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except BaseException as exn:
+        if isinstance(exn, DmarcException):
+            _store_error(domain, exn, now)
+        future.set_exception(exn)
+        raise
+    else:
+        future.set_result(result)
+    finally:
+        del _async_inflight[key]
+    return result
+
+
+async def _async_refresh(domain, timeout, max_age, semaphore):
+    try:
+        await _async_lookup(domain, timeout, max_age, semaphore)
+    except Exception:
+        logger.debug('Background refresh of %r failed', domain,
+                     exc_info=True)
+
+
+def _after_fork_in_child():
+    # Lookups in flight in the parent have no thread to finish them here,
+    # and locks may have been held by other threads at the time of fork.
+    global _cache_lock, _inflight, _inflight_lock, _async_inflight
+    _cache_lock = threading.Lock()
+    _inflight = {}
+    _inflight_lock = threading.Lock()
+    _async_inflight = {}
+    try:
+        memory_cache = get_memory_cache._value
+    except AttributeError:
+        pass
+    else:
+        memory_cache.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+async def async_get_dns_txt_record(domain, timeout=3, max_age=24*3600,
+                                   semaphore=None):
+    '''
+    Coroutine version of get_dns_txt_record, sharing the same cache.
+
+    If semaphore is given, it is only held while querying DNS, so that it
+    bounds the queries in flight without delaying answers from the cache.
+    '''
+    metrics = get_metrics()
+    if metrics is None:
+        return await _async_get_dns_txt_record(domain, timeout, max_age,
+                                               semaphore)
+    with metrics.timer('get_dns_txt_record'):
+        return await _async_get_dns_txt_record(domain, timeout, max_age,
+                                               semaphore)
+
+
+async def _async_get_dns_txt_record(domain, timeout, max_age, semaphore):
+    import asyncio
+    source = get_txt_source._value
+    if source is not None:
+        return source.get_txt_records(domain)
+    now = time.time()
+    loop = asyncio.get_event_loop()
+    found, cached_result, stale = _get_memory_cached(domain, max_age, now)
+    if not found:
+        # The persistent cache may block on its lock; keep it off the loop.
+        found, cached_result, stale = await loop.run_in_executor(
+            None, _get_persistent_cached, domain, max_age, now)
+    if found:
+        if stale:
+            if (loop, domain) not in _async_inflight:
+                task = loop.create_task(
+                    _async_refresh(domain, timeout, max_age, semaphore))
+                _async_refresh_tasks.add(task)
+                task.add_done_callback(_async_refresh_tasks.discard)
+        return cached_result
+    return await _async_lookup(domain, timeout, max_age, semaphore)
@@ -0,0 +1,243 @@
+import struct
+import collections
+
+from dmarc_policy_parser.exceptions import DmarcException
+
+
+# See https://tools.ietf.org/html/rfc1035#section-3.2.2
+TYPE_CNAME = 5
+TYPE_SOA = 6
+TYPE_TXT = 16
+TYPE_OPT = 41
+CLASS_IN = 1
+
+# See https://tools.ietf.org/html/rfc1035#section-4.1.1
+RCODE_NOERROR = 0
+RCODE_FORMERR = 1
+RCODE_SERVFAIL = 2
+RCODE_NXDOMAIN = 3
+RCODE_NOTIMP = 4
+RCODE_REFUSED = 5
+
+RCODE_NAMES = {
+    RCODE_NOERROR: 'NOERROR',
+    RCODE_FORMERR: 'FORMERR',
+    RCODE_SERVFAIL: 'SERVFAIL',
+    RCODE_NXDOMAIN: 'NXDOMAIN',
+    RCODE_NOTIMP: 'NOTIMP',
+    RCODE_REFUSED: 'REFUSED',
+}
+
+FLAG_QR = 0x8000
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+
+# Recommended by https://www.dnsflagday.net/2020/
+EDNS_PAYLOAD_SIZE = 1232
+
+# Upper bound on the number of CNAMEs followed in a single response.
+MAX_CNAME_CHAIN = 16
+
+_HEADER = struct.Struct('!HHHHHH')
+_RR_HEADER = struct.Struct('!HHIH')
+_QUESTION = struct.Struct('!HH')
+_SOA_TAIL = struct.Struct('!IIIII')
+
+
+Message = collections.namedtuple(
+    'Message', 'id flags rcode question answers authority')
+
+Record = collections.namedtuple('Record', 'name rtype rclass ttl data')
+
+
+def encode_name(domain):
+    '''
+    Encode a domain name as a sequence of length-prefixed labels.
+
+    Non-ASCII labels are converted with the IDNA codec.
+    '''
+    name = domain.rstrip('.')
+    if not name:
+        return b'\0'
+    parts = []
+    for label in name.split('.'):
+        try:
+            b = label.encode('ascii')
+        except UnicodeEncodeError:
+            try:
+                b = label.encode('idna')
+            except UnicodeError:
+                raise ValueError('invalid domain %r' % (domain,))
+        if not 0 < len(b) < 64:
+            raise ValueError('invalid domain %r' % (domain,))
+        parts.append(bytes((len(b),)) + b)
+    parts.append(b'\0')
+    result = b''.join(parts)
+    if len(result) > 255:
+        raise ValueError('invalid domain %r' % (domain,))
+    return result
+
+
+def encode_query(qid, domain, qtype=TYPE_TXT, edns=True):
+    header = _HEADER.pack(qid, FLAG_RD, 1, 0, 0, 1 if edns else 0)
+    question = encode_name(domain) + _QUESTION.pack(qtype, CLASS_IN)
+    if not edns:
+        return header + question
+    # OPT pseudo-RR, see https://tools.ietf.org/html/rfc6891#section-6.1.2
+    opt = b'\0' + _RR_HEADER.pack(TYPE_OPT, EDNS_PAYLOAD_SIZE, 0, 0)
+    return header + question + opt
+
+
+def _decode_name(data, offset):
+    labels = []
+    end = None
+    jumps = 0
+    while True:
+        try:
+            length = data[offset]
+        except IndexError:
+            raise DmarcException('Truncated name in DNS response')
+        if length & 0xc0 == 0xc0:
+            # Compression pointer
+            if offset + 2 > len(data):
+                raise DmarcException('Truncated name in DNS response')
+            if end is None:
+                end = offset + 2
+            jumps += 1
+            if jumps > 64:
+                raise DmarcException('Compression loop in DNS response')
+            offset = ((length & 0x3f) << 8) | data[offset + 1]
+            continue
+        if length & 0xc0:
+            raise DmarcException('Unsupported label type in DNS response')
+        offset += 1
+        if length == 0:
+            break
+        if offset + length > len(data):
+            raise DmarcException('Truncated name in DNS response')
+        labels.append(data[offset:offset + length].decode('latin-1').lower())
+        offset += length
+    if end is None:
+        end = offset
+    return '.'.join(labels), end
+
+
+def normalize_name(domain):
+    '''
+    Return domain in the lowercase form used for names in decoded messages.
+    '''
+    name, _ = _decode_name(encode_name(domain), 0)
+    return name
+
+
+def _decode_txt(rdata):
+    strings = []
+    i = 0
+    while i < len(rdata):
+        length = rdata[i]
+        if i + 1 + length > len(rdata):
+            raise DmarcException('Truncated TXT record in DNS response')
+        strings.append(rdata[i + 1:i + 1 + length])
+        i += 1 + length
+    return strings
+
+
+def _decode_records(data, offset, count):
+    records = []
+    for _ in range(count):
+        name, offset = _decode_name(data, offset)
+        if offset + _RR_HEADER.size > len(data):
+            raise DmarcException('Truncated record in DNS response')
+        rtype, rclass, ttl, rdlength = _RR_HEADER.unpack_from(data, offset)
+        offset += _RR_HEADER.size
+        end = offset + rdlength
+        if end > len(data):
+            raise DmarcException('Truncated record in DNS response')
+        if rtype == TYPE_TXT:
+            rdata = _decode_txt(data[offset:end])
+        elif rtype == TYPE_CNAME:
+            rdata, _ = _decode_name(data, offset)
+        elif rtype == TYPE_SOA:
+            mname, o = _decode_name(data, offset)
+            rname, o = _decode_name(data, o)
+            if o + _SOA_TAIL.size > end:
+                raise DmarcException('Truncated SOA record in DNS response')
+            rdata = (mname, rname) + _SOA_TAIL.unpack_from(data, o)
+        else:
+            rdata = data[offset:end]
+        records.append(Record(name, rtype, rclass, ttl, rdata))
+        offset = end
+    return records, offset
+
+
+def decode_message(data):
+    if len(data) < _HEADER.size:
+        raise DmarcException('Truncated DNS response')
+    qid, flags, qdcount, ancount, nscount, arcount = \
+        _HEADER.unpack_from(data)
+    offset = _HEADER.size
+    question = None
+    for _ in range(qdcount):
+        qname, offset = _decode_name(data, offset)
+        if offset + _QUESTION.size > len(data):
+            raise DmarcException('Truncated question in DNS response')
+        qtype, qclass = _QUESTION.unpack_from(data, offset)
+        offset += _QUESTION.size
+        question = (qname, qtype, qclass)
+    if flags & FLAG_TC:
+        # The rest of a truncated message is unreliable.
+        return Message(qid, flags, flags & 0xf, question, [], [])
+    answers, offset = _decode_records(data, offset, ancount)
+    authority, offset = _decode_records(data, offset, nscount)
+    return Message(qid, flags, flags & 0xf, question, answers, authority)
+
+
+def _negative_ttl(message):
+    # See https://tools.ietf.org/html/rfc2308#section-5
+    for rr in message.authority:
+        if rr.rtype == TYPE_SOA:
+            return min(rr.ttl, rr.data[-1])
+    return None
+
+
+def get_txt_answer(message, domain):
+    '''
+    Extract the TXT records for domain from a response message,
+    following any CNAME chain in the answer section.
+
+    Returns (records, ttl), where records is None if the domain does not
+    exist and an empty list if it has no TXT records. A record published as
+    several character-strings is joined into a single string.
+    ttl is None if the response does not say how long it may be cached.
+    '''
+    if message.rcode not in (RCODE_NOERROR, RCODE_NXDOMAIN):
+        raise DmarcException(
+            'DNS server returned %s for %r' %
+            (RCODE_NAMES.get(message.rcode, message.rcode), domain))
+    current = normalize_name(domain)
+    ttl = None
+    for _ in range(MAX_CNAME_CHAIN):
+        for rr in message.answers:
+            if rr.rtype == TYPE_CNAME and rr.name == current:
+                current = rr.data
+                ttl = rr.ttl if ttl is None else min(ttl, rr.ttl)
+                break
+        else:
+            break
+    else:
+        raise DmarcException('CNAME chain too long for %r' % (domain,))
+    if message.rcode == RCODE_NXDOMAIN:
+        negative_ttl = _negative_ttl(message)
+        if ttl is None or negative_ttl is None:
+            return None, negative_ttl
+        return None, min(ttl, negative_ttl)
+    records = []
+    for rr in message.answers:
+        if rr.rtype == TYPE_TXT and rr.name == current:
+            records.append(b''.join(rr.data).decode('utf8', 'replace'))
+            ttl = rr.ttl if ttl is None else min(ttl, rr.ttl)
+    if not records:
+        negative_ttl = _negative_ttl(message)
+        if negative_ttl is not None:
+            ttl = negative_ttl if ttl is None else min(ttl, negative_ttl)
+    return records, ttl
@@ -1,4 +1,19 @@
+import io
 import os
+import sys
+import gzip
+import tempfile
+import threading
+import contextlib
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where file locking is skipped.
+    fcntl = None
+
+
+_lock = threading.Lock()
 
 
 def get_cache_home():
@@ -12,7 +27,11 @@ def get_cache_home():
         cache_base = os.path.expanduser('~/.cache')
     cache_dir = os.path.join(cache_base, 'dmarc_policy_parser')
     os.makedirs(cache_dir, exist_ok=True)
-    get_cache_home._value = cache_dir
+    with _lock:
+        try:
+            return get_cache_home._value
+        except AttributeError:
+            get_cache_home._value = cache_dir
     return cache_dir
 
 
@@ -22,3 +41,58 @@ def set_cache_home(d):
 
 def get_path(filename):
     return os.path.join(get_cache_home(), filename)
+
+
+def open_temporary(path, mode='w'):
+    '''
+    Open a new, uniquely named file in the directory of path.
+    Returns (fp, tmp_path); the caller should os.replace tmp_path with path
+    once it is written, so that concurrent writers never share a temporary
+    file.
+    '''
+    fd, tmp_path = tempfile.mkstemp(
+        prefix=os.path.basename(path) + '.', suffix='.tmp',
+        dir=os.path.dirname(path) or '.')
+    return os.fdopen(fd, mode), tmp_path
+
+
+@contextlib.contextmanager
+def file_lock(path):
+    '''
+    Hold an exclusive lock on path + '.lock' for the duration of the block,
+    serializing processes that share a cache directory.
+    The lock is not reentrant and does not exclude threads of one process.
+    '''
+    if fcntl is None:
+        yield
+        return
+    with open(path + '.lock', 'a') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def open_text(filename):
+    '''
+    Open filename ('-' for standard input) for reading as text,
+    decompressing it if it starts with the gzip magic number.
+    '''
+    if filename == '-':
+        fp = sys.stdin.buffer
+        if fp.peek(2)[:2] == b'\x1f\x8b':
+            fp = gzip.GzipFile(fileobj=fp)
+    else:
+        fp = open(filename, 'rb')
+        try:
+            compressed = fp.peek(2)[:2] == b'\x1f\x8b'
+        except BaseException:
+            fp.close()
+            raise
+        if compressed:
+            # Unlike a file passed as fileobj, the file that gzip.open
+            # opens is closed with the GzipFile.
+            fp.close()
+            fp = gzip.open(filename, 'rb')
+    return io.TextIOWrapper(fp, encoding='utf8', errors='replace')
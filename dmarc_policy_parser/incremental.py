@@ -0,0 +1,302 @@
+'''
+Incremental re-scans of a list of domains that only report what changed.
+
+A StateStore keeps, for each domain, a fingerprint of the DMARC TXT
+record that determined its policy, the resulting policy and when the DNS
+answers behind it expire. rescan skips domains whose answers have not
+expired, re-reads the raw TXT records of the others, and only parses a
+record when its fingerprint changed, so the cost of a run grows with the
+number of expired and changed records rather than with the number of
+domains.
+'''
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import collections
+import concurrent.futures
+
+from dmarc_policy_parser.dmarc import (
+    get_policy_discovery, is_dmarc_record, _discovery_names,
+    _effective_policy, _select_dmarc_record,
+)
+from dmarc_policy_parser.dns import (
+    get_dns_cache, get_dns_txt_record, get_memory_cache, get_txt_source,
+)
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.files import get_path
+
+
+# Domains are read from the store and their new state written in batches
+# of this size.
+STATE_BATCH = 1000
+
+# The stored state of a domain. fingerprint identifies the DMARC TXT record
+# that applies to the domain and the domain it was found at; policy and
+# percent are its effective policy and pct, and error is set instead if
+# the record is invalid. expires is when the DNS answers behind it expire.
+DomainState = collections.namedtuple(
+    'DomainState', 'fingerprint policy percent error checked expires')
+
+# An entry of the change feed. change is one of:
+# - added: the domain has a policy and had none (or was not known).
+# - removed: the domain had a policy and no longer has a record.
+# - tightened, loosened: the effective policy or pct is stricter or laxer.
+# - changed: the record changed without changing the policy, e.g. its rua.
+# - invalid: the record can no longer be parsed; see error.
+# - error: the DNS lookup failed. The stored state is kept, and the domain
+#   is revalidated on the next run.
+# record is the new DmarcRecord, or None.
+Change = collections.namedtuple(
+    'Change', 'domain change old_policy policy record error')
+
+_STRENGTH = {None: 0, 'none': 0, 'quarantine': 1, 'reject': 2}
+
+
+class StateStore:
+    '''
+    Per-domain state of rescan in an sqlite3 table, opened like
+    cache.SqliteCache: in WAL mode, with one connection per thread and
+    process.
+    '''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._local = threading.local()
+        conn = self._connection()
+        with conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS domain_state ('
+                'domain TEXT PRIMARY KEY, fingerprint TEXT, policy TEXT, '
+                'percent INTEGER, error TEXT, checked REAL, expires REAL)')
+
+    def _connection(self):
+        try:
+            pid, conn = self._local.conn
+        except AttributeError:
+            pass
+        else:
+            if pid == os.getpid():
+                return conn
+        conn = sqlite3.connect(self.filename, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        self._local.conn = os.getpid(), conn
+        return conn
+
+    def get(self, domain):
+        return self.get_many([domain]).get(domain)
+
+    def get_many(self, domains):
+        '''
+        Returns a dict mapping those of domains that have a state to their
+        DomainState.
+        '''
+        domains = list(domains)
+        result = {}
+        conn = self._connection()
+        # Stay below the default limit of 999 parameters of old sqlite3s.
+        for i in range(0, len(domains), 900):
+            chunk = domains[i:i + 900]
+            rows = conn.execute(
+                'SELECT domain, fingerprint, policy, percent, error, checked, '
+                'expires FROM domain_state WHERE domain IN (%s)' %
+                ','.join('?' * len(chunk)), chunk)
+            for row in rows:
+                result[row[0]] = DomainState(*row[1:])
+        return result
+
+    def update(self, entries):
+        '''
+        Store many (domain, DomainState) entries in one transaction.
+        '''
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                'INSERT OR REPLACE INTO domain_state '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                ((domain,) + tuple(state) for domain, state in entries))
+
+    def close(self):
+        try:
+            pid, conn = self._local.conn
+        except AttributeError:
+            return
+        del self._local.conn
+        if pid == os.getpid():
+            conn.close()
+
+
+def _fetch_dmarc_txt(domain, max_age, kwargs):
+    # Returns (record domain, DMARC TXT records, expiry time) without
+    # parsing, following the names of policy discovery in order. max_age
+    # takes precedence over one in kwargs, which would otherwise be passed
+    # twice.
+    kwargs = dict(kwargs, max_age=max_age)
+    method = get_policy_discovery()[0]
+    now = time.time()
+    offline = get_txt_source() is not None
+    expires = now + max_age
+    for name in _discovery_names(domain, method):
+        subdomain = '_dmarc.' + name
+        records = get_dns_txt_record(subdomain, **kwargs)
+        if not offline:
+            entry = get_dns_cache().get(subdomain)
+            if entry is not None:
+                ttl = get_memory_cache().get_ttl(
+                    entry[0], entry[2] if len(entry) > 2 else None, max_age)
+                expires = min(expires, max(entry[1] + ttl, now))
+        records = sorted(r for r in records or () if is_dmarc_record(r))
+        if records:
+            return name, records, expires
+    return None, [], expires
+
+
+def _fingerprint(record_domain, records):
+    data = json.dumps([record_domain, records]).encode('utf8')
+    return hashlib.sha1(data).hexdigest()
+
+
+def _revalidate(domain, state, max_age, kwargs):
+    # Returns (DomainState, record, parsed); record is only parsed if the
+    # fingerprint changed.
+    record_domain, records, expires = _fetch_dmarc_txt(domain, max_age, kwargs)
+    now = time.time()
+    fingerprint = _fingerprint(record_domain, records)
+    if state is not None and state.fingerprint == fingerprint:
+        return state._replace(checked=now, expires=expires), None, False
+    policy = percent = error = record = None
+    if records:
+        try:
+            record = _select_dmarc_record(record_domain, records)
+        except DmarcException as exn:
+            error = str(exn)
+        else:
+            policy = _effective_policy(domain, record)
+            percent = record.percent
+    return (DomainState(fingerprint, policy, percent, error, now, expires),
+            record, True)
+
+
+def _strength(policy, percent):
+    rank = _STRENGTH.get(policy, 0)
+    if not rank:
+        return 0, 0
+    return rank, 100 if percent is None else percent
+
+
+def _classify(old, new):
+    if new.error is not None:
+        if old is not None and old.error == new.error:
+            return None
+        return 'invalid'
+    old_policy = None if old is None else old.policy
+    if old_policy is None:
+        return None if new.policy is None else 'added'
+    if new.policy is None:
+        return 'removed'
+    old_strength = _strength(old.policy, old.percent)
+    new_strength = _strength(new.policy, new.percent)
+    if new_strength > old_strength:
+        return 'tightened'
+    if new_strength < old_strength:
+        return 'loosened'
+    return 'changed'
+
+
+def rescan(domains, state=None, concurrency=32, force=False,
+           max_age=24*3600, counts=None, **kwargs):
+    '''
+    Revalidate the DMARC records of domains against the StateStore state
+    (by default domain_state.sqlite3 in the cache home, or the filename
+    given) and yield a Change for each domain whose policy or record
+    changed, in the order the lookups complete.
+
+    Domains whose stored DNS answers have not expired are skipped unless
+    force is true. The others are looked up with at most concurrency
+    lookups in flight, and their records are only parsed if the raw TXT
+    record changed. The first run reports every domain with a policy as
+    added. domains may be any iterable and is consumed lazily; it should
+    not contain duplicates.
+
+    The new state of a domain whose record changed is only stored once the
+    caller asks for the next change, so a run that is interrupted reports
+    the change it was handling, and those it had not yielded, again the
+    next time.
+
+    If counts is a dict, the number of domains "skipped", "revalidated",
+    "parsed", "changed" and "errors" are added to it. Any other keyword
+    arguments are passed on to get_dns_txt_record.
+    '''
+    if state is None:
+        state = get_path('domain_state.sqlite3')
+    store = StateStore(state) if isinstance(state, str) else state
+    if counts is None:
+        counts = {}
+    for key in ('skipped', 'revalidated', 'parsed', 'changed', 'errors'):
+        counts.setdefault(key, 0)
+    now = time.time()
+    domain_iter = iter(domains)
+    pending = {}
+    updates = []
+    executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+
+    def finish(future):
+        # Returns (domain, new state or None, Change or None).
+        domain, old = pending.pop(future)
+        try:
+            new, record, parsed = future.result()
+        except (DmarcException, ValueError) as exn:
+            counts['errors'] += 1
+            return domain, None, Change(domain, 'error', old and old.policy,
+                                        old and old.policy, None, exn)
+        counts['revalidated'] += 1
+        counts['parsed'] += parsed
+        change = _classify(old, new) if parsed else None
+        if change is None:
+            return domain, new, None
+        counts['changed'] += 1
+        return domain, new, Change(domain, change, old and old.policy,
+                                   new.policy, record, new.error)
+
+    def wait(return_when):
+        done, _ = concurrent.futures.wait(pending, return_when=return_when)
+        for future in done:
+            domain, new, change = finish(future)
+            if change is not None:
+                yield change
+            # Not reached if the caller stopped at this change.
+            if new is not None:
+                updates.append((domain, new))
+
+    try:
+        while True:
+            chunk = [d for _, d in zip(range(STATE_BATCH), domain_iter)]
+            if not chunk:
+                break
+            states = store.get_many(chunk)
+            for domain in chunk:
+                old = states.get(domain)
+                if not force and old is not None and old.expires > now:
+                    counts['skipped'] += 1
+                    continue
+                while len(pending) >= concurrency:
+                    yield from wait(concurrent.futures.FIRST_COMPLETED)
+                future = executor.submit(_revalidate, domain, old, max_age,
+                                         kwargs)
+                pending[future] = (domain, old)
+            if len(updates) >= STATE_BATCH:
+                store.update(updates)
+                del updates[:]
+        while pending:
+            yield from wait(concurrent.futures.ALL_COMPLETED)
+    finally:
+        executor.shutdown(wait=False)
+        for future in pending:
+            future.cancel()
+        store.update(updates)
+        if store is not state:
+            store.close()
@@ -0,0 +1,269 @@
+'''
+Optional instrumentation of lookups.
+
+Instrumentation is disabled until a Metrics object is installed with
+set_metrics. It then records:
+
+- stage_seconds{stage}: a latency histogram of each stage, where stage is
+  one of get_dmarc_policy, get_dmarc_record, get_dns_txt_record,
+  dns_query, cache_read, cache_write, parse, get_public_suffix,
+  public_suffix_load and public_suffix_download.
+- errors{stage, error}: exceptions raised out of each stage, by class.
+- cache{result}: how get_dns_txt_record was answered: memory_hit,
+  persistent_hit, stale (served while being refreshed), cached_error
+  (a recently failed lookup) or miss.
+- org_domain_fallbacks: lookups that fell back to the organizational
+  domain because the domain itself has no DMARC record.
+- dns_retries: DNS queries sent again after a timeout or an error.
+- dns_hedges: DNS queries also sent to a second server because the first
+  was slow to answer.
+- public_suffix_age_seconds: a gauge of the age of the public suffix list
+  in use, read when the metrics are exported.
+
+Metrics can be exported in the Prometheus text format or as JSON, and
+callbacks can be registered to receive each observation as it happens.
+'''
+
+import os
+import json
+import time
+import bisect
+import threading
+import collections
+
+
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+    0.25, 0.5, 1, 2.5, 5, 10,
+)
+
+PROMETHEUS_HELP = {
+    'stage_seconds': 'Time spent in each stage of a lookup.',
+    'errors': 'Exceptions raised by each stage of a lookup.',
+    'cache': 'DNS cache lookups by result.',
+    'org_domain_fallbacks':
+        'Lookups that fell back to the organizational domain.',
+    'dns_retries': 'DNS queries sent again after a timeout or an error.',
+    'dns_hedges': 'DNS queries also sent to a second server.',
+    'public_suffix_age_seconds': 'Age of the public suffix list in use.',
+}
+
+
+class _Timer:
+    __slots__ = ('metrics', 'stage', 'start')
+
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start,
+                             exc)
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class Metrics:
+    '''
+    Thread-safe collection of stage timers and counters.
+
+    Each callback is called as callback(name, labels, value) for every
+    observation, where name is one of the metric names listed in the
+    module documentation, labels is a dict and value is the number of
+    seconds for stage_seconds and the increment for counters. Callbacks
+    are called in the thread doing the lookup and should be quick.
+    '''
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._timers = {}
+        self._counters = collections.Counter()
+        self._callbacks = []
+
+    def add_callback(self, callback):
+        self._callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        self._callbacks.remove(callback)
+
+    def timer(self, stage):
+        '''
+        Returns a context manager that records the time spent in stage,
+        and the class of the exception if one is raised.
+        '''
+        return _Timer(self, stage)
+
+    def observe(self, stage, seconds, error=None):
+        i = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            try:
+                timer = self._timers[stage]
+            except KeyError:
+                timer = self._timers[stage] = [
+                    0, 0.0, [0] * (len(self.buckets) + 1)]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2][i] += 1
+            if error is not None:
+                error_labels = (('error', type(error).__name__),
+                                ('stage', stage))
+                self._counters['errors', error_labels] += 1
+        for callback in self._callbacks:
+            callback('stage_seconds', {'stage': stage}, seconds)
+            if error is not None:
+                callback('errors', dict(error_labels), 1)
+
+    def increment(self, name, value=1, **labels):
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self._counters[key] += value
+        for callback in self._callbacks:
+            callback(name, labels, value)
+
+    def reset(self):
+        with self._lock:
+            self._timers.clear()
+            self._counters.clear()
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def snapshot(self):
+        '''
+        Returns the current values as a dict that can be serialized as JSON:
+        {"stage_seconds": {stage: {"count", "sum", "buckets"}},
+        "counters": {name: [{"labels", "value"}]}, "gauges": {name: value}},
+        where "buckets" is a list of [upper bound, cumulative count] pairs.
+        '''
+        with self._lock:
+            timers = {stage: (count, total, list(buckets))
+                      for stage, (count, total, buckets)
+                      in self._timers.items()}
+            counters = dict(self._counters)
+        result = {'stage_seconds': {}, 'counters': {}, 'gauges': _gauges()}
+        for stage, (count, total, buckets) in sorted(timers.items()):
+            cumulative = []
+            n = 0
+            for bound, c in zip(self.buckets + ('+Inf',), buckets):
+                n += c
+                cumulative.append([bound, n])
+            result['stage_seconds'][stage] = {
+                'count': count, 'sum': total, 'buckets': cumulative}
+        for (name, labels), value in sorted(counters.items()):
+            result['counters'].setdefault(name, []).append(
+                {'labels': dict(labels), 'value': value})
+        return result
+
+    def to_json(self):
+        return json.dumps(self.snapshot())
+
+    def to_prometheus(self, prefix='dmarc_policy_parser'):
+        '''
+        Returns the metrics in the Prometheus text exposition format.
+        '''
+        snapshot = self.snapshot()
+        lines = []
+
+        def header(name, kind):
+            full_name = '%s_%s' % (prefix, name)
+            lines.append('# HELP %s %s' % (full_name, PROMETHEUS_HELP.get(
+                name.rsplit('_total', 1)[0], name)))
+            lines.append('# TYPE %s %s' % (full_name, kind))
+            return full_name
+
+        if snapshot['stage_seconds']:
+            name = header('stage_seconds', 'histogram')
+            for stage, timer in snapshot['stage_seconds'].items():
+                for bound, count in timer['buckets']:
+                    lines.append('%s_bucket{stage="%s",le="%s"} %d' % (
+                        name, stage, bound, count))
+                lines.append('%s_sum{stage="%s"} %r' % (
+                    name, stage, timer['sum']))
+                lines.append('%s_count{stage="%s"} %d' % (
+                    name, stage, timer['count']))
+        for counter, values in snapshot['counters'].items():
+            name = header(counter + '_total', 'counter')
+            for v in values:
+                labels = ','.join('%s="%s"' % (k, _escape_label(lv))
+                                  for k, lv in sorted(v['labels'].items()))
+                lines.append('%s%s %d' % (
+                    name, '{%s}' % labels if labels else '', v['value']))
+        for gauge, value in sorted(snapshot['gauges'].items()):
+            name = header(gauge, 'gauge')
+            lines.append('%s %r' % (name, value))
+        return '\n'.join(lines) + '\n'
+
+
+def _gauges():
+    # Imported here, since public_suffix records its timings in this module.
+    from dmarc_policy_parser.public_suffix import get_public_suffix_age
+    gauges = {}
+    age = get_public_suffix_age()
+    if age is not None:
+        gauges['public_suffix_age_seconds'] = age
+    return gauges
+
+
+def _escape_label(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def get_metrics():
+    '''
+    Returns the installed Metrics, or None if instrumentation is disabled.
+    '''
+    return get_metrics._value
+
+
+get_metrics._value = None
+
+
+def set_metrics(metrics):
+    '''
+    Install a Metrics object to start recording, or None to stop.
+    '''
+    get_metrics._value = metrics
+
+
+def _after_fork_in_child():
+    metrics = get_metrics._value
+    if metrics is not None:
+        metrics.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def timer(stage):
+    '''
+    Like Metrics.timer on the installed Metrics, or a context manager that
+    does nothing if instrumentation is disabled.
+    '''
+    metrics = get_metrics._value
+    if metrics is None:
+        return _NULL_TIMER
+    return metrics.timer(stage)
+
+
+def increment(name, value=1, **labels):
+    metrics = get_metrics._value
+    if metrics is not None:
+        metrics.increment(name, value, **labels)
@@ -1,75 +1,437 @@
 import os
 import time
+import marshal
+import hashlib
+import functools
 import logging
-import urllib.error
-import urllib.request
+import threading
 
-from dmarc_policy_parser.files import get_path
+from dmarc_policy_parser.files import get_path, file_lock, open_temporary
 from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.metrics import get_metrics, timer
 
 
 logger = logging.getLogger('dmarc_policy_parser')
 
+_lock = threading.Lock()
+_refreshing = False
+
 
 def download_file(uri, path, timeout=10):
+    # urllib.request is slow to import and only needed to download the list.
+    import urllib.error
+    import urllib.request
     start_time = time.time()
     try:
         p = urllib.request.urlopen(uri, None, timeout)
     except urllib.error.URLError as exn:
         raise DmarcException('Could not download file') from exn
-    tmp_path = path + '.tmp'
     try:
-        fp = open(tmp_path, 'wb')
+        fp, tmp_path = open_temporary(path, 'wb')
     except Exception as exn:
         p.close()
         raise DmarcException('Could not open output file') from exn
     try:
         try:
-            size = int(p.getheader('Content-Length'))
-        except (KeyError, ValueError):
-            size = None
-        while True:
-            elapsed_time = time.time() - start_time
-            if elapsed_time > timeout:
-                raise DmarcException('download_file timed out')
-            b = p.read(4096)
-            if not b:
-                break
-            fp.write(b)
-    finally:
-        p.close()
-        fp.close()
-    try:
-        os.rename(tmp_path, path)
-    except Exception as exn:
-        raise DmarcException('Could not rename temporary file') from exn
+            try:
+                size = int(p.getheader('Content-Length'))
+            except (KeyError, ValueError, TypeError):
+                size = None
+            while True:
+                elapsed_time = time.time() - start_time
+                if elapsed_time > timeout:
+                    raise DmarcException('download_file timed out')
+                b = p.read(4096)
+                if not b:
+                    break
+                fp.write(b)
+        finally:
+            p.close()
+            fp.close()
+        try:
+            os.replace(tmp_path, path)
+        except Exception as exn:
+            raise DmarcException('Could not rename temporary file') from exn
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+PUBLIC_SUFFIX_LIST_URI = (
+    'https://raw.githubusercontent.com/publicsuffix/list/' +
+    'master/public_suffix_list.dat')
+
+# Copies of the list installed by operating system packages, used to start
+# up without waiting for a download when background refresh is enabled.
+SYSTEM_PUBLIC_SUFFIX_FILES = (
+    '/usr/share/publicsuffix/public_suffix_list.dat',
+)
+
+# How long to wait before retrying a failed background refresh.
+REFRESH_RETRY_INTERVAL = 3600
 
 
 def fetch_public_suffixes(filename):
-    download_file('https://raw.githubusercontent.com/publicsuffix/list/' +
-                  'master/public_suffix_list.dat', filename)
+    '''
+    Download the list to filename, only replacing an existing list once the
+    new one has been checked to be usable.
+    '''
+    download_path = filename + '.download'
+    with timer('public_suffix_download'):
+        download_file(PUBLIC_SUFFIX_LIST_URI, download_path)
+        try:
+            _validate(compile_public_suffixes(
+                *_read_public_suffixes(download_path)))
+            os.replace(download_path, filename)
+        except BaseException:
+            os.unlink(download_path)
+            raise
 
 
-def get_public_suffixes(max_age=7*24*3600):
-    now = time.time()
+def _validate(trie):
+    if len(trie) < 100 or not trie.get('com', {}).get('', 0) & _RULE:
+        raise DmarcException('Downloaded public suffix list looks invalid')
+
+
+def get_public_suffix_file():
+    '''
+    Returns (filename, download): where the list is read from, and whether
+    it is downloaded there when it is missing or too old.
+    '''
     try:
-        cache_age = now - get_public_suffixes._cache_time
+        return get_public_suffix_file._value
     except AttributeError:
-        cache_age = None
-    if cache_age is not None and cache_age < max_age:
-        return get_public_suffixes._cache
+        return get_path('public_suffix_list.dat'), True
+
+
+def set_public_suffix_file(filename, download=False):
+    '''
+    Read the public suffix list from filename instead of the cache home.
+    Unless download is true, the file is never downloaded, only reloaded
+    when it is older than max_age; keeping it up to date is up to the
+    caller. Pass None to go back to the default.
+    '''
+    if filename is None:
+        try:
+            del get_public_suffix_file._value
+        except AttributeError:
+            pass
+    else:
+        get_public_suffix_file._value = filename, download
+
 
-    filename = get_path('public_suffix_list.dat')
+def set_public_suffix_background_refresh(enabled):
+    '''
+    When enabled, an expired list keeps being used while a background
+    thread downloads, validates and swaps in a new one, so lookups never
+    wait for a download. A failed refresh is retried after
+    REFRESH_RETRY_INTERVAL seconds. If there is no list at all yet, a copy
+    from SYSTEM_PUBLIC_SUFFIX_FILES is used until the download completes.
+    '''
+    get_public_suffix_background_refresh._value = bool(enabled)
+
+
+def get_public_suffix_background_refresh():
     try:
-        file_mtime = os.stat(filename).st_mtime
-    except FileNotFoundError:
-        fetch_public_suffixes(filename)
+        return get_public_suffix_background_refresh._value
+    except AttributeError:
+        return False
+
+
+def get_public_suffix_age():
+    '''
+    Returns the age in seconds of the list currently in use, based on the
+    mtime of its file, or None if no list has been loaded yet.
+    '''
+    try:
+        file_mtime = get_public_suffixes._cache[3]
+    except AttributeError:
+        return None
+    return time.time() - file_mtime
+
+
+def get_public_suffixes(max_age=7*24*3600):
+    '''
+    Returns the sets (rules, exceptions) of the public suffix list.
+
+    Lookups only need the compiled trie, so the sets are read from the list
+    on first use.
+    '''
+    filename, trie = _get_public_suffix_list(max_age)
+    with _lock:
+        try:
+            sets_trie, rules, exceptions = get_public_suffixes._sets
+        except AttributeError:
+            sets_trie = None
+        if sets_trie is not trie:
+            rules, exceptions = _read_public_suffixes(filename)
+            get_public_suffixes._sets = trie, rules, exceptions
+    return rules, exceptions
+
+
+def get_public_suffix_trie(max_age=7*24*3600):
+    '''
+    Returns the public suffix list compiled by compile_public_suffixes.
+    '''
+    filename, trie = _get_public_suffix_list(max_age)
+    return trie
+
+
+def _get_public_suffix_list(max_age):
+    # The list is reloaded when set_public_suffix_file or set_cache_home
+    # changed where it is read from, whatever its age.
+    source = get_public_suffix_file()
+    try:
+        filename, trie, cache_time, file_mtime, cache_source = \
+            get_public_suffixes._cache
+    except AttributeError:
+        pass
     else:
-        file_age = now - file_mtime
-        if file_age > max_age:
-            logger.info('Downloading new list of public suffixes')
+        if cache_source == source:
+            if time.time() - cache_time < max_age:
+                return filename, trie
+            if get_public_suffix_background_refresh():
+                _start_refresh(max_age)
+                return filename, trie
+
+    with _lock:
+        # Another thread may have loaded the list while we were waiting.
+        now = time.time()
+        try:
+            filename, trie, cache_time, file_mtime, cache_source = \
+                get_public_suffixes._cache
+        except AttributeError:
+            pass
+        else:
+            if cache_source == source and now - cache_time < max_age:
+                return filename, trie
+
+        filename, download = source
+        if (get_public_suffix_background_refresh() and
+                not os.path.exists(filename)):
+            for system_filename in SYSTEM_PUBLIC_SUFFIX_FILES:
+                if os.path.exists(system_filename):
+                    logger.info('Using %s until the public suffix list '
+                                'has been downloaded', system_filename)
+                    _load(system_filename, now, source)
+                    break
+            else:
+                system_filename = None
+        else:
+            system_filename = None
+
+        if system_filename is None:
+            if download:
+                _update_file(filename, max_age)
+            _load(filename, now, source)
+        result = get_public_suffixes._cache[:2]
+    if system_filename is not None:
+        _start_refresh(max_age)
+    return result
+
+
+def _update_file(filename, max_age):
+    # Only one process downloads the list; the others wait for it.
+    with file_lock(filename):
+        try:
+            file_mtime = os.stat(filename).st_mtime
+        except FileNotFoundError:
             fetch_public_suffixes(filename)
+        else:
+            file_age = time.time() - file_mtime
+            if file_age > max_age:
+                logger.info('Downloading new list of public suffixes')
+                fetch_public_suffixes(filename)
+
+
+def _load(filename, now, source):
+    # Must be called with _lock held. source is the get_public_suffix_file()
+    # that filename stands in for.
+    file_mtime = os.stat(filename).st_mtime
+    trie = load_public_suffixes(filename)
+    get_public_suffixes._cache = filename, trie, now, file_mtime, source
+    _get_public_suffix.cache_clear()
+
+
+def _start_refresh(max_age):
+    global _refreshing
+    with _lock:
+        if _refreshing:
+            return
+        _refreshing = True
+    t = threading.Thread(target=_refresh, args=(max_age,), daemon=True)
+    t.start()
+
 
+def _refresh(max_age):
+    global _refreshing
+    try:
+        source = get_public_suffix_file()
+        filename, download = source
+        try:
+            if download:
+                _update_file(filename, max_age)
+            # Compile outside the lock; _load then only reads the snapshot.
+            load_public_suffixes(filename)
+        except Exception as exn:
+            logger.warning('Could not refresh the public suffix list: %s',
+                           exn)
+            with _lock:
+                # Keep the current list and try again later.
+                old_filename, trie, cache_time, file_mtime, old_source = \
+                    get_public_suffixes._cache
+                get_public_suffixes._cache = (
+                    old_filename, trie,
+                    time.time() - max_age + REFRESH_RETRY_INTERVAL,
+                    file_mtime, old_source)
+            return
+        with _lock:
+            _load(filename, time.time(), source)
+    finally:
+        _refreshing = False
+
+
+def _after_fork_in_child():
+    global _lock, _refreshing
+    _lock = threading.Lock()
+    # A refresh thread running in the parent does not exist in the child.
+    _refreshing = False
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+# Bump when the format of the compiled snapshot changes.
+_SNAPSHOT_VERSION = 1
+
+
+def _file_digest(filename):
+    h = hashlib.sha256()
+    with open(filename, 'rb') as fp:
+        for b in iter(lambda: fp.read(1 << 16), b''):
+            h.update(b)
+    return h.hexdigest()
+
+
+def _snapshot_filename(filename):
+    # Lists at different paths, such as the system copy and the downloaded
+    # one, must not overwrite each other's snapshot.
+    path = os.path.abspath(filename).encode('utf8', 'surrogateescape')
+    return get_path('%s.%s.marshal' % (os.path.basename(filename),
+                                       hashlib.sha1(path).hexdigest()[:12]))
+
+
+def load_public_suffixes(filename):
+    '''
+    Returns the compiled trie for the list in filename.
+
+    The trie is kept in a marshal snapshot in the cache home, one per path
+    of a list, which is only rebuilt when the size or mtime of filename
+    change and its hash differs from the one recorded in the snapshot.
+    '''
+    with timer('public_suffix_load'):
+        return _load_public_suffixes(filename)
+
+
+def _load_public_suffixes(filename):
+    snapshot_filename = _snapshot_filename(filename)
+    st = os.stat(filename)
+    digest = None
+    try:
+        with open(snapshot_filename, 'rb') as fp:
+            snapshot = marshal.loads(fp.read())
+        version, mtime_ns, size, snapshot_digest, trie = snapshot
+    except (OSError, EOFError, ValueError, TypeError):
+        version = None
+    if version == _SNAPSHOT_VERSION:
+        if (mtime_ns, size) == (st.st_mtime_ns, st.st_size):
+            return trie
+        digest = _file_digest(filename)
+        if digest != snapshot_digest:
+            version = None
+    if version != _SNAPSHOT_VERSION:
+        logger.debug('Compiling %s', filename)
+        digest = digest or _file_digest(filename)
+        trie = compile_public_suffixes(*_read_public_suffixes(filename))
+    snapshot = (_SNAPSHOT_VERSION, st.st_mtime_ns, st.st_size, digest, trie)
+    try:
+        fp, tmp_filename = open_temporary(snapshot_filename, 'wb')
+        with fp:
+            fp.write(marshal.dumps(snapshot))
+        os.replace(tmp_filename, snapshot_filename)
+    except OSError:
+        logger.warning('Could not write %s', snapshot_filename,
+                       exc_info=True)
+    return trie
+
+
+def export_public_suffixes():
+    '''
+    Returns (data, compiled, mtime) for the list in use: the contents of
+    the list file, its marshal snapshot and its mtime, or None if the list
+    has not been downloaded.
+    '''
+    filename, download = get_public_suffix_file()
+    try:
+        mtime = os.stat(filename).st_mtime
+    except FileNotFoundError:
+        return None
+    # Make sure the snapshot is up to date.
+    load_public_suffixes(filename)
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    try:
+        with open(_snapshot_filename(filename), 'rb') as fp:
+            compiled = fp.read()
+    except OSError:
+        compiled = None
+    return data, compiled, mtime
+
+
+def import_public_suffixes(data, compiled, mtime):
+    '''
+    Install a list returned by export_public_suffixes on another host,
+    unless the current list is at least as new. The compiled snapshot is
+    only used if it was made from the same list by a compatible version;
+    otherwise the list is compiled again when it is loaded.
+
+    A list given to set_public_suffix_file without download=True is left
+    alone. Returns True if the list was installed.
+    '''
+    filename, download = get_public_suffix_file()
+    if not download:
+        return False
+    with file_lock(filename):
+        try:
+            if os.stat(filename).st_mtime >= mtime:
+                return False
+        except FileNotFoundError:
+            pass
+        fp, tmp_filename = open_temporary(filename, 'wb')
+        try:
+            with fp:
+                fp.write(data)
+            os.utime(tmp_filename, (mtime, mtime))
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            os.unlink(tmp_filename)
+            raise
+        if compiled is not None:
+            snapshot_filename = _snapshot_filename(filename)
+            fp, tmp_filename = open_temporary(snapshot_filename, 'wb')
+            with fp:
+                fp.write(compiled)
+            os.replace(tmp_filename, snapshot_filename)
+    with _lock:
+        _load(filename, time.time())
+    return True
+
+
+def _read_public_suffixes(filename):
     exceptions = set()
     rules = set()
 
@@ -87,41 +449,104 @@ def get_public_suffixes(max_age=7*24*3600):
                     exceptions.add(w[1:])
                 else:
                     rules.add(w)
-
-    get_public_suffixes._cache = rules, exceptions
-    get_public_suffixes._cache_time = now
     return rules, exceptions
 
 
-def get_public_suffix(domain):
-    if domain is None:
-        return
-    domain = domain.lower()
-    rules, exceptions = get_public_suffixes()
+# Flags stored under the key '' in a trie node. '' is never a label.
+_RULE = 1
+_EXCEPTION = 2
+
+
+def _punycode_label(label):
+    try:
+        label.encode('ascii')
+    except UnicodeEncodeError:
+        return 'xn--' + label.encode('punycode').decode('ascii')
 
-    parts_input = domain.split('.')
-    if not all(parts_input):
+
+def compile_public_suffixes(rules, exceptions):
+    '''
+    Compile the rules and exceptions into a trie keyed by labels from
+    right to left. Each node is a dict mapping a label (or '*') to the
+    child node, and '' to a combination of the _RULE and _EXCEPTION flags.
+    Non-ASCII labels are also reachable through their punycode form,
+    so lookups need not decode punycode.
+    '''
+    trie = {}
+    for names, flag in ((rules, _RULE), (exceptions, _EXCEPTION)):
+        for name in names:
+            node = trie
+            for label in reversed(name.split('.')):
+                child = node.get(label)
+                puny = _punycode_label(label)
+                if child is None:
+                    child = node.setdefault(puny, {}) if puny else {}
+                    node[label] = child
+                node = child
+            node[''] = node.get('', 0) | flag
+    return trie
+
+
+def _find_registrable_labels(trie, parts):
+    # Returns the number of labels at the end of parts that make up the
+    # registrable domain, or 0 if parts is itself a public suffix.
+    n = len(parts)
+    node = trie
+    # The implicit "*" rule matches every top-level domain.
+    match = 1
+    is_exception = False
+    for depth in range(1, n + 1):
+        label = parts[n - depth]
+        child = node.get(label)
+        if child is None and label.startswith('xn--'):
+            # Not in the canonical punycode form stored in the trie
+            try:
+                child = node.get(label[4:].encode().decode('punycode'))
+            except UnicodeError:
+                pass
+        flags = 0 if child is None else child.get('', 0)
+        if flags & _EXCEPTION:
+            match, is_exception = depth, True
+        elif flags & _RULE or node.get('*', {}).get('', 0) & _RULE:
+            match, is_exception = depth, False
+        if child is None:
+            break
+        node = child
+    if is_exception:
+        return match
+    if match == n:
+        return 0
+    return match + 1
+
+
+@functools.lru_cache(maxsize=65536)
+def _get_public_suffix(domain):
+    domain = domain.lower()
+    parts = domain.split('.')
+    if not all(parts):
         # Some components are empty
         return
-    # Decode punycode
-    parts = [p[4:].encode().decode('punycode')
-             if p.startswith('xn--') else p
-             for p in parts_input]
-    for i in range(len(parts)):
-        current_suffix = '.'.join(parts[i:])
-        # Is current_suffix a public suffix?
-        if current_suffix in exceptions:
-            return '.'.join(parts_input[i:])
-        current_suffix_wild = '.'.join(['*'] + parts[i+1:])
-        rule_matches = (
-            i == len(parts) - 1 or
-            current_suffix in rules or
-            current_suffix_wild in rules)
-        if rule_matches:
-            if i > 0:
-                return '.'.join(parts_input[i-1:])
-            else:
-                return
+    trie = get_public_suffix_trie()
+    k = _find_registrable_labels(trie, parts)
+    if k:
+        return '.'.join(parts[-k:])
+
+
+def get_public_suffix(domain):
+    '''
+    Returns the organizational domain of domain: its public suffix plus one
+    label, or None if domain is itself a public suffix.
+    '''
+    if domain is None:
+        return
+    metrics = get_metrics()
+    if metrics is None:
+        # Refresh the list (and clear _get_public_suffix) when it is too old.
+        get_public_suffix_trie()
+        return _get_public_suffix(domain)
+    with metrics.timer('get_public_suffix'):
+        get_public_suffix_trie()
+        return _get_public_suffix(domain)
 
 
 def test():
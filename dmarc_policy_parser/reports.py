@@ -0,0 +1,364 @@
+'''
+Ingest DMARC aggregate reports [DMARC, Appendix C], the XML files sent to
+the addresses in "rua", and compare the policy each reporter saw with the
+one published now.
+
+Reports may be plain XML or compressed with gzip or zip, as they arrive
+attached to email. They are parsed as a stream, totalling each <record>
+as it is read, so memory use does not depend on the size of a report.
+Reports come from arbitrary senders, so a report with a DOCTYPE or an
+entity declaration is rejected before anything is expanded.
+'''
+
+import os
+import gzip
+import zipfile
+import collections
+import concurrent.futures
+import xml.parsers.expat as expat
+
+from dmarc_policy_parser.dmarc import get_dmarc_record
+from dmarc_policy_parser.exceptions import DmarcException
+
+
+# A report summarized by parse_report. policy_published is a dict of the
+# tags the reporter saw, e.g. {"domain": ..., "p": "reject", "pct": "100"}.
+# messages is the number of messages in the report, dispositions maps the
+# applied disposition to a number of messages, and dkim_pass, spf_pass and
+# dmarc_pass count the messages that passed aligned DKIM, aligned SPF or
+# either. error is set, and the other fields may be None, if the report
+# could not be read.
+Report = collections.namedtuple(
+    'Report',
+    'filename org_name report_id begin end domain policy_published '
+    'messages dispositions dkim_pass spf_pass dmarc_pass error')
+
+# Tags of policy_published that are compared with the published record,
+# the DmarcRecord attribute they correspond to and their default.
+_COMPARED_TAGS = (
+    ('p', 'request', None), ('sp', 'srequest', None),
+    ('pct', 'percent', 100), ('adkim', 'adkim', 'r'), ('aspf', 'aspf', 'r'),
+)
+
+
+# A zip archive starts with a local file header, or with the end of the
+# central directory if it is empty.
+_ZIP_MAGIC = (b'PK\x03\x04', b'PK\x05\x06')
+
+
+def open_report(filename):
+    '''
+    Open an aggregate report for reading as bytes, decompressing it if it
+    is gzip-compressed or a zip archive. A zip archive is expected to hold
+    a single report.
+    '''
+    fp = open(filename, 'rb')
+    try:
+        magic = fp.peek(4)[:4]
+    except BaseException:
+        fp.close()
+        raise
+    if magic[:2] != b'\x1f\x8b' and magic not in _ZIP_MAGIC:
+        return fp
+    # Reopen compressed reports by name, so that closing the returned file
+    # also closes the file underneath; a file passed as fileobj is not.
+    fp.close()
+    if magic[:2] == b'\x1f\x8b':
+        return gzip.open(filename, 'rb')
+    with zipfile.ZipFile(filename) as archive:
+        names = [name for name in archive.namelist()
+                 if not name.endswith('/')]
+        if not names:
+            raise DmarcException('%s is an empty zip archive' % (filename,))
+        # The archive's file stays open until the member is closed.
+        return archive.open(names[0])
+
+
+def _local_name(tag):
+    # Strip the namespace of DMARCbis reports.
+    return tag.rpartition('}')[2]
+
+
+class _ReportTarget:
+    # Parser target that totals the records of a report as they are parsed,
+    # without building a tree of the document.
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.path = []
+        self.text = []
+        self.metadata = {}
+        self.published = None
+        self.count = 0
+        self.evaluated = {}
+        self.messages = self.dkim_pass = self.spf_pass = self.dmarc_pass = 0
+        self.dispositions = collections.Counter()
+
+    def start(self, tag, attrib):
+        name = _local_name(tag) if '}' in tag else tag
+        if not self.path and name != 'feedback':
+            raise DmarcException('%s is not an aggregate report' %
+                                 (self.filename,))
+        if name == 'policy_published':
+            self.published = {}
+        self.path.append(name)
+        del self.text[:]
+
+    def data(self, data):
+        self.text.append(data)
+
+    def end(self, tag):
+        path = self.path
+        name = path.pop()
+        parent = path[-1] if path else None
+        if parent == 'policy_evaluated':
+            self.evaluated[name] = ''.join(self.text).strip()
+        elif parent == 'row':
+            if name == 'count':
+                self.count = int(''.join(self.text) or 0)
+        elif name == 'record':
+            count = self.count
+            dkim = self.evaluated.get('dkim') == 'pass'
+            spf = self.evaluated.get('spf') == 'pass'
+            self.messages += count
+            self.dispositions[self.evaluated.get('disposition') or
+                              'none'] += count
+            self.dkim_pass += count * dkim
+            self.spf_pass += count * spf
+            self.dmarc_pass += count * (dkim or spf)
+            self.count = 0
+            self.evaluated = {}
+        elif parent == 'policy_published':
+            self.published[name] = ''.join(self.text).strip()
+        elif parent in ('report_metadata', 'date_range'):
+            self.metadata[name] = ''.join(self.text).strip()
+        del self.text[:]
+
+    def doctype(self, *args):
+        # Reports have no use for a DTD, and rejecting it rules out entity
+        # expansion ("billion laughs") whatever the version of expat.
+        raise DmarcException('%s has a DOCTYPE declaration' %
+                             (self.filename,))
+
+    def entity(self, name, *args):
+        raise DmarcException('%s declares the entity %s' %
+                             (self.filename, name))
+
+
+def _new_parser(target):
+    # An expat parser that calls target as ElementTree would, giving tags in
+    # a namespace as "namespace}name".
+    parser = expat.ParserCreate(namespace_separator='}')
+    parser.buffer_text = True
+    parser.StartElementHandler = target.start
+    parser.EndElementHandler = target.end
+    parser.CharacterDataHandler = target.data
+    parser.StartDoctypeDeclHandler = target.doctype
+    parser.EntityDeclHandler = target.entity
+    return parser
+
+
+def parse_report(filename):
+    '''
+    Read the aggregate report in filename and return a Report summarizing
+    it. Errors reading or parsing the report are returned in Report.error
+    rather than raised, so that one bad report does not stop a batch.
+    '''
+    target = _ReportTarget(filename)
+    try:
+        with open_report(filename) as fp:
+            parser = _new_parser(target)
+            while True:
+                data = fp.read(65536)
+                if not data:
+                    break
+                parser.Parse(data, False)
+            parser.Parse(b'', True)
+    except (OSError, EOFError, ValueError, zipfile.BadZipFile,
+            expat.ExpatError, DmarcException) as exn:
+        error = exn
+    else:
+        error = None
+        if not (target.published or {}).get('domain'):
+            error = DmarcException('%s has no policy_published domain' %
+                                   (filename,))
+    metadata = target.metadata
+    if error is not None:
+        return Report(filename, metadata.get('org_name'),
+                      metadata.get('report_id'), None, None, None,
+                      target.published, None, None, None, None, None, error)
+    return Report(
+        filename, metadata.get('org_name'), metadata.get('report_id'),
+        _int_or_none(metadata.get('begin')), _int_or_none(metadata.get('end')),
+        target.published['domain'].rstrip('.').lower(), target.published,
+        target.messages, dict(target.dispositions), target.dkim_pass,
+        target.spf_pass, target.dmarc_pass, None)
+
+
+def _int_or_none(s):
+    try:
+        return int(s)
+    except (TypeError, ValueError):
+        return None
+
+
+def compare_policy(published, record):
+    '''
+    Returns the sorted tags of policy_published whose value differs from
+    the DmarcRecord record, which is None if the domain has no record.
+    Tags missing from either side compare as their default.
+    '''
+    differences = []
+    for tag, attribute, default in _COMPARED_TAGS:
+        value = published.get(tag) or None
+        current = None if record is None else getattr(record, attribute)
+        if tag == 'sp':
+            value = value or published.get('p') or None
+            if record is not None:
+                current = current or record.request
+        if current is None:
+            current = default
+        if value is None:
+            value = default
+        if value is not None and current is not None:
+            value = str(value).lower()
+            current = str(current).lower()
+        if value != current:
+            differences.append(tag)
+    return sorted(differences)
+
+
+class DomainAggregate:
+    '''
+    Running totals of the reports about one domain, updated by
+    ingest_reports as reports are read.
+
+    record is the DMARC record published now, or None; lookup_error is set
+    instead if it could not be looked up. mismatched_reports counts the
+    reports whose policy_published differs from record, and mismatches
+    maps each differing tag to its number of reports.
+    '''
+
+    __slots__ = (
+        'domain', 'record', 'lookup_error', 'reports', 'messages',
+        'dispositions', 'dkim_pass', 'spf_pass', 'dmarc_pass',
+        'mismatched_reports', 'mismatches', 'reporters', 'begin', 'end',
+    )
+
+    def __init__(self, domain, record=None, lookup_error=None):
+        self.domain = domain
+        self.record = record
+        self.lookup_error = lookup_error
+        self.reports = self.messages = 0
+        self.dkim_pass = self.spf_pass = self.dmarc_pass = 0
+        self.mismatched_reports = 0
+        self.dispositions = collections.Counter()
+        self.mismatches = collections.Counter()
+        self.reporters = collections.Counter()
+        self.begin = self.end = None
+
+    def add(self, report):
+        '''
+        Add a Report about this domain. Returns the tags of its
+        policy_published that differ from the current record, or None if
+        the record could not be looked up.
+        '''
+        self.reports += 1
+        self.messages += report.messages
+        self.dispositions.update(report.dispositions)
+        self.dkim_pass += report.dkim_pass
+        self.spf_pass += report.spf_pass
+        self.dmarc_pass += report.dmarc_pass
+        self.reporters[report.org_name] += 1
+        if report.begin is not None:
+            self.begin = (report.begin if self.begin is None else
+                          min(self.begin, report.begin))
+        if report.end is not None:
+            self.end = (report.end if self.end is None else
+                        max(self.end, report.end))
+        if self.lookup_error is not None:
+            return None
+        differences = compare_policy(report.policy_published, self.record)
+        if differences:
+            self.mismatched_reports += 1
+            self.mismatches.update(differences)
+        return differences
+
+    def as_dict(self):
+        return {
+            'domain': self.domain,
+            'record': None if self.record is None else self.record.as_dict(),
+            'lookup_error': (None if self.lookup_error is None else
+                             str(self.lookup_error)),
+            'reports': self.reports,
+            'messages': self.messages,
+            'dispositions': dict(self.dispositions),
+            'dkim_pass': self.dkim_pass,
+            'spf_pass': self.spf_pass,
+            'dmarc_pass': self.dmarc_pass,
+            'mismatched_reports': self.mismatched_reports,
+            'mismatches': dict(self.mismatches),
+            'reporters': len(self.reporters),
+            'begin': self.begin,
+            'end': self.end,
+        }
+
+
+def _iter_parsed(filenames, workers):
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1:
+        for filename in filenames:
+            yield parse_report(filename)
+        return
+    # Keep a bounded number of files in flight so that a long list of
+    # filenames is consumed lazily.
+    filenames = iter(filenames)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        pending = set()
+        while True:
+            for filename in filenames:
+                pending.add(executor.submit(parse_report, filename))
+                if len(pending) >= 2 * workers:
+                    break
+            if not pending:
+                return
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def ingest_reports(filenames, workers=None, aggregates=None, **kwargs):
+    '''
+    Read the aggregate reports in filenames in a pool of workers processes
+    (by default one per CPU; 0 or 1 to read them in this process) and
+    yield (report, aggregate, differences) in the order the
+    reports are read, where aggregate is the updated DomainAggregate of
+    the domain of the report and differences is as returned by
+    DomainAggregate.add. aggregate is None for reports that could not be
+    read (see Report.error).
+
+    aggregates is a dict mapping domains to their DomainAggregate, which
+    is updated in place, so a caller may keep totals across calls. The
+    current record of each domain is looked up once per aggregate with
+    get_dmarc_record, and so usually comes from the DNS cache. Any keyword
+    arguments are passed on to get_dmarc_record.
+    '''
+    if aggregates is None:
+        aggregates = {}
+    for report in _iter_parsed(filenames, workers):
+        if report.error is not None:
+            yield report, None, None
+            continue
+        aggregate = aggregates.get(report.domain)
+        if aggregate is None:
+            try:
+                record = get_dmarc_record(report.domain, **kwargs)
+            except (DmarcException, ValueError) as exn:
+                aggregate = DomainAggregate(report.domain, lookup_error=exn)
+            else:
+                aggregate = DomainAggregate(report.domain, record)
+            aggregates[report.domain] = aggregate
+        differences = aggregate.add(report)
+        yield report, aggregate, differences
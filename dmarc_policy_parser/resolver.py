@@ -0,0 +1,877 @@
+import os
+import time
+import random
+import socket
+import struct
+import logging
+import selectors
+import threading
+import collections
+
+from dmarc_policy_parser import dnswire
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.metrics import increment
+
+
+logger = logging.getLogger('dmarc_policy_parser')
+
+DNS_PORT = 53
+
+_TCP_LENGTH = struct.Struct('!H')
+
+
+def read_resolv_conf(filename='/etc/resolv.conf'):
+    servers = []
+    try:
+        with open(filename) as fp:
+            for line in fp:
+                words = line.split()
+                if len(words) >= 2 and words[0] == 'nameserver':
+                    servers.append((words[1], DNS_PORT))
+    except FileNotFoundError:
+        pass
+    return servers
+
+
+def get_nameservers():
+    try:
+        return get_nameservers._value
+    except AttributeError:
+        pass
+    servers = read_resolv_conf() or [('127.0.0.1', DNS_PORT)]
+    get_nameservers._value = servers
+    return servers
+
+
+def set_nameservers(servers):
+    '''
+    Set the nameservers used by the native resolver.
+
+    Each server is either an address or an (address, port) pair.
+    '''
+    result = []
+    for s in servers:
+        if isinstance(s, str):
+            result.append((s, DNS_PORT))
+        else:
+            host, port = s
+            result.append((host, int(port)))
+    if not result:
+        raise ValueError('no nameservers given')
+    get_nameservers._value = result
+
+
+def _family(host):
+    return socket.AF_INET6 if ':' in host else socket.AF_INET
+
+
+def _new_query_id():
+    return struct.unpack('!H', os.urandom(2))[0]
+
+
+def _is_response_to(message, qid, domain, qtype):
+    if message.id != qid or not message.flags & dnswire.FLAG_QR:
+        return False
+    if message.question is None:
+        # Some servers omit the question in FORMERR responses.
+        return message.rcode == dnswire.RCODE_FORMERR
+    qname, qtype_, qclass = message.question
+    return qname == domain and qtype_ == qtype
+
+
+def _recv_exact(sock, n):
+    chunks = []
+    while n:
+        b = sock.recv(n)
+        if not b:
+            raise DmarcException('Connection closed by DNS server')
+        chunks.append(b)
+        n -= len(b)
+    return b''.join(chunks)
+
+
+def _with_query_id(packet, qid):
+    return struct.pack('!H', qid) + packet[2:]
+
+
+# Timeouts of a single try, in seconds. Servers that have not answered yet
+# start at INITIAL_TIMEOUT.
+INITIAL_TIMEOUT = 1.0
+MIN_TIMEOUT = 0.05
+MAX_TIMEOUT = 3.0
+# Never hedge sooner than this, so that fast servers are not sent every
+# query twice.
+MIN_HEDGE_DELAY = 0.005
+# A server that fails this many times in a row is skipped for a while.
+FAILURES_BEFORE_DOWN = 3
+MAX_DOWN_TIME = 60
+TCP_IDLE_TIMEOUT = 10
+_RTT_SAMPLES = 64
+
+
+class _ServerState:
+    '''
+    Round-trip time estimate and health of one nameserver.
+
+    The timeout of a try is the smoothed RTT plus four times its mean
+    deviation as in RFC 6298, doubled after each timeout of the server.
+    '''
+
+    __slots__ = ('srtt', 'rttvar', 'backoff', 'failures', 'down_until',
+                 'rtts')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.backoff = 1
+        self.failures = 0
+        self.down_until = 0
+        self.rtts = collections.deque(maxlen=_RTT_SAMPLES)
+
+    def timeout(self):
+        if self.srtt is None:
+            t = INITIAL_TIMEOUT
+        else:
+            t = self.srtt + 4 * self.rttvar
+        return min(max(t * self.backoff, MIN_TIMEOUT), MAX_TIMEOUT)
+
+    def hedge_delay(self):
+        # The 95th percentile of recent RTTs.
+        if len(self.rtts) < 8:
+            return self.timeout() / 2
+        rtts = sorted(self.rtts)
+        return max(rtts[len(rtts) * 95 // 100], MIN_HEDGE_DELAY)
+
+    def success(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.backoff = 1
+        self.failures = 0
+        self.down_until = 0
+        self.rtts.append(rtt)
+
+    def failure(self, now, timed_out):
+        self.failures += 1
+        if timed_out:
+            self.backoff = min(self.backoff * 2, 8)
+        if self.failures >= FAILURES_BEFORE_DOWN:
+            self.down_until = now + min(
+                2 ** (self.failures - FAILURES_BEFORE_DOWN), MAX_DOWN_TIME)
+
+
+class _TcpConnection:
+    '''
+    A TCP connection to a nameserver that several threads may send queries
+    on at once (RFC 7766 pipelining). A reader thread hands each response
+    to the thread waiting for it, and closes the connection when it has
+    been idle for idle_timeout seconds.
+    '''
+
+    def __init__(self, server, timeout, idle_timeout):
+        self.sock = socket.create_connection(server, timeout)
+        self.sock.settimeout(idle_timeout)
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.error = None
+        self.queries = 0
+        self.last_used = time.monotonic()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def query(self, packet, qid, qname, qtype, timeout):
+        # Returns the response, or raises socket.timeout or the error that
+        # closed the connection.
+        slot = [threading.Event(), None, qname, qtype]
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            while qid in self.pending:
+                qid = _new_query_id()
+            packet = _with_query_id(packet, qid)
+            self.pending[qid] = slot
+            self.queries += 1
+            try:
+                self.sock.sendall(_TCP_LENGTH.pack(len(packet)) + packet)
+            except OSError as exn:
+                del self.pending[qid]
+                self._close(exn)
+                raise
+        try:
+            if not slot[0].wait(timeout):
+                raise socket.timeout()
+        finally:
+            with self.lock:
+                self.pending.pop(qid, None)
+                self.last_used = time.monotonic()
+        if slot[1] is None:
+            raise self.error
+        return slot[1]
+
+    def _read_loop(self):
+        try:
+            while True:
+                try:
+                    length, = _TCP_LENGTH.unpack(_recv_exact(self.sock, 2))
+                except socket.timeout:
+                    with self.lock:
+                        if (not self.pending and time.monotonic() -
+                                self.last_used >= self.idle_timeout):
+                            self._close(DmarcException(
+                                'Idle connection closed'))
+                            return
+                    continue
+                message = dnswire.decode_message(
+                    _recv_exact(self.sock, length))
+                with self.lock:
+                    slot = self.pending.get(message.id)
+                if slot is not None and _is_response_to(
+                        message, message.id, slot[2], slot[3]):
+                    slot[1] = message
+                    slot[0].set()
+        except (OSError, DmarcException) as exn:
+            with self.lock:
+                self._close(exn)
+
+    def _close(self, exn):
+        # Must be called with self.lock held.
+        if self.error is not None:
+            return
+        self.error = exn
+        self.sock.close()
+        for slot in self.pending.values():
+            slot[0].set()
+
+
+class _AsyncTcpConnection:
+    '''
+    Coroutine version of _TcpConnection, bound to one event loop.
+    '''
+
+    def __init__(self, loop, reader, writer, idle_timeout):
+        # asyncio is slow to import, and only the coroutine versions need it.
+        import asyncio
+        self.loop = loop
+        self.reader = reader
+        self.writer = writer
+        self.idle_timeout = idle_timeout
+        self.pending = {}
+        self.error = None
+        self.queries = 0
+        self.last_used = loop.time()
+        self._reader = asyncio.ensure_future(self._read_loop())
+        self._idle_check = loop.call_later(idle_timeout, self._check_idle)
+
+    async def query(self, packet, qid, qname, qtype):
+        if self.error is not None:
+            raise self.error
+        while qid in self.pending:
+            qid = _new_query_id()
+        packet = _with_query_id(packet, qid)
+        future = self.loop.create_future()
+        self.pending[qid] = future, qname, qtype
+        self.queries += 1
+        try:
+            self.writer.write(_TCP_LENGTH.pack(len(packet)) + packet)
+            return await future
+        finally:
+            del self.pending[qid]
+            self.last_used = self.loop.time()
+
+    async def _read_loop(self):
+        import asyncio
+        try:
+            while True:
+                length, = _TCP_LENGTH.unpack(
+                    await self.reader.readexactly(2))
+                message = dnswire.decode_message(
+                    await self.reader.readexactly(length))
+                future, qname, qtype = self.pending.get(
+                    message.id, (None, None, None))
+                if (future is not None and not future.done() and
+                        _is_response_to(message, message.id, qname, qtype)):
+                    future.set_result(message)
+        except asyncio.IncompleteReadError:
+            self._close(DmarcException('Connection closed by DNS server'))
+        except (OSError, DmarcException) as exn:
+            self._close(exn)
+
+    def _check_idle(self):
+        if self.error is not None:
+            return
+        idle = self.loop.time() - self.last_used
+        if not self.pending and idle >= self.idle_timeout:
+            self._close(DmarcException('Idle connection closed'))
+        else:
+            self._idle_check = self.loop.call_later(
+                max(self.idle_timeout - idle, 1), self._check_idle)
+
+    async def close(self):
+        '''
+        Close the connection and wait for the reader task to finish.
+        '''
+        import asyncio
+        self._close(DmarcException('Connection closed'))
+        self._reader.cancel()
+        try:
+            await self._reader
+        except asyncio.CancelledError:
+            pass
+
+    def _close(self, exn):
+        if self.error is not None:
+            return
+        self.error = exn
+        self._idle_check.cancel()
+        self.writer.close()
+        for future, qname, qtype in self.pending.values():
+            if not future.done():
+                future.set_exception(exn)
+
+
+class ResolverPool:
+    '''
+    Sends the queries of query_txt and async_query_txt to a list of
+    nameservers, keeping track of the health and round-trip time of each.
+
+    Healthy servers are tried fastest first. Each try times out after a
+    few RTTs of its server rather than after the whole timeout, so a lost
+    packet is retried quickly; the last try gets whatever time is left.
+    Servers that fail FAILURES_BEFORE_DOWN times in a row are skipped for
+    an exponentially growing time, unless all servers are down. A try is
+    made at most attempts times, or once per server if there are more
+    servers, sleeping for a random fraction of an exponentially growing
+    backoff after a server answers with an error.
+
+    If hedge is true and a server has not answered after the 95th
+    percentile of its recent RTTs, the query is also sent to the next
+    server (or again to the same one) and the first answer wins.
+
+    Truncated answers are retried over one persistent TCP connection per
+    server, shared by concurrent queries.
+    '''
+
+    def __init__(self, hedge=False, attempts=4, backoff=0.05,
+                 tcp_idle_timeout=TCP_IDLE_TIMEOUT):
+        self.hedge = hedge
+        self.attempts = attempts
+        self.backoff = backoff
+        self.tcp_idle_timeout = tcp_idle_timeout
+        self._lock = threading.Lock()
+        self._servers = {}
+        self._tcp = {}
+        self._async_tcp = {}
+
+    def _state(self, server):
+        try:
+            return self._servers[server]
+        except KeyError:
+            with self._lock:
+                return self._servers.setdefault(server, _ServerState())
+
+    def stats(self):
+        '''
+        Returns a dict mapping "host:port" of each server queried so far to
+        its smoothed RTT, current timeout, consecutive failures and whether
+        it is up, with times in seconds.
+        '''
+        now = time.monotonic()
+        with self._lock:
+            servers = list(self._servers.items())
+        return {
+            '%s:%d' % server: {
+                'srtt': state.srtt,
+                'timeout': state.timeout(),
+                'failures': state.failures,
+                'up': now >= state.down_until,
+            }
+            for server, state in servers
+        }
+
+    def after_fork(self):
+        # The reader threads of the connections only exist in the parent.
+        self._lock = threading.Lock()
+        self._tcp = {}
+        self._async_tcp = {}
+
+    async def async_close(self):
+        '''
+        Close the TCP connections of async_query_txt on the running event
+        loop, e.g. before closing the loop.
+        '''
+        import asyncio
+        loop = asyncio.get_event_loop()
+        for server, conn in list(self._async_tcp.items()):
+            if conn.loop is loop:
+                del self._async_tcp[server]
+                await conn.close()
+
+    def _order(self, nameservers):
+        # The servers that are up, fastest first, or all of them if none
+        # are up.
+        now = time.monotonic()
+        states = [self._state(s) for s in nameservers]
+        up = [i for i, state in enumerate(states)
+              if now >= state.down_until] or range(len(states))
+
+        def key(i):
+            state = states[i]
+            return (state.srtt is None, state.srtt or 0, i)
+
+        return [nameservers[i] for i in sorted(up, key=key)]
+
+    def _record(self, server, rtt=None, timed_out=False):
+        state = self._state(server)
+        with self._lock:
+            if rtt is None:
+                state.failure(time.monotonic(), timed_out)
+            else:
+                state.success(rtt)
+
+    def _tries(self, nameservers):
+        # Yields (server, hedge server) for each try.
+        servers = self._order(nameservers)
+        n = len(servers)
+        for attempt in range(max(self.attempts, n)):
+            server = servers[attempt % n]
+            if self.hedge:
+                yield server, servers[(attempt + 1) % n]
+            else:
+                yield server, None
+
+    def _try_timeout(self, server, remaining, last):
+        if last:
+            return remaining
+        return min(self._state(server).timeout(), remaining)
+
+    def _backoff_delay(self, retries):
+        return random.uniform(0, self.backoff * 2 ** retries)
+
+    def query_txt(self, domain, timeout, nameservers):
+        deadline = time.monotonic() + timeout
+        errors = []
+        tries = list(self._tries(nameservers))
+        for i, (server, hedge_server) in enumerate(tries):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if i:
+                increment('dns_retries')
+            try:
+                server, message = self.query(
+                    server, domain, dnswire.TYPE_TXT,
+                    self._try_timeout(server, remaining, i + 1 == len(tries)),
+                    hedge_server)
+            except socket.timeout:
+                errors.append('%s timed out' % (server[0],))
+                continue
+            except (OSError, DmarcException) as exn:
+                errors.append('%s: %s' % (server[0], exn))
+            else:
+                if message.rcode in (dnswire.RCODE_NOERROR,
+                                     dnswire.RCODE_NXDOMAIN):
+                    return dnswire.get_txt_answer(message, domain)
+                errors.append(_rcode_error(server, message))
+            if i + 1 < len(tries):
+                time.sleep(min(self._backoff_delay(i),
+                               max(deadline - time.monotonic(), 0)))
+        raise _lookup_error(domain, errors)
+
+    def query(self, server, domain, qtype, timeout, hedge_server=None):
+        '''
+        Send a single query to server, and to hedge_server if server is
+        slow to answer. Returns (server that answered, response).
+
+        Falls back to TCP if the UDP response is truncated and retries
+        without EDNS if the server does not support it.
+        '''
+        qname = dnswire.normalize_name(domain)
+        deadline = time.monotonic() + timeout
+        edns = True
+        while True:
+            qid = _new_query_id()
+            packet = dnswire.encode_query(qid, domain, qtype, edns)
+            server, message = self._query_udp(
+                server, hedge_server, packet, qid, qname, qtype,
+                deadline - time.monotonic())
+            if message.flags & dnswire.FLAG_TC:
+                logger.debug('Truncated response for %r, retrying over TCP',
+                             domain)
+                message = self._query_tcp(server, packet, qid, qname, qtype,
+                                          deadline - time.monotonic())
+            if message.rcode == dnswire.RCODE_FORMERR and edns:
+                edns = False
+                hedge_server = None
+                continue
+            return server, message
+
+    def _query_udp(self, server, hedge_server, packet, qid, qname, qtype,
+                   timeout):
+        start = time.monotonic()
+        deadline = start + timeout
+        hedge_at = None
+        if hedge_server is not None:
+            hedge_at = start + self._state(server).hedge_delay()
+            if hedge_at >= deadline:
+                hedge_at = None
+        selector = selectors.DefaultSelector()
+        sent = {}
+        error = None
+
+        def send(server):
+            sock = socket.socket(_family(server[0]), socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sent[sock] = server, time.monotonic()
+            selector.register(sock, selectors.EVENT_READ)
+            sock.connect(server)
+            sock.send(packet)
+
+        try:
+            send(server)
+            while sent or hedge_at is not None:
+                now = time.monotonic()
+                if hedge_at is not None and now >= hedge_at:
+                    increment('dns_hedges')
+                    send(hedge_server)
+                    hedge_at = None
+                if now >= deadline:
+                    break
+                for key, events in selector.select(
+                        min(deadline, hedge_at or deadline) - now):
+                    sock = key.fileobj
+                    try:
+                        data = sock.recv(65535)
+                    except BlockingIOError:
+                        continue
+                    except OSError as exn:
+                        # E.g. ICMP port unreachable.
+                        error = exn
+                        self._record(sent.pop(sock)[0])
+                        selector.unregister(sock)
+                        sock.close()
+                        continue
+                    try:
+                        message = dnswire.decode_message(data)
+                    except DmarcException:
+                        # Could be a stray or spoofed packet; keep waiting.
+                        continue
+                    if _is_response_to(message, qid, qname, qtype):
+                        answered, sent_time = sent[sock]
+                        self._record(answered, time.monotonic() - sent_time)
+                        return answered, message
+                if not sent and hedge_at is not None:
+                    # The first server failed before it was time to hedge.
+                    hedge_at = time.monotonic()
+            if not sent:
+                raise error
+            for answered, sent_time in sent.values():
+                self._record(answered, timed_out=True)
+            raise socket.timeout()
+        finally:
+            for sock in sent:
+                sock.close()
+            selector.close()
+
+    def _query_tcp(self, server, packet, qid, qname, qtype, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                conn = self._tcp.get(server)
+            reused = conn is not None and conn.error is None
+            if not reused:
+                # The UDP try may have used up the time, and
+                # create_connection rejects a timeout that is not positive.
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout()
+                conn = _TcpConnection(server, remaining,
+                                      self.tcp_idle_timeout)
+                with self._lock:
+                    self._tcp[server] = conn
+            try:
+                return conn.query(packet, qid, qname, qtype,
+                                  deadline - time.monotonic())
+            except (OSError, DmarcException):
+                # The server may have closed a connection that had been
+                # idle; try once more on a new one.
+                if not reused or conn.error is None:
+                    raise
+                reused = False
+                if deadline <= time.monotonic():
+                    raise
+
+    async def async_query_txt(self, domain, timeout, nameservers):
+        import asyncio
+        deadline = time.monotonic() + timeout
+        errors = []
+        tries = list(self._tries(nameservers))
+        for i, (server, hedge_server) in enumerate(tries):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if i:
+                increment('dns_retries')
+            try:
+                server, message = await self.async_query(
+                    server, domain, dnswire.TYPE_TXT,
+                    self._try_timeout(server, remaining, i + 1 == len(tries)),
+                    hedge_server)
+            except socket.timeout:
+                errors.append('%s timed out' % (server[0],))
+                continue
+            except (OSError, DmarcException) as exn:
+                errors.append('%s: %s' % (server[0], exn))
+            else:
+                if message.rcode in (dnswire.RCODE_NOERROR,
+                                     dnswire.RCODE_NXDOMAIN):
+                    return dnswire.get_txt_answer(message, domain)
+                errors.append(_rcode_error(server, message))
+            if i + 1 < len(tries):
+                await asyncio.sleep(min(self._backoff_delay(i),
+                                        max(deadline - time.monotonic(), 0)))
+        raise _lookup_error(domain, errors)
+
+    async def async_query(self, server, domain, qtype, timeout,
+                          hedge_server=None):
+        '''
+        Coroutine version of query.
+        '''
+        qname = dnswire.normalize_name(domain)
+        deadline = time.monotonic() + timeout
+        edns = True
+        while True:
+            qid = _new_query_id()
+            packet = dnswire.encode_query(qid, domain, qtype, edns)
+            server, message = await self._async_query_udp(
+                server, hedge_server, packet, qid, qname, qtype,
+                deadline - time.monotonic())
+            if message.flags & dnswire.FLAG_TC:
+                logger.debug('Truncated response for %r, retrying over TCP',
+                             domain)
+                message = await self._async_query_tcp(
+                    server, packet, qid, qname, qtype,
+                    deadline - time.monotonic())
+            if message.rcode == dnswire.RCODE_FORMERR and edns:
+                edns = False
+                hedge_server = None
+                continue
+            return server, message
+
+    async def _async_query_udp(self, server, hedge_server, packet, qid,
+                               qname, qtype, timeout):
+        import asyncio
+        deadline = time.monotonic() + timeout
+        tasks = {}
+
+        def send(server):
+            task = asyncio.ensure_future(
+                _async_query_udp(server, packet, qid, qname, qtype))
+            tasks[task] = server, time.monotonic()
+
+        try:
+            send(server)
+            if hedge_server is not None:
+                delay = self._state(server).hedge_delay()
+                if delay < timeout:
+                    done, _ = await asyncio.wait(list(tasks), timeout=delay)
+                    # Hedge when the server is slow, or as soon as it
+                    # fails, like _query_udp.
+                    if not done or next(iter(done)).exception() is not None:
+                        increment('dns_hedges')
+                        send(hedge_server)
+            error = None
+            while tasks:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, _ = await asyncio.wait(
+                    list(tasks), timeout=remaining,
+                    return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    answered, sent_time = tasks.pop(task)
+                    if task.exception() is None:
+                        self._record(answered, time.monotonic() - sent_time)
+                        return answered, task.result()
+                    error = task.exception()
+                    self._record(answered)
+            if not tasks:
+                raise error
+            for answered, sent_time in tasks.values():
+                self._record(answered, timed_out=True)
+            raise socket.timeout()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _async_query_tcp(self, server, packet, qid, qname, qtype,
+                               timeout):
+        import asyncio
+        loop = asyncio.get_event_loop()
+        deadline = time.monotonic() + timeout
+        while True:
+            conn = self._async_tcp.get(server)
+            reused = (conn is not None and conn.loop is loop and
+                      conn.error is None)
+            if not reused:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout()
+                try:
+                    reader, writer = await asyncio.wait_for(
+                        asyncio.open_connection(*server), remaining)
+                except asyncio.TimeoutError:
+                    raise socket.timeout()
+                conn = _AsyncTcpConnection(loop, reader, writer,
+                                           self.tcp_idle_timeout)
+                self._async_tcp[server] = conn
+            try:
+                return await asyncio.wait_for(
+                    conn.query(packet, qid, qname, qtype),
+                    deadline - time.monotonic())
+            except asyncio.TimeoutError:
+                raise socket.timeout()
+            except (OSError, DmarcException):
+                if not reused or conn.error is None:
+                    raise
+                reused = False
+                if deadline <= time.monotonic():
+                    raise
+
+
+def get_resolver_pool():
+    try:
+        return get_resolver_pool._value
+    except AttributeError:
+        pass
+    pool = get_resolver_pool._value = ResolverPool()
+    return pool
+
+
+def set_resolver_pool(pool):
+    '''
+    Replace the ResolverPool used by the native resolver, e.g. to enable
+    hedging with set_resolver_pool(ResolverPool(hedge=True)).
+    '''
+    get_resolver_pool._value = pool
+
+
+def _after_fork_in_child():
+    try:
+        pool = get_resolver_pool._value
+    except AttributeError:
+        return
+    pool.after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def query(server, domain, qtype, timeout):
+    '''
+    Send a single query to server and return the decoded response.
+
+    Falls back to TCP if the UDP response is truncated and retries without
+    EDNS if the server does not support it.
+    '''
+    return get_resolver_pool().query(server, domain, qtype, timeout)[1]
+
+
+def _rcode_error(server, message):
+    return '%s returned %s' % (
+        server[0], dnswire.RCODE_NAMES.get(message.rcode, message.rcode))
+
+
+def _lookup_error(domain, errors):
+    if not errors:
+        return DmarcException('Timed out while looking up %r' % (domain,))
+    return DmarcException('Could not look up %r: %s' %
+                          (domain, '; '.join(errors)))
+
+
+def query_txt(domain, timeout=3, nameservers=None):
+    '''
+    Look up the TXT records of domain.
+
+    Returns (records, ttl) as described in dnswire.get_txt_answer.
+    The nameservers are queried as described in ResolverPool.
+    '''
+    if nameservers is None:
+        nameservers = get_nameservers()
+    return get_resolver_pool().query_txt(domain, timeout, nameservers)
+
+
+class _DatagramProtocol:
+    # Implements asyncio.DatagramProtocol without subclassing it, so that
+    # asyncio is only imported by the coroutine lookups.
+
+    def __init__(self, qid, qname, qtype):
+        import asyncio
+        self.qid = qid
+        self.qname = qname
+        self.qtype = qtype
+        self.future = asyncio.get_event_loop().create_future()
+
+    def connection_made(self, transport):
+        pass
+
+    def pause_writing(self):
+        pass
+
+    def resume_writing(self):
+        pass
+
+    def datagram_received(self, data, addr):
+        if self.future.done():
+            return
+        try:
+            message = dnswire.decode_message(data)
+        except DmarcException:
+            # Could be a stray or spoofed packet; keep waiting.
+            return
+        if _is_response_to(message, self.qid, self.qname, self.qtype):
+            self.future.set_result(message)
+
+    def error_received(self, exn):
+        if not self.future.done():
+            self.future.set_exception(exn)
+
+    def connection_lost(self, exn):
+        if not self.future.done():
+            self.future.set_exception(
+                exn or DmarcException('Connection closed'))
+
+
+async def _async_query_udp(server, packet, qid, qname, qtype):
+    import asyncio
+    loop = asyncio.get_event_loop()
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: _DatagramProtocol(qid, qname, qtype),
+        remote_addr=server, family=_family(server[0]))
+    try:
+        transport.sendto(packet)
+        return await protocol.future
+    finally:
+        transport.close()
+
+
+async def async_query(server, domain, qtype, timeout):
+    '''
+    Coroutine version of query.
+    '''
+    server, message = await get_resolver_pool().async_query(
+        server, domain, qtype, timeout)
+    return message
+
+
+async def async_query_txt(domain, timeout=3, nameservers=None):
+    '''
+    Coroutine version of query_txt.
+    '''
+    if nameservers is None:
+        nameservers = get_nameservers()
+    return await get_resolver_pool().async_query_txt(
+        domain, timeout, nameservers)
@@ -0,0 +1,298 @@
+'''
+A long-running lookup service, so that many short-lived processes on a host
+can share one warm DNS cache and public suffix list.
+
+Clients connect over a Unix or TCP socket and may use either protocol on
+any connection:
+
+- The Postfix policy delegation protocol: name=value attributes ending
+  with an empty line. The DMARC policy of the sender domain is returned as
+  "action=PREPEND X-DMARC-Policy: <policy>; domain=<record domain>", or
+  "action=DUNNO" if there is no policy or the lookup fails.
+- JSON lines: {"id": ..., "method": ..., "domain": ...}, where method is
+  get_dmarc_policy (the default), get_dmarc_record or stats. Each request
+  is answered by {"id": ..., "result": ...} or {"id": ..., "error": ...}.
+  Records are returned as by DmarcRecord.as_dict.
+
+Requests on one connection are looked up concurrently and answered in the
+order they were received. See client.PolicyClient for a client.
+'''
+
+import os
+import json
+import stat
+import signal
+import socket
+import asyncio
+import logging
+
+from dmarc_policy_parser.dmarc import (
+    async_get_dmarc_record, get_parsed_record_cache_stats, _effective_policy,
+)
+from dmarc_policy_parser.dns import get_dns_cache_stats
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.public_suffix import get_public_suffix_trie
+from dmarc_policy_parser.resolver import get_resolver_pool
+
+
+logger = logging.getLogger('dmarc_policy_parser')
+
+_DUNNO = b'action=DUNNO\n\n'
+
+
+def parse_address(s):
+    '''
+    Parse a socket address: a path (optionally prefixed by "unix:") for a
+    Unix socket, or "host:port" or "[IPv6 address]:port" for TCP.
+    Returns the path or a (host, port) pair.
+    '''
+    if s.startswith('unix:'):
+        return s[5:]
+    if s.startswith('['):
+        host, _, port = s[1:].partition(']')
+        return host, int(port.lstrip(':'))
+    if s.startswith(('/', '.')) or s.count(':') != 1:
+        return s
+    host, port = s.split(':')
+    return host, int(port)
+
+
+class PolicyServer:
+    '''
+    Serves DMARC lookups over the protocols described in the module
+    documentation.
+
+    All connections share the DNS cache, the parsed record cache and the
+    public suffix list of the process. At most concurrency DNS queries run
+    at a time, while lookups answered from the cache are not limited, and
+    each connection has at most pipeline requests in flight before the
+    server stops reading from it.
+
+    Lookups run on the event loop, so enable
+    set_public_suffix_background_refresh to keep them from waiting for
+    downloads of the public suffix list.
+    '''
+
+    def __init__(self, concurrency=64, timeout=3, pipeline=128,
+                 header='X-DMARC-Policy'):
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.pipeline = pipeline
+        self.header = header
+        self._semaphore = None
+        self._servers = []
+        self._paths = []
+        # Writer of each open connection -> Event set when it is closed.
+        self._connections = {}
+
+    async def start(self, addresses):
+        '''
+        Load the public suffix list and start listening on each address,
+        as returned by parse_address.
+        '''
+        loop = asyncio.get_event_loop()
+        self._semaphore = asyncio.Semaphore(self.concurrency)
+        await loop.run_in_executor(None, get_public_suffix_trie)
+        for address in addresses:
+            if isinstance(address, str):
+                _remove_stale_socket(address)
+                server = await asyncio.start_unix_server(
+                    self._handle, address)
+                self._paths.append(address)
+            else:
+                host, port = address
+                server = await asyncio.start_server(self._handle, host, port)
+            self._servers.append(server)
+            logger.info('Listening on %s', address)
+
+    def close(self):
+        '''
+        Stop listening and close all connections once their pending
+        requests have been answered.
+        '''
+        for server in self._servers:
+            server.close()
+        for writer in list(self._connections):
+            # The reader of the connection then sees the end of the stream.
+            writer.close()
+        for path in self._paths:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._paths = []
+
+    async def wait_closed(self):
+        for server in self._servers:
+            await server.wait_closed()
+        self._servers = []
+        for closed in list(self._connections.values()):
+            await closed.wait()
+
+    async def lookup(self, domain):
+        # The semaphore bounds the DNS queries in flight, so that answers
+        # from the cache never wait behind slow queries.
+        return await async_get_dmarc_record(domain, timeout=self.timeout,
+                                            semaphore=self._semaphore)
+
+    async def _handle(self, reader, writer):
+        responses = asyncio.Queue(self.pipeline)
+        writer_task = asyncio.ensure_future(
+            _write_responses(responses, writer))
+        attributes = {}
+        closed = self._connections[writer] = asyncio.Event()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf8', 'replace').rstrip('\r\n')
+                if not attributes and line.startswith('{'):
+                    coro = self._json_request(line)
+                elif line:
+                    name, sep, value = line.partition('=')
+                    if sep:
+                        attributes[name] = value
+                    continue
+                elif attributes:
+                    coro = self._postfix_request(attributes)
+                    attributes = {}
+                else:
+                    continue
+                await responses.put(asyncio.ensure_future(coro))
+        except (ConnectionError, ValueError) as exn:
+            # ValueError: a line longer than the limit of the reader.
+            logger.debug('Dropping connection: %s', exn)
+        finally:
+            await responses.put(None)
+            await writer_task
+            writer.close()
+            del self._connections[writer]
+            closed.set()
+
+    async def _postfix_request(self, attributes):
+        sender = attributes.get('sender', '')
+        if '@' not in sender:
+            # The null sender of bounces, or a local sender.
+            return _DUNNO
+        domain = sender.rpartition('@')[2].rstrip('.').lower()
+        try:
+            record = await self.lookup(domain)
+        except (DmarcException, ValueError) as exn:
+            logger.info('Could not look up %r: %s', domain, exn)
+            return _DUNNO
+        policy = _effective_policy(domain, record)
+        if policy is None or not self.header:
+            return _DUNNO
+        return ('action=PREPEND %s: %s; domain=%s\n\n' % (
+            self.header, policy, record.domain)).encode('utf8')
+
+    async def _json_request(self, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            request = None
+        if not isinstance(request, dict):
+            return _json_response(None, error='Invalid request')
+        request_id = request.get('id')
+        method = request.get('method', 'get_dmarc_policy')
+        if method == 'stats':
+            return _json_response(request_id, {
+                'dns_cache': get_dns_cache_stats(),
+                'parsed_record_cache': get_parsed_record_cache_stats(),
+            })
+        if method not in ('get_dmarc_policy', 'get_dmarc_record'):
+            return _json_response(
+                request_id, error='Unknown method %r' % (method,))
+        domain = request.get('domain')
+        if not isinstance(domain, str):
+            return _json_response(request_id, error='Missing domain')
+        try:
+            record = await self.lookup(domain)
+        except (DmarcException, ValueError) as exn:
+            return _json_response(request_id, error=str(exn))
+        if method == 'get_dmarc_policy':
+            return _json_response(
+                request_id, _effective_policy(domain, record))
+        return _json_response(
+            request_id, None if record is None else record.as_dict())
+
+
+def _json_response(request_id, result=None, error=None):
+    response = {'id': request_id}
+    if error is None:
+        response['result'] = result
+    else:
+        response['error'] = error
+    return (json.dumps(response) + '\n').encode('utf8')
+
+
+async def _write_responses(responses, writer):
+    # Answer in the order of the requests. Keep consuming responses after
+    # the client goes away so that the reading side never blocks.
+    connected = True
+    while True:
+        future = await responses.get()
+        if future is None:
+            break
+        try:
+            data = await future
+        except Exception:
+            logger.exception('Request failed; dropping the connection')
+            connected = False
+            writer.close()
+        if not connected:
+            continue
+        try:
+            writer.write(data)
+            await writer.drain()
+        except ConnectionError:
+            connected = False
+            writer.close()
+
+
+def _remove_stale_socket(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        return
+    sock = socket.socket(socket.AF_UNIX)
+    try:
+        sock.connect(path)
+    except ConnectionRefusedError:
+        # Left behind by a server that is no longer running.
+        os.unlink(path)
+    except OSError:
+        pass
+    else:
+        raise DmarcException('Another server is listening on %s' % (path,))
+    finally:
+        sock.close()
+
+
+def serve(addresses, **kwargs):
+    '''
+    Run a PolicyServer on addresses until interrupted. Any keyword
+    arguments are passed to PolicyServer.
+    '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = PolicyServer(**kwargs)
+    try:
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, loop.stop)
+    except NotImplementedError:
+        # Windows: rely on KeyboardInterrupt.
+        pass
+    try:
+        loop.run_until_complete(server.start(addresses))
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.run_until_complete(get_resolver_pool().async_close())
+        loop.close()
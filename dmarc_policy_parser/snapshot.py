@@ -0,0 +1,135 @@
+'''
+Snapshots of the DNS cache and the public suffix list, so that new hosts
+can start with the cache of a warm one.
+
+A snapshot is a gzip-compressed JSON Lines file. The first line is a
+header: {"format": SNAPSHOT_FORMAT, "version": SNAPSHOT_VERSION,
+"created": time, "public_suffix_list": {"mtime", "data", "compiled"} or
+null}, where data is the list and compiled is its base64-encoded marshal
+snapshot. Every other line is one [domain, result, time, ttl] entry of the
+DNS cache.
+
+The compiled list is loaded with marshal, so only import snapshots from
+hosts you trust.
+'''
+
+import os
+import time
+import gzip
+import json
+import base64
+import logging
+
+from dmarc_policy_parser.dns import get_dns_cache, get_memory_cache
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.files import open_temporary
+from dmarc_policy_parser.public_suffix import (
+    export_public_suffixes, import_public_suffixes,
+)
+
+
+logger = logging.getLogger('dmarc_policy_parser')
+
+SNAPSHOT_FORMAT = 'dmarc_policy_parser cache snapshot'
+# Bump when the format changes incompatibly.
+SNAPSHOT_VERSION = 1
+
+
+def _get_snapshot_cache():
+    cache = get_dns_cache()
+    if not hasattr(cache, 'items') or not hasattr(cache, 'merge'):
+        raise DmarcException('The DNS cache %r does not support snapshots'
+                             % (cache,))
+    return cache
+
+
+def export_cache_snapshot(filename, max_age=24*3600,
+                          public_suffix_list=True):
+    '''
+    Write the entries of the persistent DNS cache that are less than
+    max_age seconds old, and unless public_suffix_list is false the public
+    suffix list, to a snapshot in filename. Returns the number of entries
+    written.
+    '''
+    cache = _get_snapshot_cache()
+    now = time.time()
+    header = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'created': now,
+        'public_suffix_list': None,
+    }
+    psl = export_public_suffixes() if public_suffix_list else None
+    if psl is not None:
+        data, compiled, mtime = psl
+        header['public_suffix_list'] = {
+            'mtime': mtime,
+            'data': data.decode('utf8'),
+            'compiled': (None if compiled is None else
+                         base64.b64encode(compiled).decode('ascii')),
+        }
+    count = 0
+    fp, tmp_filename = open_temporary(filename, 'wb')
+    try:
+        with fp, gzip.GzipFile(fileobj=fp, mode='wb') as gz:
+            gz.write(json.dumps(header).encode('utf8') + b'\n')
+            for entry in cache.items():
+                if max_age is not None and now - entry[2] >= max_age:
+                    continue
+                gz.write(json.dumps(entry).encode('utf8') + b'\n')
+                count += 1
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.unlink(tmp_filename)
+        raise
+    logger.info('Exported %d DNS cache entries to %s', count, filename)
+    return count
+
+
+def _read_entries(lines, now, max_age):
+    for line in lines:
+        domain, result, cached_time, ttl = json.loads(line.decode('utf8'))
+        if max_age is not None and now - cached_time >= max_age:
+            continue
+        yield domain, result, cached_time, ttl
+
+
+def import_cache_snapshot(filename, max_age=24*3600,
+                          public_suffix_list=True):
+    '''
+    Merge a snapshot written by export_cache_snapshot into the persistent
+    DNS cache. An entry is only imported if it is less than max_age seconds
+    old and newer than the cached entry for its domain. Unless
+    public_suffix_list is false, the public suffix list of the snapshot is
+    installed if it is newer than the one in use.
+
+    Returns a dict with the number of DNS cache entries "imported" and
+    whether the "public_suffix_list" was installed.
+    '''
+    cache = _get_snapshot_cache()
+    with gzip.open(filename, 'rb') as fp:
+        try:
+            header = json.loads(fp.readline().decode('utf8'))
+            snapshot_format = header['format']
+            version = header['version']
+        except (OSError, EOFError, ValueError, TypeError, KeyError):
+            snapshot_format = version = None
+        if snapshot_format != SNAPSHOT_FORMAT:
+            raise DmarcException('%s is not a cache snapshot' % (filename,))
+        if version != SNAPSHOT_VERSION:
+            raise DmarcException(
+                'Unsupported cache snapshot version %r in %s' %
+                (version, filename))
+        imported = cache.merge(_read_entries(fp, time.time(), max_age))
+    # Entries cached in memory may be older than the imported ones.
+    get_memory_cache().clear()
+    psl = header['public_suffix_list']
+    installed = False
+    if public_suffix_list and psl is not None:
+        compiled = psl['compiled']
+        installed = import_public_suffixes(
+            psl['data'].encode('utf8'),
+            None if compiled is None else base64.b64decode(compiled),
+            psl['mtime'])
+    logger.info('Imported %d DNS cache entries from %s', imported, filename)
+    return {'imported': imported, 'public_suffix_list': installed}
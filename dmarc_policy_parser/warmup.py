@@ -0,0 +1,77 @@
+'''
+Load everything a lookup needs up front, for servers that fork workers.
+
+Importing dmarc_policy_parser is cheap, and the public suffix list and the
+DNS cache are read on first use. That suits scripts, but in a pre-fork
+server every worker would then repeat the work and keep its own copy of
+the data. preload does it once in the parent instead, so that the workers
+start warm and share the pages of the parent copy-on-write.
+'''
+
+import gc
+import time
+import heapq
+import importlib
+
+import dmarc_policy_parser
+from dmarc_policy_parser.dns import (
+    get_dns_cache, get_memory_cache, get_txt_source,
+)
+from dmarc_policy_parser.public_suffix import get_public_suffix_trie
+
+
+def _load_memory_cache(max_age):
+    # Copy the newest usable entries of the persistent DNS cache into the
+    # memory cache, as _get_cached would on a hit. Returns their number.
+    cache = get_dns_cache()
+    if not hasattr(cache, 'items'):
+        return 0
+    memory_cache = get_memory_cache()
+    now = time.time()
+
+    def usable_entries():
+        for domain, result, cached_time, ttl in cache.items():
+            ttl = memory_cache.get_ttl(result, ttl, max_age)
+            usable, stale = memory_cache.is_usable(cached_time, ttl, now,
+                                                   max_age)
+            if usable:
+                yield cached_time, domain, result, ttl
+
+    entries = heapq.nlargest(memory_cache.max_entries, usable_entries())
+    # Oldest first, so that the newest entries are the last to be evicted.
+    for cached_time, domain, result, ttl in reversed(entries):
+        memory_cache.set(domain, result, cached_time, ttl)
+    # Do not hand an open database connection to the workers.
+    if hasattr(cache, 'close'):
+        cache.close()
+    return len(entries)
+
+
+def preload(memory_cache=True, max_age=24*3600, freeze=True):
+    '''
+    Import all subsystems, load the public suffix list and, unless
+    memory_cache is false, copy the DNS cache entries less than max_age
+    seconds old into the in-memory cache (newest first, up to its
+    max_entries). Call it in the parent of a pre-fork server before it
+    starts its workers.
+
+    If freeze is true, the garbage collector then moves every object into
+    its permanent generation (gc.freeze, Python 3.7+), so that collections
+    in the workers do not write to, and so copy, the pages holding them.
+    The workers should not call preload again.
+
+    Returns a dict with the number of "modules" imported, the DNS cache
+    "entries" loaded and the number of objects "frozen".
+    '''
+    counts = {'modules': 0, 'entries': 0, 'frozen': 0}
+    for module in sorted(set(dmarc_policy_parser._EXPORTS.values())):
+        importlib.import_module('dmarc_policy_parser.' + module)
+        counts['modules'] += 1
+    get_public_suffix_trie()
+    if memory_cache and get_txt_source() is None:
+        counts['entries'] = _load_memory_cache(max_age)
+    if freeze and hasattr(gc, 'freeze'):
+        gc.collect()
+        gc.freeze()
+        counts['frozen'] = gc.get_freeze_count()
+    return counts
@@ -23,10 +23,10 @@ setup(
         'Intended Audience :: Developers',
 
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.4',
         'Programming Language :: Python :: 3.5',
         'Programming Language :: Python :: 3.6',
     ],
 
+    python_requires='>=3.5',
     packages=find_packages(include=['dmarc_policy_parser']),
 )
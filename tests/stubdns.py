@@ -0,0 +1,263 @@
+'''
+A stub DNS server for the tests and the benchmarks, answering over UDP and
+TCP from a zone held in memory.
+
+Both servers run in threads of the test process and share one Zone, so
+tests can change the zone and count the queries each transport received.
+The benchmarks run them in a child process instead, so that the server
+does not compete with the code being measured for the GIL.
+'''
+
+import time
+import random
+import socket
+import struct
+import threading
+import socketserver
+import multiprocessing
+
+from dmarc_policy_parser import dnswire
+from dmarc_policy_parser.exceptions import DmarcException
+
+
+_HEADER = struct.Struct('!HHHHHH')
+_RR_HEADER = struct.Struct('!HHIH')
+_TCP_LENGTH = struct.Struct('!H')
+
+TTL = 600
+SOA_TTL = 900
+SOA_MINIMUM = 120
+
+# The payload size of a UDP response without EDNS [RFC 1035, Sec. 4.2.1].
+UDP_PAYLOAD_SIZE = 512
+
+
+def txt_rdata(strings):
+    '''
+    Encode a TXT record given as one string, split into character-strings
+    of at most 255 bytes, or as a list of character-strings.
+    '''
+    if isinstance(strings, str):
+        data = strings.encode('utf8')
+        chunks = [data[i:i + 255] for i in range(0, len(data), 255)]
+    else:
+        chunks = [s.encode('utf8') for s in strings]
+    return b''.join(bytes((len(c),)) + c for c in chunks or [b''])
+
+
+def resource_record(name, rtype, ttl, rdata):
+    return (dnswire.encode_name(name) +
+            _RR_HEADER.pack(rtype, dnswire.CLASS_IN, ttl, len(rdata)) +
+            rdata)
+
+
+def soa_record(zone='example.', ttl=SOA_TTL, minimum=SOA_MINIMUM):
+    rdata = (dnswire.encode_name('ns.' + zone) +
+             dnswire.encode_name('hostmaster.' + zone) +
+             struct.pack('!IIIII', 1, 3600, 600, 86400, minimum))
+    return resource_record(zone, dnswire.TYPE_SOA, ttl, rdata)
+
+
+def message(qid, flags, question, answers=(), authority=()):
+    '''
+    Encode a response to question, a (name, type) pair.
+    '''
+    qname, qtype = question
+    return (_HEADER.pack(qid, dnswire.FLAG_QR | flags, 1, len(answers),
+                         len(authority), 0) +
+            dnswire.encode_name(qname) +
+            struct.pack('!HH', qtype, dnswire.CLASS_IN) +
+            b''.join(answers) + b''.join(authority))
+
+
+class Zone:
+    '''
+    txt maps names to lists of TXT records, each a string or a list of
+    character-strings, and cname maps names to their target. Names in
+    servfail are answered with SERVFAIL and unknown names with NXDOMAIN.
+    UDP responses are truncated if they exceed udp_payload_size or the
+    name is in truncate. delay maps names to the seconds to wait before
+    answering, and a fraction loss of the UDP queries is dropped.
+    '''
+
+    def __init__(self, txt=None, loss=0, seed=1):
+        self.txt = dict(txt or {})
+        self.cname = {}
+        self.servfail = set()
+        self.truncate = set()
+        self.delay = {}
+        self.loss = loss
+        self.udp_payload_size = UDP_PAYLOAD_SIZE
+        self.queries = {'udp': 0, 'tcp': 0}
+        self.lock = threading.Lock()
+        self._rng = random.Random(seed)
+
+    def __getstate__(self):
+        # For StubServer(process=True) where processes are spawned.
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def answer(self, packet, transport):
+        '''
+        Returns the response to packet, or None to drop it.
+        '''
+        if transport == 'udp' and self.loss:
+            with self.lock:
+                if self._rng.random() < self.loss:
+                    return None
+        query = dnswire.decode_message(packet)
+        qname, qtype, qclass = query.question
+        with self.lock:
+            self.queries[transport] += 1
+        if qname in self.delay:
+            time.sleep(self.delay[qname])
+        flags = dnswire.FLAG_RD | 0x0080  # RA
+        answers = []
+        authority = []
+        name = qname
+        while name in self.cname:
+            target = self.cname[name]
+            answers.append(resource_record(
+                name, dnswire.TYPE_CNAME, TTL, dnswire.encode_name(target)))
+            name = target
+        if name in self.servfail:
+            flags |= dnswire.RCODE_SERVFAIL
+        elif name in self.txt:
+            for strings in self.txt[name]:
+                answers.append(resource_record(
+                    name, dnswire.TYPE_TXT, TTL, txt_rdata(strings)))
+            if not self.txt[name]:
+                authority.append(soa_record())
+        else:
+            flags |= dnswire.RCODE_NXDOMAIN
+            authority.append(soa_record())
+        response = message(query.id, flags, (qname, qtype), answers,
+                           authority)
+        if transport == 'udp' and (len(response) > self.udp_payload_size or
+                                   qname in self.truncate):
+            response = message(query.id, flags | dnswire.FLAG_TC,
+                               (qname, qtype))
+        return response
+
+
+class _UdpHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        packet, sock = self.request
+        try:
+            response = self.server.zone.answer(packet, 'udp')
+        except DmarcException:
+            return
+        if response is not None:
+            sock.sendto(response, self.client_address)
+
+
+class _TcpHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        # Answer queries until the client closes the connection.
+        while True:
+            header = self._recv(_TCP_LENGTH.size)
+            if header is None:
+                return
+            length, = _TCP_LENGTH.unpack(header)
+            packet = self._recv(length)
+            if packet is None:
+                return
+            response = self.server.zone.answer(packet, 'tcp')
+            self.request.sendall(_TCP_LENGTH.pack(len(response)) + response)
+
+    def _recv(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+
+class _UdpServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        # Room for the bursts of queries of the benchmarks.
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 << 20)
+        super().server_bind()
+
+
+class _TcpServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def _start_servers(zone):
+    # Returns the UDP and TCP servers of zone, serving in threads on the
+    # same port.
+    for _ in range(10):
+        udp = _UdpServer(('127.0.0.1', 0), _UdpHandler)
+        try:
+            tcp = _TcpServer(udp.server_address, _TcpHandler)
+        except OSError:
+            udp.server_close()
+            continue
+        break
+    else:
+        raise OSError('No free port for the stub DNS server')
+    for server in (udp, tcp):
+        server.zone = zone
+        threading.Thread(target=server.serve_forever, args=(0.05,),
+                         daemon=True).start()
+    return udp, tcp
+
+
+def _serve_in_child(zone, conn):
+    udp, tcp = _start_servers(zone)
+    conn.send(udp.server_address)
+    conn.close()
+    threading.Event().wait()
+
+
+class StubServer:
+    '''
+    Serves zone over UDP and TCP on the same port of 127.0.0.1. Use as a
+    context manager; the address attribute is the (host, port) to pass to
+    set_nameservers.
+
+    If process is true, the servers run in a child process with a copy of
+    zone, so changes to zone and the counts of queries are not shared.
+    '''
+
+    def __init__(self, zone, process=False):
+        self.zone = zone
+        self.process = process
+        self.address = None
+        self._servers = []
+        self._child = None
+
+    def __enter__(self):
+        if self.process:
+            parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+            self._child = multiprocessing.Process(
+                target=_serve_in_child, args=(self.zone, child_conn),
+                daemon=True)
+            self._child.start()
+            self.address = parent_conn.recv()
+            parent_conn.close()
+        else:
+            self._servers = _start_servers(self.zone)
+            self.address = self._servers[0].server_address
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._child is not None:
+            self._child.terminate()
+            self._child.join()
+            self._child = None
+        for server in self._servers:
+            server.shutdown()
+            server.server_close()
+        self._servers = []
@@ -0,0 +1,73 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from dmarc_policy_parser import dns, files, public_suffix, resolver
+from dmarc_policy_parser.bulk import get_dmarc_policies
+from dmarc_policy_parser.cache import MemoryCache
+
+from tests.stubdns import StubServer, Zone
+
+
+class FailingCache:
+    '''
+    A persistent DNS cache that fails to read some names.
+    '''
+
+    def __init__(self, errors):
+        self.errors = errors
+        self.entries = {}
+
+    def get(self, domain):
+        if domain in self.errors:
+            raise self.errors[domain]
+        return self.entries.get(domain)
+
+    def set(self, domain, result, cached_time, ttl=None):
+        self.entries[domain] = [result, cached_time, ttl]
+
+
+class ErrorTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(files.set_cache_home, files.get_cache_home())
+        files.set_cache_home(tmpdir)
+        psl = os.path.join(tmpdir, 'public_suffix_list.dat')
+        with open(psl, 'w') as fp:
+            fp.write('com\n')
+        self.addCleanup(public_suffix.set_public_suffix_file, None)
+        public_suffix.set_public_suffix_file(psl)
+
+        zone = Zone()
+        for name in ('example', 'locked', 'unreadable'):
+            zone.txt['_dmarc.%s.com' % name] = ['v=DMARC1; p=reject']
+        server = StubServer(zone)
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        self.addCleanup(resolver.set_nameservers, resolver.get_nameservers())
+        resolver.set_nameservers([server.address])
+
+        dns.set_dns_cache(FailingCache({
+            '_dmarc.locked.com': sqlite3.OperationalError(
+                'database is locked'),
+            '_dmarc.unreadable.com': OSError('I/O error'),
+        }))
+        self.addCleanup(dns.set_dns_cache, None)
+        dns.set_memory_cache(MemoryCache())
+        self.addCleanup(dns.set_memory_cache, MemoryCache())
+
+    def test_errors_are_reported_per_domain(self):
+        results = get_dmarc_policies(
+            ['example.com', 'locked.com', 'unreadable.com'])
+        self.assertEqual(results['example.com'].policy, 'reject')
+        self.assertIsNone(results['example.com'].error)
+        self.assertIsInstance(results['locked.com'].error,
+                              sqlite3.OperationalError)
+        self.assertIsInstance(results['unreadable.com'].error, OSError)
+
+
+if __name__ == '__main__':
+    unittest.main()
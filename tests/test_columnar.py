@@ -0,0 +1,116 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dmarc_policy_parser.bulk import BulkResult
+from dmarc_policy_parser.columnar import ResultTable
+from dmarc_policy_parser.dmarc import parse_dmarc_record
+from dmarc_policy_parser.exceptions import DmarcException
+
+
+def record(text, domain):
+    return parse_dmarc_record(text).with_domain(domain)
+
+
+RESULTS = [
+    BulkResult('example.com', record(
+        'v=DMARC1; p=reject; rua=mailto:a@example.com', 'example.com'),
+        'reject', None),
+    BulkResult('mail.example.com', record(
+        'v=DMARC1; p=reject; rua=mailto:a@example.com', 'example.com'),
+        'reject', None),
+    BulkResult('example.net', record(
+        'v=DMARC1; p=none; pct=50; fo=1:d; '
+        'rua=mailto:a@example.com,mailto:b@example.net!10m', 'example.net'),
+        'none', None),
+    BulkResult('example.org', record('v=DMARC1; p=none', 'example.org'),
+               'none', None),
+    BulkResult('nothing.test', None, None, None),
+    BulkResult('broken.test', None, None,
+               DmarcException('more than one DMARC policy')),
+]
+
+
+class ResultTableTest(unittest.TestCase):
+    def setUp(self):
+        self.table = ResultTable.from_results(RESULTS)
+
+    def check_table(self, table):
+        self.assertEqual(len(table), len(RESULTS))
+        for result, expected in zip(table, RESULTS):
+            self.assertEqual(result.domain, expected.domain)
+            self.assertEqual(result.record, expected.record)
+            self.assertEqual(result.policy, expected.policy)
+            self.assertEqual(str(result.error), str(expected.error))
+            if expected.record is not None:
+                self.assertEqual(result.record.domain, expected.record.domain)
+        self.assertEqual(table.get('example.net'), table[2])
+        self.assertEqual(table.find('broken.test'), 5)
+        self.assertIsNone(table.find('missing.test'))
+        self.assertEqual(table[-1].domain, 'broken.test')
+        with self.assertRaises(IndexError):
+            table[len(RESULTS)]
+
+    def test_rows(self):
+        self.check_table(self.table)
+
+    def test_save_and_load(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'scan.dmarctab')
+        self.table.save(filename)
+        with ResultTable.load(filename) as table:
+            self.check_table(table)
+            self.assertEqual(list(table.where(p='none')), [2, 3])
+            self.assertEqual(table.count_by('status'),
+                             self.table.count_by('status'))
+            with self.assertRaises(DmarcException):
+                table.append(RESULTS[0])
+
+    def test_load_rejects_other_files(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        filename = os.path.join(tmpdir, 'other')
+        with open(filename, 'wb') as fp:
+            fp.write(b'not a table')
+        with self.assertRaises(DmarcException):
+            ResultTable.load(filename)
+
+    def test_where(self):
+        table = self.table
+        self.assertEqual(list(table.where(p='reject')), [0, 1])
+        self.assertEqual(list(table.where(p='none', rua=None)), [3])
+        self.assertEqual(list(table.where(status='error')), [5])
+        self.assertEqual(list(table.where(status={'error', 'no_record'})),
+                         [4, 5])
+        self.assertEqual(list(table.where(record_domain='.')), [0, 2, 3])
+        # Only records found at another domain are matched by name.
+        self.assertEqual(list(table.where(record_domain='example.com')),
+                         [1])
+        self.assertEqual(list(table.where(pct=50, fo=('1', 'd'))), [2])
+        self.assertEqual(list(table.where(pct=75)), [])
+        self.assertEqual(len(table.where()), len(RESULTS))
+        self.assertEqual(table.count(policy='none'), 2)
+        with self.assertRaises(ValueError):
+            table.where(p='sometimes')
+        with self.assertRaises(ValueError):
+            table.where(colour='blue')
+
+    def test_count_by(self):
+        table = self.table
+        self.assertEqual(table.count_by('status'),
+                         {'record': 4, 'no_record': 1, 'error': 1})
+        self.assertEqual(table.count_by('p', 'pct'),
+                         {('reject', None): 2, ('none', 50): 1,
+                          ('none', None): 1, (None, None): 2})
+        self.assertEqual(table.count_by('rua', p='reject'),
+                         {(('mailto:a@example.com', None),): 2})
+        with self.assertRaises(ValueError):
+            table.count_by()
+        with self.assertRaises(ValueError):
+            table.count_by('colour')
+
+
+if __name__ == '__main__':
+    unittest.main()
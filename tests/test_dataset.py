@@ -0,0 +1,157 @@
+import io
+import os
+import json
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from dmarc_policy_parser.dataset import (
+    TxtDataset, TxtIndex, build_txt_index, open_txt_dataset, read_jsonl,
+    read_txt_dataset, read_zone_file,
+)
+from dmarc_policy_parser.exceptions import DmarcException
+
+
+ZONE = r'''$ORIGIN example.com.
+$TTL 3600
+@               IN SOA ns hostmaster ( 1 3600 600
+                                      86400 120 )
+_dmarc          3600 IN TXT "v=DMARC1; p=reject" ; the policy
+                     TXT "second record"
+www             IN A 192.0.2.1
+_dmarc.mail     TXT ( "v=DMARC1; "
+                      "p=quarantine; rua=mailto:a@example.com" )
+_dmarc.escaped  TXT "semi\;colon \"quoted\" \065"
+$ORIGIN example.net.
+_dmarc          IN 300 TXT "v=DMARC1;" " p=none"
+_dmarc.other.org. TXT "absolute"
+'''
+
+ZONE_RECORDS = [
+    ('_dmarc.example.com.', 'v=DMARC1; p=reject'),
+    ('_dmarc.example.com.', 'second record'),
+    ('_dmarc.mail.example.com.',
+     'v=DMARC1; p=quarantine; rua=mailto:a@example.com'),
+    ('_dmarc.escaped.example.com.', 'semi;colon "quoted" A'),
+    ('_dmarc.example.net.', 'v=DMARC1; p=none'),
+    ('_dmarc.other.org.', 'absolute'),
+]
+
+JSONL = '''\
+{"name": "_dmarc.example.com", "type": "TXT", "value": "v=DMARC1; p=reject"}
+{"domain": "_dmarc.example.net.", "records": ["v=DMARC1; p=none", "other"]}
+
+%s
+{"name": "example.org", "type": "A", "value": "192.0.2.1"}
+''' % (json.dumps({'name': '_dmarc.example.org', 'type': 16,
+                   'data': '"v=DMARC1; " "p=quarantine"'}),)
+
+JSONL_RECORDS = [
+    ('_dmarc.example.com', 'v=DMARC1; p=reject'),
+    ('_dmarc.example.net.', 'v=DMARC1; p=none'),
+    ('_dmarc.example.net.', 'other'),
+    ('_dmarc.example.org', 'v=DMARC1; p=quarantine'),
+]
+
+
+class ReaderTest(unittest.TestCase):
+    def test_zone_file(self):
+        self.assertEqual(list(read_zone_file(io.StringIO(ZONE))),
+                         ZONE_RECORDS)
+
+    def test_zone_file_origin_argument(self):
+        zone = '_dmarc TXT "v=DMARC1; p=none"\n'
+        self.assertEqual(
+            list(read_zone_file(io.StringIO(zone), 'example.com.')),
+            [('_dmarc.example.com.', 'v=DMARC1; p=none')])
+
+    def test_zone_file_without_owner(self):
+        with self.assertRaises(DmarcException):
+            list(read_zone_file(io.StringIO('  TXT "orphan"\n')))
+
+    def test_jsonl(self):
+        self.assertEqual(list(read_jsonl(io.StringIO(JSONL))), JSONL_RECORDS)
+
+    def test_jsonl_errors(self):
+        with self.assertRaises(DmarcException):
+            list(read_jsonl(io.StringIO('{"name": "x"}\n')))
+        with self.assertRaises(DmarcException):
+            list(read_jsonl(io.StringIO('not json\n')))
+
+
+class IndexTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, name, text, opener=open):
+        filename = os.path.join(self.tmpdir, name)
+        with opener(filename, 'wt') as fp:
+            fp.write(text)
+        return filename
+
+    def test_formats_are_guessed(self):
+        self.assertEqual(list(read_txt_dataset(self.write('zone.db', ZONE))),
+                         ZONE_RECORDS)
+        self.assertEqual(
+            list(read_txt_dataset(self.write('txt.jsonl.gz', JSONL,
+                                             gzip.open))),
+            JSONL_RECORDS)
+        with self.assertRaises(ValueError):
+            list(read_txt_dataset(self.write('zone.db', ZONE), 'csv'))
+
+    def check_lookups(self, dataset):
+        self.assertEqual(dataset.get_txt_records('_dmarc.example.com'),
+                         ['v=DMARC1; p=reject', 'second record'])
+        self.assertEqual(dataset.get_txt_records('_DMARC.Example.NET.'),
+                         ['v=DMARC1; p=none'])
+        self.assertEqual(dataset.get_txt_records('_dmarc.other.org'),
+                         ['absolute'])
+        self.assertIsNone(dataset.get_txt_records('_dmarc.missing.com'))
+        self.assertIsNone(dataset.get_txt_records('example.com'))
+        self.assertEqual(len(dataset), len(ZONE_RECORDS))
+
+    def test_index(self):
+        zone = self.write('zone.db', ZONE)
+        index = os.path.join(self.tmpdir, 'zone.idx')
+        self.assertEqual(build_txt_index(zone, index), len(ZONE_RECORDS))
+        dataset = open_txt_dataset(index)
+        self.addCleanup(dataset.close)
+        self.assertIsInstance(dataset, TxtIndex)
+        self.check_lookups(dataset)
+
+    def test_dataset(self):
+        dataset = open_txt_dataset(self.write('zone.db', ZONE))
+        self.assertIsInstance(dataset, TxtDataset)
+        self.check_lookups(dataset)
+
+    def test_index_of_many_names(self):
+        # Enough names for hash collisions and long probe sequences.
+        lines = ['{"name": "_dmarc.d%d.example", "value": "v=DMARC1; '
+                 'p=none; rua=mailto:%d@example.com"}' % (i, i)
+                 for i in range(5000)]
+        lines.append('{"name": "_dmarc.special.example", '
+                     '"value": "tab\\there\\nnewline\\\\backslash"}')
+        source = self.write('many.jsonl', '\n'.join(lines) + '\n')
+        index = os.path.join(self.tmpdir, 'many.idx')
+        build_txt_index(source, index)
+        dataset = TxtIndex(index)
+        self.addCleanup(dataset.close)
+        self.assertEqual(len(dataset), 5001)
+        for i in range(5000):
+            self.assertEqual(
+                dataset.get_txt_records('_dmarc.d%d.example' % i),
+                ['v=DMARC1; p=none; rua=mailto:%d@example.com' % i])
+            self.assertIsNone(
+                dataset.get_txt_records('_dmarc.e%d.example' % i))
+        self.assertEqual(dataset.get_txt_records('_dmarc.special.example'),
+                         ['tab\there\nnewline\\backslash'])
+
+    def test_not_an_index(self):
+        with self.assertRaises(DmarcException):
+            TxtIndex(self.write('zone.db', ZONE))
+
+
+if __name__ == '__main__':
+    unittest.main()
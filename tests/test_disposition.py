@@ -0,0 +1,157 @@
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+from dmarc_policy_parser import dns, files, public_suffix, resolver
+from dmarc_policy_parser.cache import MemoryCache, SqliteCache
+from dmarc_policy_parser.disposition import (
+    async_evaluate_message, evaluate_message, evaluate_messages,
+)
+
+from tests.stubdns import StubServer, Zone
+
+
+class FixedRandom:
+    # Stands in for the random module in pct sampling.
+
+    def __init__(self, value):
+        self.value = value
+
+    def random(self):
+        return self.value
+
+
+class EvaluateTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(files.set_cache_home, files.get_cache_home())
+        files.set_cache_home(tmpdir)
+        psl = os.path.join(tmpdir, 'public_suffix_list.dat')
+        with open(psl, 'w') as fp:
+            fp.write('com\n')
+        self.addCleanup(public_suffix.set_public_suffix_file, None)
+        public_suffix.set_public_suffix_file(psl)
+
+        self.zone = Zone()
+        self.zone.txt['_dmarc.example.com'] = ['v=DMARC1; p=reject']
+        self.zone.txt['_dmarc.relaxed.com'] = [
+            'v=DMARC1; p=reject; sp=quarantine']
+        self.zone.txt['_dmarc.strict.com'] = [
+            'v=DMARC1; p=reject; adkim=s; aspf=s']
+        self.zone.txt['_dmarc.reject50.com'] = ['v=DMARC1; p=reject; pct=50']
+        self.zone.txt['_dmarc.quarantine50.com'] = [
+            'v=DMARC1; p=quarantine; pct=50']
+        server = StubServer(self.zone)
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        self.addCleanup(resolver.set_nameservers, resolver.get_nameservers())
+        resolver.set_nameservers([server.address])
+
+        dns.set_dns_cache(SqliteCache(os.path.join(tmpdir, 'dns.sqlite3')))
+        self.addCleanup(dns.set_dns_cache, None)
+        dns.set_memory_cache(MemoryCache())
+        self.addCleanup(dns.set_memory_cache, MemoryCache())
+
+    def check_no_from_domain(self, evaluation):
+        self.assertEqual(evaluation.reason, 'no_from_domain')
+        self.assertEqual(evaluation.disposition, 'none')
+        self.assertIsNone(evaluation.domain)
+        self.assertIsNone(evaluation.error)
+
+    def test_evaluate_message(self):
+        for from_domain in (None, '', '.'):
+            self.check_no_from_domain(evaluate_message(from_domain,
+                                                       'example.com'))
+        self.assertEqual(self.zone.queries, {'udp': 0, 'tcp': 0})
+
+    def test_async_evaluate_message(self):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        self.check_no_from_domain(loop.run_until_complete(
+            async_evaluate_message(None, 'example.com')))
+        self.assertEqual(self.zone.queries, {'udp': 0, 'tcp': 0})
+
+    def test_evaluate_messages(self):
+        missing, example = evaluate_messages(
+            [(None, 'example.com', ()), ('example.com', None, ())])
+        self.check_no_from_domain(missing)
+        self.assertEqual(example.reason, 'fail')
+        self.assertEqual(example.disposition, 'reject')
+        # Only example.com was looked up.
+        self.assertEqual(self.zone.queries['udp'], 1)
+
+
+    def check(self, evaluation, disposition, policy, reason,
+              spf_aligned=False, dkim_aligned=False):
+        self.assertEqual((evaluation.disposition, evaluation.policy,
+                          evaluation.reason, evaluation.spf_aligned,
+                          evaluation.dkim_aligned),
+                         (disposition, policy, reason, spf_aligned,
+                          dkim_aligned))
+
+    def test_relaxed_alignment(self):
+        self.check(evaluate_message('relaxed.com', 'bounce.relaxed.com'),
+                   'none', 'reject', 'pass', spf_aligned=True)
+        self.check(evaluate_message('mail.relaxed.com', None,
+                                    ['relaxed.com']),
+                   'none', 'quarantine', 'pass', dkim_aligned=True)
+        self.check(evaluate_message('relaxed.com', 'relaxed.net',
+                                    ['other.com', 'notrelaxed.com']),
+                   'reject', 'reject', 'fail')
+
+    def test_strict_alignment(self):
+        self.check(evaluate_message('strict.com', 'bounce.strict.com',
+                                    ['mail.strict.com']),
+                   'reject', 'reject', 'fail')
+        self.check(evaluate_message('strict.com', 'strict.com'),
+                   'none', 'reject', 'pass', spf_aligned=True)
+        self.check(evaluate_message('STRICT.com.', None, ['strict.COM']),
+                   'none', 'reject', 'pass', dkim_aligned=True)
+
+    def test_subdomain_policy(self):
+        # sp applies to subdomains without a record of their own.
+        self.check(evaluate_message('relaxed.com'),
+                   'reject', 'reject', 'fail')
+        self.check(evaluate_message('mail.relaxed.com'),
+                   'quarantine', 'quarantine', 'fail')
+        # Without sp, subdomains get p.
+        self.check(evaluate_message('mail.strict.com'),
+                   'reject', 'reject', 'fail')
+
+    def test_pct_sampling(self):
+        selected, skipped = FixedRandom(0.4), FixedRandom(0.6)
+        self.check(evaluate_message('reject50.com', rng=selected),
+                   'reject', 'reject', 'fail')
+        self.check(evaluate_message('reject50.com', rng=skipped),
+                   'quarantine', 'reject', 'sampled_out')
+        self.check(evaluate_message('quarantine50.com', rng=selected),
+                   'quarantine', 'quarantine', 'fail')
+        self.check(evaluate_message('quarantine50.com', rng=skipped),
+                   'none', 'quarantine', 'sampled_out')
+        # Messages that pass are never sampled.
+        self.check(evaluate_message('reject50.com', 'reject50.com',
+                                    rng=skipped),
+                   'none', 'reject', 'pass', spf_aligned=True)
+
+    def test_no_policy(self):
+        evaluation = evaluate_message('nothing.com', 'nothing.com')
+        self.assertEqual((evaluation.disposition, evaluation.reason),
+                         ('none', 'no_policy'))
+
+    def test_evaluate_messages_matches_evaluate_message(self):
+        messages = [
+            ('relaxed.com', 'bounce.relaxed.com', ()),
+            ('mail.relaxed.com', None, ()),
+            ('strict.com', 'bounce.strict.com', ['strict.com']),
+            ('reject50.com', None, ()),
+        ]
+        self.assertEqual(
+            evaluate_messages(messages, rng=FixedRandom(0.6)),
+            [evaluate_message(*m, rng=FixedRandom(0.6)) for m in messages])
+
+
+if __name__ == '__main__':
+    unittest.main()
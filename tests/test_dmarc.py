@@ -0,0 +1,84 @@
+import os
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+from dmarc_policy_parser import dmarc, dns, files, public_suffix, resolver
+from dmarc_policy_parser.cache import MemoryCache, SqliteCache
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.metrics import Metrics, get_metrics, set_metrics
+
+from tests.stubdns import StubServer, Zone
+
+
+class PolicyDiscoveryTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(files.set_cache_home, files.get_cache_home())
+        files.set_cache_home(tmpdir)
+        psl = os.path.join(tmpdir, 'public_suffix_list.dat')
+        with open(psl, 'w') as fp:
+            fp.write('com\n')
+        self.addCleanup(public_suffix.set_public_suffix_file, None)
+        public_suffix.set_public_suffix_file(psl)
+
+        self.zone = Zone()
+        self.zone.txt['_dmarc.example.com'] = ['v=DMARC1; p=reject']
+        server = StubServer(self.zone)
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        self.addCleanup(resolver.set_nameservers, resolver.get_nameservers())
+        resolver.set_nameservers([server.address])
+
+        dns.set_dns_cache(SqliteCache(os.path.join(tmpdir, 'dns.sqlite3')))
+        self.addCleanup(dns.set_dns_cache, None)
+        dns.set_memory_cache(MemoryCache())
+        self.addCleanup(dns.set_memory_cache, MemoryCache())
+        self.addCleanup(dmarc.set_policy_discovery,
+                        *dmarc.get_policy_discovery())
+        dmarc.set_policy_discovery('rfc7489', parallel=False)
+
+    def async_get_dmarc_record(self, domain):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                dmarc.async_get_dmarc_record(domain))
+        finally:
+            loop.close()
+
+    def check_discovery(self, get_dmarc_record):
+        record = get_dmarc_record('mail.example.com')
+        self.assertEqual(record.request, 'reject')
+        self.assertEqual(self.zone.queries['udp'], 2)
+        # A public suffix has no organizational domain to fall back to.
+        self.assertIsNone(get_dmarc_record('com'))
+        self.assertEqual(self.zone.queries['udp'], 3)
+
+    def test_discovery(self):
+        self.check_discovery(dmarc.get_dmarc_record)
+
+    def test_async_discovery(self):
+        self.check_discovery(self.async_get_dmarc_record)
+
+
+class ParseErrorTest(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(set_metrics, get_metrics())
+        self.metrics = Metrics()
+        set_metrics(self.metrics)
+
+    def test_every_parse_error_is_counted(self):
+        records = ['v=DMARC1; p=bogus']
+        for _ in range(3):
+            with self.assertRaises(DmarcException):
+                dmarc._select_dmarc_record('example.com', records)
+        errors = self.metrics.snapshot()['counters']['errors']
+        self.assertEqual(errors, [{'labels': {'error': 'ValueError',
+                                              'stage': 'parse'},
+                                   'value': 3}])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import time
+import asyncio
+import threading
+import unittest
+
+from dmarc_policy_parser import dns, resolver
+from dmarc_policy_parser.cache import MemoryCache
+
+from tests.stubdns import StubServer, Zone
+
+
+class BlockingCache:
+    '''
+    A persistent DNS cache whose reads and writes block until released,
+    like an sqlite3 database locked by another process.
+    '''
+
+    def __init__(self):
+        self.entries = {}
+        self.released = threading.Event()
+
+    def get(self, domain):
+        self.released.wait(5)
+        return self.entries.get(domain)
+
+    def set(self, domain, result, cached_time, ttl=None):
+        self.released.wait(5)
+        self.entries[domain] = [result, cached_time, ttl]
+
+
+class AsyncCacheTest(unittest.TestCase):
+    def setUp(self):
+        zone = Zone()
+        zone.txt['_dmarc.example.com'] = ['v=DMARC1; p=reject']
+        server = StubServer(zone)
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        nameservers = resolver.get_nameservers()
+        self.addCleanup(resolver.set_nameservers, nameservers)
+        resolver.set_nameservers([server.address])
+        self.cache = BlockingCache()
+        dns.set_dns_cache(self.cache)
+        self.addCleanup(dns.set_dns_cache, None)
+        dns.set_memory_cache(MemoryCache())
+        self.addCleanup(dns.set_memory_cache, MemoryCache())
+        dns.get_memory_cache().set('_dmarc.cached.com',
+                                   ['v=DMARC1; p=none'], time.time(), 3600)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_memory_hits_do_not_wait_for_persistent_cache(self):
+        async def main():
+            start = time.monotonic()
+            miss = asyncio.ensure_future(
+                dns.async_get_dns_txt_record('_dmarc.example.com'))
+            # Let the miss start reading the persistent cache.
+            await asyncio.sleep(0.05)
+            hit = await dns.async_get_dns_txt_record('_dmarc.cached.com')
+            hit_time = time.monotonic() - start
+            self.assertFalse(miss.done())
+            self.cache.released.set()
+            return hit, hit_time, await miss
+
+        hit, hit_time, miss = self.loop.run_until_complete(main())
+        self.assertLess(hit_time, 2)
+        self.assertEqual(hit, ['v=DMARC1; p=none'])
+        self.assertEqual(miss, ['v=DMARC1; p=reject'])
+        self.assertEqual(self.cache.entries['_dmarc.example.com'][0],
+                         ['v=DMARC1; p=reject'])
+
+
+if __name__ == '__main__':
+    unittest.main()
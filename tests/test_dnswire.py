@@ -0,0 +1,147 @@
+import struct
+import unittest
+
+from dmarc_policy_parser import dnswire
+from dmarc_policy_parser.exceptions import DmarcException
+
+from tests.stubdns import (
+    TTL, SOA_MINIMUM, message, resource_record, soa_record, txt_rdata,
+)
+
+
+QUESTION = ('_dmarc.example', dnswire.TYPE_TXT)
+
+
+def decode(flags, answers=(), authority=(), question=QUESTION):
+    return dnswire.decode_message(
+        message(1, flags, question, answers, authority))
+
+
+class DecodeTest(unittest.TestCase):
+    def test_multi_string_txt(self):
+        m = decode(0, [resource_record(
+            '_dmarc.example', dnswire.TYPE_TXT, TTL,
+            txt_rdata(['v=DMARC1; p=', 'reject; rua=mailto:a@example']))])
+        self.assertEqual(m.answers[0].data,
+                         [b'v=DMARC1; p=', b'reject; rua=mailto:a@example'])
+        records, ttl = dnswire.get_txt_answer(m, '_dmarc.example')
+        self.assertEqual(records,
+                         ['v=DMARC1; p=reject; rua=mailto:a@example'])
+        self.assertEqual(ttl, TTL)
+
+    def test_empty_txt_string(self):
+        m = decode(0, [resource_record('_dmarc.example', dnswire.TYPE_TXT,
+                                       TTL, txt_rdata(['']))])
+        self.assertEqual(dnswire.get_txt_answer(m, '_dmarc.example'),
+                         ([''], TTL))
+
+    def test_truncated_txt(self):
+        rdata = b'\x10' + b'v=DMARC1'
+        with self.assertRaises(DmarcException):
+            decode(0, [resource_record('_dmarc.example', dnswire.TYPE_TXT,
+                                       TTL, rdata)])
+
+    def test_compressed_name(self):
+        # The owner name points to the question name at offset 12.
+        rdata = txt_rdata('v=DMARC1; p=none')
+        answer = (b'\xc0\x0c' +
+                  struct.pack('!HHIH', dnswire.TYPE_TXT, dnswire.CLASS_IN,
+                              TTL, len(rdata)) + rdata)
+        m = decode(0, [answer])
+        self.assertEqual(m.answers[0].name, '_dmarc.example')
+
+    def test_compression_loop(self):
+        # A name that is a pointer to itself.
+        packet = (struct.pack('!HHHHHH', 1, dnswire.FLAG_QR, 1, 0, 0, 0) +
+                  b'\xc0\x0c' + struct.pack('!HH', dnswire.TYPE_TXT,
+                                            dnswire.CLASS_IN))
+        with self.assertRaises(DmarcException):
+            dnswire.decode_message(packet)
+
+    def test_compression_loop_between_names(self):
+        # Two pointers that point to each other.
+        packet = (struct.pack('!HHHHHH', 1, dnswire.FLAG_QR, 1, 0, 0, 0) +
+                  b'\xc0\x0e\xc0\x0c' +
+                  struct.pack('!HH', dnswire.TYPE_TXT, dnswire.CLASS_IN))
+        with self.assertRaises(DmarcException):
+            dnswire.decode_message(packet)
+
+    def test_truncated_message(self):
+        with self.assertRaises(DmarcException):
+            dnswire.decode_message(b'\0\1\x80')
+        packet = message(1, 0, QUESTION, [resource_record(
+            '_dmarc.example', dnswire.TYPE_TXT, TTL, txt_rdata('v=DMARC1'))])
+        with self.assertRaises(DmarcException):
+            dnswire.decode_message(packet[:-3])
+
+    def test_tc_flag_drops_records(self):
+        m = decode(dnswire.FLAG_TC, [resource_record(
+            '_dmarc.example', dnswire.TYPE_TXT, TTL, txt_rdata('v=DMARC1'))])
+        self.assertTrue(m.flags & dnswire.FLAG_TC)
+        self.assertEqual(m.answers, [])
+
+
+class TxtAnswerTest(unittest.TestCase):
+    def test_cname_chain(self):
+        m = decode(0, [
+            resource_record('_dmarc.example', dnswire.TYPE_CNAME, 300,
+                            dnswire.encode_name('a.example')),
+            resource_record('a.example', dnswire.TYPE_CNAME, 60,
+                            dnswire.encode_name('b.example')),
+            resource_record('b.example', dnswire.TYPE_TXT, TTL,
+                            txt_rdata('v=DMARC1; p=reject')),
+            # A record of another name is ignored.
+            resource_record('c.example', dnswire.TYPE_TXT, TTL,
+                            txt_rdata('v=DMARC1; p=none')),
+        ])
+        records, ttl = dnswire.get_txt_answer(m, '_DMARC.Example.')
+        self.assertEqual(records, ['v=DMARC1; p=reject'])
+        # The shortest TTL along the chain.
+        self.assertEqual(ttl, 60)
+
+    def test_cname_loop(self):
+        m = decode(0, [
+            resource_record('_dmarc.example', dnswire.TYPE_CNAME, TTL,
+                            dnswire.encode_name('a.example')),
+            resource_record('a.example', dnswire.TYPE_CNAME, TTL,
+                            dnswire.encode_name('_dmarc.example')),
+        ])
+        with self.assertRaises(DmarcException):
+            dnswire.get_txt_answer(m, '_dmarc.example')
+
+    def test_cname_to_nxdomain(self):
+        m = decode(dnswire.RCODE_NXDOMAIN, [
+            resource_record('_dmarc.example', dnswire.TYPE_CNAME, 60,
+                            dnswire.encode_name('a.example')),
+        ], [soa_record()])
+        self.assertEqual(dnswire.get_txt_answer(m, '_dmarc.example'),
+                         (None, 60))
+
+    def test_nxdomain_negative_ttl(self):
+        # The minimum of the SOA TTL and its MINIMUM field [RFC 2308].
+        m = decode(dnswire.RCODE_NXDOMAIN, authority=[soa_record()])
+        self.assertEqual(dnswire.get_txt_answer(m, '_dmarc.example'),
+                         (None, SOA_MINIMUM))
+        m = decode(dnswire.RCODE_NXDOMAIN,
+                   authority=[soa_record(ttl=30, minimum=3600)])
+        self.assertEqual(dnswire.get_txt_answer(m, '_dmarc.example'),
+                         (None, 30))
+
+    def test_nodata_negative_ttl(self):
+        m = decode(0, authority=[soa_record()])
+        self.assertEqual(dnswire.get_txt_answer(m, '_dmarc.example'),
+                         ([], SOA_MINIMUM))
+
+    def test_negative_answer_without_soa(self):
+        m = decode(dnswire.RCODE_NXDOMAIN)
+        self.assertEqual(dnswire.get_txt_answer(m, '_dmarc.example'),
+                         (None, None))
+
+    def test_servfail(self):
+        m = decode(dnswire.RCODE_SERVFAIL)
+        with self.assertRaises(DmarcException):
+            dnswire.get_txt_answer(m, '_dmarc.example')
+
+
+if __name__ == '__main__':
+    unittest.main()
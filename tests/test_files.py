@@ -0,0 +1,40 @@
+import os
+import gzip
+import shutil
+import tempfile
+import unittest
+
+from dmarc_policy_parser.files import open_text
+
+from tests.test_reports import open_files
+
+
+class OpenTextTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, name, opener):
+        filename = os.path.join(self.tmpdir, name)
+        with opener(filename, 'wb') as fp:
+            fp.write('example.com\nexämple.net\n'.encode('utf8'))
+        return filename
+
+    def test_open_text(self):
+        for filename in (self.write('domains.txt', open),
+                         self.write('domains.txt.gz', gzip.open)):
+            with open_text(filename) as fp:
+                self.assertEqual(fp.read().split(),
+                                 ['example.com', 'exämple.net'])
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc')
+    def test_files_are_closed(self):
+        filename = self.write('domains.txt.gz', gzip.open)
+        for _ in range(10):
+            with open_text(filename) as fp:
+                fp.read()
+        self.assertEqual(open_files(self.tmpdir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
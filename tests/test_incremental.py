@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dmarc_policy_parser import (
+    dns, files, incremental, public_suffix, resolver,
+)
+from dmarc_policy_parser.cache import MemoryCache, SqliteCache
+from dmarc_policy_parser.incremental import StateStore, rescan
+
+from tests.stubdns import StubServer, Zone
+
+
+class RescanTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(files.set_cache_home, files.get_cache_home())
+        files.set_cache_home(tmpdir)
+        psl = os.path.join(tmpdir, 'public_suffix_list.dat')
+        with open(psl, 'w') as fp:
+            fp.write('com\n')
+        self.addCleanup(public_suffix.set_public_suffix_file, None)
+        public_suffix.set_public_suffix_file(psl)
+
+        zone = Zone()
+        zone.txt['_dmarc.one.com'] = ['v=DMARC1; p=reject']
+        zone.txt['_dmarc.two.com'] = ['v=DMARC1; p=quarantine']
+        server = StubServer(zone)
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        self.addCleanup(resolver.set_nameservers, resolver.get_nameservers())
+        resolver.set_nameservers([server.address])
+
+        dns.set_dns_cache(SqliteCache(os.path.join(tmpdir, 'dns.sqlite3')))
+        self.addCleanup(dns.set_dns_cache, None)
+        dns.set_memory_cache(MemoryCache())
+        self.addCleanup(dns.set_memory_cache, MemoryCache())
+        self.store = StateStore(os.path.join(tmpdir, 'state.sqlite3'))
+        self.addCleanup(self.store.close)
+
+    def rescan(self):
+        return rescan(['one.com', 'two.com'], self.store, force=True)
+
+    def test_interrupted_run_reports_its_changes_again(self):
+        changes = self.rescan()
+        first = next(changes)
+        changes.close()
+
+        # Neither the change being handled nor the one not yet yielded
+        # was stored.
+        self.assertEqual(self.store.get_many(['one.com', 'two.com']), {})
+        changes = sorted((c.domain, c.change) for c in self.rescan())
+        self.assertEqual(changes, [('one.com', 'added'),
+                                   ('two.com', 'added')])
+        self.assertIn(first.domain, ['one.com', 'two.com'])
+
+        # A run that completes stores every change.
+        self.assertEqual(list(self.rescan()), [])
+
+
+    def test_max_age_in_lookup_arguments(self):
+        # rescan passes its own max_age, whatever the lookup arguments say.
+        state, record, parsed = incremental._revalidate(
+            'one.com', None, 3600, {'max_age': 60, 'timeout': 2})
+        self.assertEqual(state.policy, 'reject')
+        self.assertTrue(parsed)
+
+
+if __name__ == '__main__':
+    unittest.main()
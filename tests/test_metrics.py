@@ -0,0 +1,45 @@
+import os
+import json
+import time
+import shutil
+import tempfile
+import unittest
+
+import dmarc_policy_parser
+from dmarc_policy_parser import files, public_suffix
+from dmarc_policy_parser.metrics import Metrics
+
+
+class PublicSuffixAgeTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(files.set_cache_home, files.get_cache_home())
+        files.set_cache_home(tmpdir)
+        psl = os.path.join(tmpdir, 'public_suffix_list.dat')
+        with open(psl, 'w') as fp:
+            fp.write('com\n')
+        # A list downloaded an hour ago.
+        mtime = time.time() - 3600
+        os.utime(psl, (mtime, mtime))
+        self.addCleanup(public_suffix.set_public_suffix_file, None)
+        public_suffix.set_public_suffix_file(psl)
+
+    def test_age(self):
+        public_suffix.get_public_suffix('example.com')
+        age = dmarc_policy_parser.get_public_suffix_age()
+        self.assertGreaterEqual(age, 3600)
+        self.assertLess(age, 3700)
+
+        gauges = json.loads(Metrics().to_json())['gauges']
+        self.assertGreaterEqual(gauges['public_suffix_age_seconds'], age)
+        lines = Metrics().to_prometheus().splitlines()
+        self.assertIn('# TYPE dmarc_policy_parser_public_suffix_age_seconds '
+                      'gauge', lines)
+        value, = [line for line in lines if line.startswith(
+            'dmarc_policy_parser_public_suffix_age_seconds ')]
+        self.assertGreaterEqual(float(value.split()[1]), age)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,34 @@
+import types
+import pkgutil
+import unittest
+import importlib
+
+import dmarc_policy_parser
+
+
+class LazyExportsTest(unittest.TestCase):
+    def test_exports_are_not_submodule_names(self):
+        submodules = {m.name for m in
+                      pkgutil.iter_modules(dmarc_policy_parser.__path__)}
+        self.assertEqual(submodules & set(dmarc_policy_parser._EXPORTS),
+                         set())
+
+    def test_exports(self):
+        for name, module in sorted(dmarc_policy_parser._EXPORTS.items()):
+            module = importlib.import_module('dmarc_policy_parser.' + module)
+            self.assertIs(getattr(dmarc_policy_parser, name),
+                          getattr(module, name))
+        self.assertEqual(set(dmarc_policy_parser.__all__),
+                         set(dmarc_policy_parser._EXPORTS))
+
+    def test_import_binds_submodules(self):
+        import dmarc_policy_parser.incremental as incremental
+        import dmarc_policy_parser.warmup as warmup
+        self.assertIsInstance(incremental, types.ModuleType)
+        self.assertIsInstance(warmup, types.ModuleType)
+        self.assertIs(dmarc_policy_parser.rescan, incremental.rescan)
+        self.assertIs(dmarc_policy_parser.preload, warmup.preload)
+
+
+if __name__ == '__main__':
+    unittest.main()
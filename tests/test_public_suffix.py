@@ -0,0 +1,98 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from dmarc_policy_parser import files, public_suffix
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(files.set_cache_home, files.get_cache_home())
+        files.set_cache_home(self.tmpdir)
+
+    def write_list(self, directory, rules):
+        os.mkdir(os.path.join(self.tmpdir, directory))
+        filename = os.path.join(self.tmpdir, directory,
+                                'public_suffix_list.dat')
+        with open(filename, 'w') as fp:
+            fp.write('\n'.join(rules) + '\n')
+        return filename
+
+    def snapshots(self):
+        return sorted(f for f in os.listdir(self.tmpdir)
+                      if f.endswith('.marshal'))
+
+    def test_lists_with_the_same_name_keep_their_own_snapshot(self):
+        # Like a system copy of the list and the downloaded one.
+        system = self.write_list('system', ['com'])
+        downloaded = self.write_list('downloaded', ['com', 'example.com'])
+        system_trie = public_suffix.load_public_suffixes(system)
+        downloaded_trie = public_suffix.load_public_suffixes(downloaded)
+        self.assertNotEqual(system_trie, downloaded_trie)
+        snapshots = self.snapshots()
+        self.assertEqual(len(snapshots), 2)
+        mtimes = [os.stat(os.path.join(self.tmpdir, f)).st_mtime_ns
+                  for f in snapshots]
+
+        # Loading either list again uses its snapshot as it is.
+        self.assertEqual(public_suffix.load_public_suffixes(system),
+                         system_trie)
+        self.assertEqual(public_suffix.load_public_suffixes(downloaded),
+                         downloaded_trie)
+        self.assertEqual(self.snapshots(), snapshots)
+        self.assertEqual([os.stat(os.path.join(self.tmpdir, f)).st_mtime_ns
+                          for f in snapshots], mtimes)
+
+    def test_snapshot_is_rebuilt_when_the_list_changes(self):
+        filename = self.write_list('list', ['com'])
+        trie = public_suffix.load_public_suffixes(filename)
+        with open(filename, 'a') as fp:
+            fp.write('example.com\n')
+        self.assertNotEqual(public_suffix.load_public_suffixes(filename),
+                            trie)
+        self.assertEqual(len(self.snapshots()), 1)
+
+
+class SwitchListTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.addCleanup(files.set_cache_home, files.get_cache_home())
+        self.addCleanup(public_suffix.set_public_suffix_file, None)
+
+    def write_list(self, directory, rules):
+        directory = os.path.join(self.tmpdir, directory)
+        os.mkdir(directory)
+        filename = os.path.join(directory, 'public_suffix_list.dat')
+        with open(filename, 'w') as fp:
+            fp.write('\n'.join(rules) + '\n')
+        return directory, filename
+
+    def test_set_public_suffix_file(self):
+        files.set_cache_home(self.tmpdir)
+        _, short = self.write_list('short', ['com'])
+        _, longer = self.write_list('longer', ['com', 'example.com'])
+        public_suffix.set_public_suffix_file(short)
+        self.assertEqual(public_suffix.get_public_suffix('x.example.com'),
+                         'example.com')
+        public_suffix.set_public_suffix_file(longer)
+        self.assertEqual(public_suffix.get_public_suffix('x.example.com'),
+                         'x.example.com')
+
+    def test_set_cache_home(self):
+        public_suffix.set_public_suffix_file(None)
+        short, _ = self.write_list('short', ['com'])
+        longer, _ = self.write_list('longer', ['com', 'example.com'])
+        files.set_cache_home(short)
+        self.assertEqual(public_suffix.get_public_suffix('x.example.com'),
+                         'example.com')
+        files.set_cache_home(longer)
+        self.assertEqual(public_suffix.get_public_suffix('x.example.com'),
+                         'x.example.com')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import os
+import gzip
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+from dmarc_policy_parser.exceptions import DmarcException
+from dmarc_policy_parser.reports import open_report, parse_report
+
+
+def open_files(directory):
+    # The files in directory that this process has open.
+    names = []
+    for fd in os.listdir('/proc/self/fd'):
+        try:
+            name = os.readlink(os.path.join('/proc/self/fd', fd))
+        except OSError:
+            continue
+        if name.startswith(directory + os.sep):
+            names.append(name)
+    return names
+
+
+REPORT = '''<?xml version="1.0" encoding="UTF-8"?>
+<feedback%s>
+  <report_metadata>
+    <org_name>example.net</org_name>
+    <report_id>1234</report_id>
+    <date_range><begin>1700000000</begin><end>1700086400</end></date_range>
+  </report_metadata>
+  <policy_published>
+    <domain>Example.COM</domain>
+    <p>reject</p>
+    <pct>100</pct>
+  </policy_published>
+  <record>
+    <row>
+      <count>3</count>
+      <policy_evaluated>
+        <disposition>none</disposition>
+        <dkim>pass</dkim>
+        <spf>fail</spf>
+      </policy_evaluated>
+    </row>
+  </record>
+  <record>
+    <row>
+      <count>2</count>
+      <policy_evaluated>
+        <disposition>reject</disposition>
+        <dkim>fail</dkim>
+        <spf>fail</spf>
+      </policy_evaluated>
+    </row>
+  </record>
+</feedback>
+'''
+
+BILLION_LAUGHS = '''<?xml version="1.0"?>
+<!DOCTYPE feedback [
+  <!ENTITY lol "lol">
+  <!ENTITY lol1 "&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;&lol;">
+  <!ENTITY lol2 "&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;&lol1;">
+  <!ENTITY lol3 "&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;&lol2;">
+  <!ENTITY lol4 "&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;&lol3;">
+  <!ENTITY lol5 "&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;&lol4;">
+  <!ENTITY lol6 "&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;&lol5;">
+  <!ENTITY lol7 "&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;&lol6;">
+  <!ENTITY lol8 "&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;&lol7;">
+  <!ENTITY lol9 "&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;&lol8;">
+]>
+<feedback><report_metadata><org_name>&lol9;</org_name></report_metadata>
+</feedback>
+'''
+
+
+class ParseReportTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def write(self, name, text, opener=open):
+        filename = os.path.join(self.tmpdir, name)
+        with opener(filename, 'wb') as fp:
+            fp.write(text.encode('utf8'))
+        return filename
+
+    def check_report(self, report):
+        self.assertIsNone(report.error)
+        self.assertEqual(report.org_name, 'example.net')
+        self.assertEqual(report.report_id, '1234')
+        self.assertEqual((report.begin, report.end),
+                         (1700000000, 1700086400))
+        self.assertEqual(report.domain, 'example.com')
+        self.assertEqual(report.policy_published['p'], 'reject')
+        self.assertEqual(report.messages, 5)
+        self.assertEqual(report.dispositions, {'none': 3, 'reject': 2})
+        self.assertEqual((report.dkim_pass, report.spf_pass,
+                          report.dmarc_pass), (3, 0, 3))
+
+    def test_report(self):
+        self.check_report(parse_report(self.write('report.xml',
+                                                  REPORT % ('',))))
+
+    def test_gzip_report(self):
+        self.check_report(parse_report(
+            self.write('report.xml.gz', REPORT % ('',), gzip.open)))
+
+    def write_zip(self, name, members):
+        filename = os.path.join(self.tmpdir, name)
+        with zipfile.ZipFile(filename, 'w') as archive:
+            for member, text in members:
+                archive.writestr(member, text)
+        return filename
+
+    def test_zip_report(self):
+        self.check_report(parse_report(self.write_zip(
+            'report.zip', [('report.xml', REPORT % ('',))])))
+        report = parse_report(self.write_zip('empty.zip', []))
+        self.assertIsInstance(report.error, DmarcException)
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'needs /proc')
+    def test_files_are_closed(self):
+        filenames = [
+            self.write('report.xml', REPORT % ('',)),
+            self.write('report.xml.gz', REPORT % ('',), gzip.open),
+            self.write_zip('report.zip', [('report.xml', REPORT % ('',))]),
+            self.write_zip('empty.zip', []),
+        ]
+        for filename in filenames:
+            for _ in range(10):
+                parse_report(filename)
+        self.assertEqual(open_files(self.tmpdir), [])
+        for filename in filenames[:3]:
+            with open_report(filename) as fp:
+                self.assertTrue(fp.read().startswith(b'<?xml'))
+        self.assertEqual(open_files(self.tmpdir), [])
+
+    def test_namespaced_report(self):
+        namespace = ' xmlns="urn:ietf:params:xml:ns:dmarc-2.0"'
+        self.check_report(parse_report(self.write('report.xml',
+                                                  REPORT % (namespace,))))
+
+    def test_billion_laughs_is_rejected(self):
+        report = parse_report(self.write('laughs.xml', BILLION_LAUGHS))
+        self.assertIsInstance(report.error, DmarcException)
+        self.assertIsNone(report.org_name)
+
+    def test_doctype_is_rejected(self):
+        report = parse_report(self.write(
+            'doctype.xml', '<!DOCTYPE feedback SYSTEM "file:///etc/passwd">'
+            + REPORT.partition('?>')[2] % ('',)))
+        self.assertIsInstance(report.error, DmarcException)
+
+    def test_not_a_report(self):
+        report = parse_report(self.write('other.xml', '<html></html>'))
+        self.assertIsInstance(report.error, DmarcException)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import time
+import socket
+import asyncio
+import unittest
+
+from dmarc_policy_parser import dnswire, resolver
+from dmarc_policy_parser.exceptions import DmarcException
+
+from tests.stubdns import SOA_MINIMUM, TTL, StubServer, Zone
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class ResolverTest(unittest.TestCase):
+    def setUp(self):
+        self.zone = Zone()
+        self.zone.txt['_dmarc.example.com'] = [
+            ['v=DMARC1; p=', 'quarantine']]
+        self.zone.txt['empty.example.com'] = []
+        self.zone.cname['_dmarc.alias.example.com'] = '_dmarc.example.com'
+        self.zone.servfail.add('_dmarc.broken.example.com')
+        # Too large for a UDP response without EDNS.
+        self.zone.txt['_dmarc.big.example.com'] = [
+            'v=DMARC1; p=reject; rua=mailto:%s@example.com' % ('a' * 200,),
+            'x' * 200, 'y' * 200]
+        self.zone.txt['_dmarc.tc.example.com'] = ['v=DMARC1; p=none']
+        self.zone.truncate.add('_dmarc.tc.example.com')
+        self.server = StubServer(self.zone)
+        self.server.__enter__()
+        self.addCleanup(self.server.__exit__, None, None, None)
+        self.pool = resolver.ResolverPool()
+
+    def query_txt(self, domain):
+        return self.pool.query_txt(domain, 3, [self.server.address])
+
+    def async_query_txt(self, domain):
+        async def query_txt():
+            try:
+                return await self.pool.async_query_txt(
+                    domain, 3, [self.server.address])
+            finally:
+                await self.pool.async_close()
+
+        return run(query_txt())
+
+    def check_lookups(self, query_txt):
+        self.assertEqual(query_txt('_dmarc.example.com'),
+                         (['v=DMARC1; p=quarantine'], TTL))
+        self.assertEqual(query_txt('_dmarc.alias.example.com'),
+                         (['v=DMARC1; p=quarantine'], TTL))
+        self.assertEqual(query_txt('empty.example.com'), ([], SOA_MINIMUM))
+        self.assertEqual(query_txt('_dmarc.missing.example.com'),
+                         (None, SOA_MINIMUM))
+        with self.assertRaises(DmarcException):
+            query_txt('_dmarc.broken.example.com')
+        self.assertEqual(self.zone.queries['tcp'], 0)
+
+    def check_tcp_fallback(self, query_txt):
+        records, ttl = query_txt('_dmarc.big.example.com')
+        self.assertEqual(records, self.zone.txt['_dmarc.big.example.com'])
+        self.assertEqual(ttl, TTL)
+        self.assertEqual(query_txt('_dmarc.tc.example.com'),
+                         (['v=DMARC1; p=none'], TTL))
+        self.assertEqual(self.zone.queries['tcp'], 2)
+        # Both went over UDP first.
+        self.assertEqual(self.zone.queries['udp'], 2)
+
+    def test_lookups(self):
+        self.check_lookups(self.query_txt)
+
+    def test_async_lookups(self):
+        self.check_lookups(self.async_query_txt)
+
+    def test_tcp_fallback(self):
+        self.check_tcp_fallback(self.query_txt)
+
+    def test_async_tcp_fallback(self):
+        self.check_tcp_fallback(self.async_query_txt)
+
+    def check_hedge_after_error(self, query):
+        # A port nobody listens on, which answers with ICMP port
+        # unreachable.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        closed = sock.getsockname()
+        sock.close()
+        start = time.monotonic()
+        answered, message = query(closed, '_dmarc.example.com',
+                                  dnswire.TYPE_TXT, 3, self.server.address)
+        # Well before the hedge delay of a server without RTT samples.
+        self.assertLess(time.monotonic() - start,
+                        resolver.INITIAL_TIMEOUT / 4)
+        self.assertEqual(answered, self.server.address)
+        self.assertEqual(dnswire.get_txt_answer(message,
+                                                '_dmarc.example.com'),
+                         (['v=DMARC1; p=quarantine'], TTL))
+
+    def test_hedge_after_error(self):
+        self.check_hedge_after_error(self.pool.query)
+
+    def test_async_hedge_after_error(self):
+        self.check_hedge_after_error(
+            lambda *args: run(self.pool.async_query(*args)))
+
+    def check_tcp_timeout(self, query_tcp):
+        # The UDP try used up the time before the response came back
+        # truncated.
+        packet = dnswire.encode_query(1, '_dmarc.tc.example.com',
+                                      dnswire.TYPE_TXT)
+        with self.assertRaises(socket.timeout):
+            query_tcp(self.server.address, packet, 1,
+                      '_dmarc.tc.example.com', dnswire.TYPE_TXT, -0.1)
+        self.assertEqual(self.zone.queries['tcp'], 0)
+
+    def test_tcp_timeout(self):
+        self.check_tcp_timeout(self.pool._query_tcp)
+
+    def test_async_tcp_timeout(self):
+        self.check_tcp_timeout(lambda *args: run(
+            self.pool._async_query_tcp(*args)))
+
+    def test_async_close(self):
+        async def main():
+            await self.pool.async_query_txt('_dmarc.tc.example.com', 3,
+                                            [self.server.address])
+            conn, = self.pool._async_tcp.values()
+            await self.pool.async_close()
+            return conn
+
+        conn = run(main())
+        self.assertTrue(conn._reader.done())
+        self.assertIsNotNone(conn.error)
+        self.assertEqual(self.pool._async_tcp, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import os
+import time
+import shutil
+import asyncio
+import tempfile
+import unittest
+
+from dmarc_policy_parser import dns, files, public_suffix, resolver
+from dmarc_policy_parser.cache import MemoryCache, SqliteCache
+from dmarc_policy_parser.server import PolicyServer
+
+from tests.stubdns import StubServer, Zone
+
+
+class LookupTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        self.addCleanup(files.set_cache_home, files.get_cache_home())
+        files.set_cache_home(tmpdir)
+        psl = os.path.join(tmpdir, 'public_suffix_list.dat')
+        with open(psl, 'w') as fp:
+            fp.write('com\n')
+        self.addCleanup(public_suffix.set_public_suffix_file, None)
+        public_suffix.set_public_suffix_file(psl)
+
+        self.zone = Zone()
+        self.zone.txt['_dmarc.slow.com'] = ['v=DMARC1; p=reject']
+        self.zone.delay['_dmarc.slow.com'] = 1
+        server = StubServer(self.zone)
+        server.__enter__()
+        self.addCleanup(server.__exit__, None, None, None)
+        self.addCleanup(resolver.set_nameservers, resolver.get_nameservers())
+        resolver.set_nameservers([server.address])
+
+        dns.set_dns_cache(SqliteCache(os.path.join(tmpdir, 'dns.sqlite3')))
+        self.addCleanup(dns.set_dns_cache, None)
+        dns.set_memory_cache(MemoryCache())
+        self.addCleanup(dns.set_memory_cache, MemoryCache())
+        dns.get_memory_cache().set('_dmarc.cached.com',
+                                   ['v=DMARC1; p=none'], time.time(), 3600)
+        self.loop = asyncio.new_event_loop()
+        self.addCleanup(self.loop.close)
+
+    def test_cache_hits_do_not_wait_for_queries(self):
+        server = PolicyServer(concurrency=1, timeout=5)
+
+        async def main():
+            await server.start([])
+            slow = asyncio.ensure_future(server.lookup('slow.com'))
+            await asyncio.sleep(0.1)
+            start = time.monotonic()
+            cached = await server.lookup('cached.com')
+            cached_time = time.monotonic() - start
+            self.assertFalse(slow.done())
+            return cached, cached_time, await slow
+
+        cached, cached_time, slow = self.loop.run_until_complete(main())
+        self.assertLess(cached_time, 0.5)
+        self.assertEqual(cached.request, 'none')
+        self.assertEqual(slow.request, 'reject')
+
+    def test_queries_are_bounded(self):
+        self.zone.txt['_dmarc.slow2.com'] = ['v=DMARC1; p=quarantine']
+        self.zone.delay['_dmarc.slow2.com'] = 0.5
+        self.zone.delay['_dmarc.slow.com'] = 0.5
+        server = PolicyServer(concurrency=1, timeout=5)
+
+        async def main():
+            await server.start([])
+            start = time.monotonic()
+            records = await asyncio.gather(server.lookup('slow.com'),
+                                           server.lookup('slow2.com'))
+            return records, time.monotonic() - start
+
+        records, elapsed = self.loop.run_until_complete(main())
+        self.assertEqual([r.request for r in records],
+                         ['reject', 'quarantine'])
+        # One query at a time.
+        self.assertGreaterEqual(elapsed, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()